@@ -1,8 +1,19 @@
+import os
+import json
 import time
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+from time import perf_counter
+from fastapi import APIRouter, Depends, HTTPException, Query, Header
+from fastapi.responses import Response
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Dict, Any
-from . import schemas, crud
+from typing import List, Dict, Any, Optional, Literal
+from . import schemas, crud, database, metrics
+from .cache import result_cache, statement_cache, canonical_query_key, canonical_filters_key, data_watermark
+from .columnar import columnar_engine
+from .singleflight import analytics_flights
+from .slowlog import slow_query_log
+from .streaming import negotiate_format, stream_analytics_response
 from .database import get_db
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import text, select
@@ -15,10 +26,29 @@ from .models import stores
 #   dimensões disponíveis — usadas pelo frontend para popular selects.
 # - Endpoint `/analytics`: recebe `AnalyticsQueryRequest`, delega a
 #   `crud.get_analytics_data` e devolve `AnalyticsQueryResponse` com dados
-#   e metadados (incluindo tempo de execução).
+#   e metadados (incluindo tempo de execução). Resultados passam pelo cache
+#   em memória (`cache.py`), invalidado pelo watermark dos dados, e
+#   requisições idênticas concorrentes compartilham uma única execução
+#   (`singleflight.py`). Com o motor colunar carregado (`columnar.py`), a
+#   consulta é respondida em memória e o SQL fica como fallback. Os
+#   metadados trazem o tempo de cada fase (montagem, banco, conversão e
+#   serialização), repetido no header `Server-Timing`.
+# - Endpoint `/analytics/explain` (ANALYTICS_EXPLAIN=1): SQL compilado e
+#   plano do EXPLAIN ANALYZE da mesma requisição, para diagnóstico.
+# - `/admin/slow-queries`: formatos de consulta mais lentos (p50/p95/p99 por
+#   fingerprint) com a última amostra de SQL lento (`slowlog.py`).
+# - Endpoint `/analytics/batch`: recebe várias consultas (ex.: widgets de um
+#   dashboard), funde as que compartilham filtros numa única query GROUPING
+#   SETS e executa os grupos restantes em paralelo, em conexões separadas
+#   (no máximo ANALYTICS_BATCH_CONCURRENCY por vez); um grupo que falha
+#   devolve o erro nos seus itens sem derrubar o lote.
+# - `/analytics?format=ndjson|csv|arrow` (ou Accept equivalente) devolve as
+#   linhas em streaming a partir de um cursor do servidor (`streaming.py`).
 # - Endpoints de metadata (`/metadata/metrics`, `/metadata/dimensions`,
 #   `/metadata/states`, `/metadata/cities`) servem listas auxiliares para a UI.
-# - Endpoint `/health`: simples checagem para confirmar conexão com o DB.
+# - Endpoint `/health`: simples checagem para confirmar conexão com o DB;
+#   `/health/pool` devolve a ocupação do pool de conexões (`database.pool_stats`)
+#   e `/health/caches` a taxa de acerto dos caches de statements e resultados.
 # -------------------------------------------------------------
 
 # =============================================================================
@@ -30,6 +60,47 @@ router = APIRouter(
     tags=["Analytics"],
 )
 
+# `/analytics/explain` executa a query com EXPLAIN ANALYZE: desligado por padrão
+EXPLAIN_ENABLED = os.getenv("ANALYTICS_EXPLAIN", "0").strip().lower() in ("1", "true", "yes")
+
+# grupos do `/analytics/batch` executados ao mesmo tempo (cada um ocupa uma
+# conexão): abaixo do pool, para sobrar conexões às demais requisições
+BATCH_CONCURRENCY = int(os.getenv(
+    "ANALYTICS_BATCH_CONCURRENCY", str(max(1, database.ENGINE_SETTINGS["pool_size"] // 2))
+))
+
+# fases do header Server-Timing: (nome, campo de ResponseMetadata)
+SERVER_TIMING_PHASES = (
+    ("build", "build_time_ms"),
+    ("db", "execute_time_ms"),
+    ("fetch", "fetch_time_ms"),
+    ("serialize", "serialize_time_ms"),
+)
+
+_DATA_JSON = TypeAdapter(List[Any])
+
+# campos de ResponseMetadata que descrevem o resultado (e não a execução):
+# ficam no cache junto dos dados e voltam na resposta de um hit
+RESULT_METADATA_FIELDS = ("engine", "accuracy", "sample_percent", "error_bounds")
+
+
+def _result_metadata(stats: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: stats[field] for field in RESULT_METADATA_FIELDS if field in stats}
+
+
+def server_timing(metadata: schemas.ResponseMetadata) -> str:
+    """Valor do header Server-Timing: fases medidas, origem do resultado e o total."""
+    entries = [
+        f"{name};dur={getattr(metadata, field)}"
+        for name, field in SERVER_TIMING_PHASES
+        if getattr(metadata, field) is not None
+    ]
+    if metadata.cache_hit:
+        entries.append('cache;desc="hit"')
+    total = metadata.execution_time_ms + (metadata.serialize_time_ms or 0)
+    entries.append(f"total;dur={round(total, 3)}")
+    return ", ".join(entries)
+
 # =============================================================================
 # ENDPOINTS DE METADADOS (Já implementados)
 # =============================================================================
@@ -85,32 +156,269 @@ async def get_available_dimensions():
 )
 async def execute_analytics_query(
     query_request: schemas.AnalyticsQueryRequest,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    format: Optional[Literal['json', 'ndjson', 'csv', 'arrow']] = Query(
+        default=None,
+        description=(
+            "Formato da resposta. 'ndjson', 'csv' e 'arrow' (Arrow IPC stream) fazem "
+            "streaming das linhas (sem metadados)."
+        )
+    ),
+    accept: Optional[str] = Header(default=None),
 ):
     """
     Este é o endpoint principal da API. Ele recebe uma requisição JSON
     descrevendo as métricas, dimensões e filtros desejados, e retorna
     os dados analíticos correspondentes.
+
+    Com `?format=ndjson|csv|arrow` (ou `Accept: application/x-ndjson |
+    text/csv | application/vnd.apache.arrow.stream`) as linhas são enviadas
+    em streaming conforme saem do banco.
     """
+    fmt = negotiate_format(format, accept)
+    if fmt != "json":
+        return stream_analytics_response(query_request, fmt)
+
     # Mede o tempo de início para calcular a duração da execução
     start_time = time.time()
 
-    # Chama a função do construtor de queries de crud.py
-    # A execução da query no banco de dados acontece aqui de forma assíncrona.
-    data = await crud.get_analytics_data(query_request=query_request, db=db)
+    # Consulta o cache antes de ir ao banco; o watermark (max sales.id)
+    # garante que entradas anteriores a novas vendas não sejam reaproveitadas.
+    cache_key = canonical_query_key(query_request)
+    watermark = None
+    cache_hit = False
+    coalesced = False
+    data = None
+    build_stats: Dict[str, Any] = {}
+    if result_cache.enabled:
+        watermark = await data_watermark(db)
+        # encerra a transação de leitura para devolver a conexão ao pool
+        # enquanto a query analítica roda (ela usa uma sessão própria)
+        await db.rollback()
+        cached = result_cache.get(cache_key, watermark)
+        if cached is not None:
+            data, result_metadata = cached
+            build_stats = dict(result_metadata)
+            cache_hit = True
+
+    if not cache_hit:
+        async def _execute():
+            # A execução compartilhada usa uma sessão própria: se o cliente
+            # que a iniciou desconectar, a sessão da requisição dele é
+            # fechada, mas as demais requisições continuam aguardando.
+            stats: Dict[str, Any] = {}
+            # motor colunar é CPU-bound: roda numa thread para não travar o event loop.
+            # Com cache, só responde se o snapshot já tem as vendas do watermark
+            # (senão o resultado defasado ficaria em cache como atual).
+            result = await asyncio.to_thread(
+                columnar_engine.execute, query_request, stats, watermark[0] if watermark else None
+            )
+            if result is None:
+                async with database.AsyncSessionFactory() as session:
+                    # Chama a função do construtor de queries de crud.py
+                    result = await crud.get_analytics_data(query_request=query_request, db=session, stats=stats)
+            if result_cache.enabled:
+                result_cache.set(cache_key, watermark, (result, _result_metadata(stats)))
+            return result, stats
+
+        (data, build_stats), coalesced = await analytics_flights.do((cache_key, watermark), _execute)
 
     # Mede o tempo de fim e calcula a duração em milissegundos
     end_time = time.time()
     execution_time_ms = (end_time - start_time) * 1000
 
-    # Retorna os resultados no formato JSON esperado
-    # O FastAPI garante que este dicionário corresponda ao `AnalyticsQueryResponse`.
+    # `data` é serializado aqui (e não pelo FastAPI) para que o tempo gasto
+    # entre nos metadados; o corpo segue o formato de `AnalyticsQueryResponse`.
+    serialize_start = perf_counter()
+    data_json = _DATA_JSON.dump_json(data)
+    metadata = schemas.ResponseMetadata(
+        query=query_request,
+        execution_time_ms=round(execution_time_ms, 2),
+        cache_hit=cache_hit,
+        coalesced=coalesced,
+        serialize_time_ms=round((perf_counter() - serialize_start) * 1000, 3),
+        **build_stats,
+    )
+    body = b'{"data":' + data_json + b',"metadata":' + metadata.model_dump_json().encode() + b"}"
+    metrics.observe_analytics(query_request, metadata, len(data))
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Server-Timing": server_timing(metadata)},
+    )
+
+
+@router.post(
+    "/analytics/explain",
+    response_model=schemas.AnalyticsExplainResponse,
+    summary="Plano de execução de uma consulta analítica"
+)
+async def explain_analytics_query(
+    query_request: schemas.AnalyticsQueryRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Devolve o SQL que `/analytics` executaria para a requisição (mesmo
+    roteamento para rollups/amostragem) e a saída de `EXPLAIN (ANALYZE,
+    BUFFERS, FORMAT JSON)`. A query é de fato executada, por isso o endpoint
+    só existe com ANALYTICS_EXPLAIN=1. O motor colunar não é considerado.
+    """
+    if not EXPLAIN_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    prepared = crud.prepare_analytics_query(query_request)
+    if prepared.statement is None:
+        return {"build_time_ms": prepared.build_time_ms}
+
+    sql, params = crud.compiled_sql(prepared.statement, prepared.params)
+    started = perf_counter()
+    try:
+        raw = (await db.execute(
+            crud.Explain(prepared.statement, "ANALYZE, BUFFERS, FORMAT JSON"), prepared.params
+        )).scalar()
+    except SQLAlchemyError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+    finally:
+        await db.rollback()
+    return {
+        "sql": sql,
+        "params": params,
+        "plan": json.loads(raw) if isinstance(raw, str) else raw,
+        "build_time_ms": prepared.build_time_ms,
+        "explain_time_ms": round((perf_counter() - started) * 1000, 3),
+    }
+
+
+def _batch_groups(queries) -> List[List[int]]:
+    """
+    Agrupa os índices das consultas do lote em grupos de execução.
+
+    Consultas fundíveis (ver `crud.is_fusable`) com filtros idênticos formam
+    um grupo; as demais executam sozinhas. Grupos ficam na ordem da
+    primeira consulta de cada um.
+    """
+    groups: List[List[int]] = []
+    by_filters: Dict[str, List[int]] = {}
+    for i, query_request in enumerate(queries):
+        if crud.is_fusable(query_request):
+            key = canonical_filters_key(query_request.filters)
+            if key not in by_filters:
+                by_filters[key] = []
+                groups.append(by_filters[key])
+            by_filters[key].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+@router.post(
+    "/analytics/batch",
+    response_model=schemas.AnalyticsBatchResponse,
+    summary="Executar Várias Consultas Analíticas"
+)
+async def execute_analytics_batch(
+    batch_request: schemas.AnalyticsBatchRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Executa várias consultas de uma vez e devolve os resultados na mesma
+    ordem do corpo. Consultas com os mesmos filtros são respondidas por uma
+    única query (GROUPING SETS); os grupos rodam em paralelo (até
+    ANALYTICS_BATCH_CONCURRENCY), cada um em uma conexão do pool, e cada
+    item informa o tempo do seu grupo. A falha de um grupo não derruba o
+    lote: seus itens voltam sem dados e com `metadata.error`.
+    """
+    start_time = time.time()
+    queries = batch_request.queries
+    results: List[Any] = [None] * len(queries)
+
+    # Itens já presentes no cache não vão ao banco
+    cache_keys = [canonical_query_key(q) for q in queries]
+    watermark = None
+    pending = list(range(len(queries)))
+    if result_cache.enabled:
+        watermark = await data_watermark(db)
+        await db.rollback()
+        pending = []
+        for i, key in enumerate(cache_keys):
+            cached = result_cache.get(key, watermark)
+            if cached is None:
+                pending.append(i)
+            else:
+                data, result_metadata = cached
+                results[i] = {
+                    "data": data, "time_ms": 0.0, "cache_hit": True, "group": None, "fused": False,
+                    "stats": result_metadata,
+                }
+
+    groups = [[pending[j] for j in g] for g in _batch_groups([queries[i] for i in pending])]
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    min_sale_id = watermark[0] if watermark else None
+
+    def _run_columnar(indexes, stats):
+        return [columnar_engine.execute(queries[i], s, min_sale_id) for i, s in zip(indexes, stats)]
+
+    async def _run_group(indexes: List[int]):
+        group_start = time.time()
+        # motor colunar: o grupo inteiro em memória (numa thread), sem conexão
+        stats = [{} for _ in indexes]
+        datasets = await asyncio.to_thread(_run_columnar, indexes, stats)
+        if all(data is not None for data in datasets):
+            return datasets, stats, (time.time() - group_start) * 1000
+        # cada grupo usa sua própria sessão/conexão para rodar em paralelo
+        async with semaphore, database.AsyncSessionFactory() as session:
+            if len(indexes) > 1:
+                datasets = await crud.get_fused_analytics_data([queries[i] for i in indexes], session)
+                # consultas fundidas nunca são aproximadas (ver `crud.is_fusable`)
+                stats = [{"engine": "sql", "accuracy": "exact"} for _ in indexes]
+            else:
+                stats = [{}]
+                datasets = [await crud.get_analytics_data(query_request=queries[indexes[0]], db=session, stats=stats[0])]
+        return datasets, stats, (time.time() - group_start) * 1000
+
+    outcomes = await asyncio.gather(*[_run_group(g) for g in groups], return_exceptions=True)
+
+    for group_index, (indexes, outcome) in enumerate(zip(groups, outcomes)):
+        if isinstance(outcome, BaseException):
+            if not isinstance(outcome, Exception):
+                raise outcome  # CancelledError etc.
+            for i in indexes:
+                results[i] = {
+                    "data": [], "time_ms": 0.0, "cache_hit": False, "group": group_index,
+                    "fused": len(indexes) > 1, "stats": {}, "error": f"{type(outcome).__name__}: {outcome}",
+                }
+            continue
+        datasets, stats, elapsed_ms = outcome
+        for i, data, item_stats in zip(indexes, datasets, stats):
+            result_metadata = _result_metadata(item_stats)
+            if result_cache.enabled:
+                result_cache.set(cache_keys[i], watermark, (data, result_metadata))
+            results[i] = {
+                "data": data, "time_ms": elapsed_ms, "cache_hit": False,
+                "group": group_index, "fused": len(indexes) > 1, "stats": result_metadata,
+            }
+
+    execution_time_ms = (time.time() - start_time) * 1000
     return {
-        "data": data,
-        "metadata": {
-            "query": query_request,
-            "execution_time_ms": round(execution_time_ms, 2)
-        }
+        "results": [
+            {
+                "data": r["data"],
+                "metadata": {
+                    "query": q,
+                    "execution_time_ms": round(r["time_ms"], 2),
+                    "cache_hit": r["cache_hit"],
+                    # itens servidos pelo cache não pertencem a nenhum grupo
+                    "group": r["group"] if r["group"] is not None else -1,
+                    "fused": r["fused"],
+                    "error": r.get("error"),
+                    **r["stats"],
+                },
+            }
+            for q, r in zip(queries, results)
+        ],
+        "execution_time_ms": round(execution_time_ms, 2),
     }
 
 
@@ -131,6 +439,62 @@ async def health(db=Depends(get_db)):
         raise HTTPException(status_code=503, detail=f"db_unavailable: {exc}")
 
 
+@router.get("/health/pool", summary="Ocupação do pool de conexões do banco")
+async def health_pool():
+    """
+    Estatísticas do pool de conexões (perfil do engine, conexões em uso,
+    saturação e contadores desde o startup). Não consulta o banco; use para
+    dimensionar DB_POOL_SIZE/DB_MAX_OVERFLOW sob carga real.
+    """
+    return database.pool_stats()
+
+
+@router.get("/health/caches", summary="Estatísticas dos caches de consultas")
+async def health_caches():
+    """
+    Taxa de acerto do cache de statements por formato (`statement_cache`) e
+    do cache de resultados (`result_cache`) desde o startup, e o estado do
+    motor colunar em memória.
+    """
+    total = result_cache.hits + result_cache.misses
+    return {
+        "statements": statement_cache.stats(),
+        "results": {
+            "size": len(result_cache),
+            "hits": result_cache.hits,
+            "misses": result_cache.misses,
+            "hit_rate": round(result_cache.hits / total, 4) if total else None,
+        },
+        "columnar": columnar_engine.stats(),
+    }
+
+
+@router.get("/admin/slow-queries", summary="Formatos de consulta mais lentos")
+async def admin_slow_queries(
+    limit: int = Query(default=10, ge=1, le=100),
+    order_by: Literal[
+        'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'mean_ms', 'total_ms', 'count', 'slow_count'
+    ] = Query(default='p95_ms'),
+):
+    """
+    Top-N fingerprints de `crud.get_analytics_data` (formato da requisição
+    sem valores) pela estatística `order_by`, com percentis da janela
+    recente e o último SQL lento amostrado (binds incluídos).
+    """
+    return {
+        "threshold_ms": slow_query_log.threshold_ms,
+        "sample_rate": slow_query_log.sample_rate,
+        "fingerprints": len(slow_query_log),
+        "top": slow_query_log.top(limit, order_by),
+    }
+
+
+@router.delete("/admin/slow-queries", summary="Zera o registro de consultas lentas")
+async def admin_reset_slow_queries():
+    slow_query_log.clear()
+    return {"status": "ok"}
+
+
 @router.get('/metadata/states', summary='Obter lista de estados (stores.state)')
 async def get_states(db: AsyncSession = Depends(get_db)):
     """Retorna a lista de estados únicos das lojas (stores.state)."""
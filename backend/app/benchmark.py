@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select, func, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from . import crud, indexes, partitions, rollups, schemas
+from .models import sales
+from .slowlog import fingerprint, percentile, slow_query_log
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Benchmark reprodutível do construtor de queries (`python -m app.benchmark`).
+# - `seed`: cria o schema num banco vazio (dedicado ao benchmark) e o popula
+#   com `generate_data.py` de forma determinística (`--seed` e `--end-date`
+#   fixos) em 1, 6 ou 24 meses; depois aplica os índices e monta os rollups,
+#   como num ambiente real.
+# - `run`: executa a carga canônica dos dashboards via
+#   `crud.get_analytics_data` (com o roteamento para rollups/particionamento
+#   do banco), `--iterations` vezes por consulta após `--warmup` execuções,
+#   e grava p50/p95/máx e linhas/s por formato de consulta (fingerprint do
+#   `slowlog.py`) num JSON. Com `--baseline`, compara e sai com código 1 se
+#   algum formato regrediu.
+# - `compare`: compara dois arquivos de resultado já gravados.
+# - Regressão: p50 acima de `baseline × (1 + threshold)`. O p95 é reportado,
+#   mas não decide (poucas iterações o deixam ruidoso).
+# -------------------------------------------------------------
+
+SCALES = (1, 6, 24)
+DEFAULT_SEED = 42
+DEFAULT_END_DATE = "2025-06-30"
+DEFAULT_THRESHOLD = 0.25
+
+# raiz do repositório (schema e gerador de dados)
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+
+def benchmark_workload(last_day) -> List[schemas.AnalyticsQueryRequest]:
+    """
+    Carga do benchmark: visões de dashboard servidas pelos rollups (visão
+    geral, série diária, ranking de produtos) e a carga canônica de
+    `indexes.canonical_workload`, que exercita o caminho bruto.
+    """
+    month = [str(last_day - timedelta(days=29)), str(last_day)]
+    quarter = [str(last_day - timedelta(days=89)), str(last_day)]
+    bodies = [
+        {"metrics": ["total_revenue", "order_count", "avg_order_value"], "dimensions": ["channel_name"],
+         "filters": [{"field": "order_time", "operator": "between", "value": month}]},
+        {"metrics": ["total_revenue"], "dimensions": ["channel_name"], "time_grain": "day",
+         "filters": [{"field": "order_time", "operator": "between", "value": quarter}]},
+        {"metrics": ["total_revenue", "order_count"], "dimensions": ["product_name"], "limit": 10, "others": True,
+         "filters": [{"field": "order_time", "operator": "between", "value": month}]},
+        {"metrics": ["avg_order_value"], "dimensions": ["order_day_of_week"],
+         "filters": [{"field": "order_time", "operator": "between", "value": quarter}]},
+        {"metrics": ["total_revenue"], "dimensions": ["store_name"], "time_grain": "month"},
+    ]
+    return [schemas.AnalyticsQueryRequest(**body) for body in bodies] + indexes.canonical_workload(last_day)
+
+
+def describe(query_request) -> str:
+    """Rótulo legível de uma requisição para os relatórios."""
+    filters = ",".join(f.field for f in query_request.filters) or "-"
+    extra = []
+    if query_request.time_grain:
+        extra.append(f"grain={query_request.time_grain}")
+    if query_request.limit:
+        extra.append(f"top{query_request.limit}" + ("+others" if query_request.others else ""))
+    return (f"{'+'.join(query_request.metrics)} by {'+'.join(query_request.dimensions) or '-'}"
+            f" [{filters}]" + (f" {' '.join(extra)}" if extra else ""))
+
+
+def summarize(durations_ms: List[float], rows: int) -> Dict[str, Any]:
+    ordered = sorted(durations_ms)
+    p50 = percentile(ordered, 0.50)
+    return {
+        "iterations": len(ordered),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(percentile(ordered, 0.95), 3),
+        "max_ms": round(ordered[-1], 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / (p50 / 1000), 1) if p50 else None,
+    }
+
+
+async def dataset_info(conn) -> Dict[str, Any]:
+    first, last, count = (await conn.execute(
+        select(func.min(sales.c.created_at), func.max(sales.c.created_at), func.count())
+    )).one()
+    months = round((last - first).days / 30) if first and last else 0
+    return {
+        "sales": count,
+        "first_sale": first.isoformat() if first else None,
+        "last_sale": last.isoformat() if last else None,
+        "months": months,
+        "server_version": (await conn.execute(text("SHOW server_version"))).scalar(),
+    }
+
+
+async def run_benchmark(engine: AsyncEngine, iterations: int = 20, warmup: int = 2,
+                        requests: Optional[List[schemas.AnalyticsQueryRequest]] = None) -> Dict[str, Any]:
+    """
+    Executa a carga e devolve o documento de resultados: metadados do
+    ambiente/dataset e, por fingerprint, as estatísticas de `summarize`.
+    """
+    async with engine.connect() as conn:
+        await rollups.load_rollup_state(conn)
+        await partitions.load_partition_state(conn)
+        dataset = await dataset_info(conn)
+    if requests is None:
+        last = datetime.fromisoformat(dataset["last_sale"]) if dataset["last_sale"] else datetime.now()
+        requests = benchmark_workload(last.date())
+
+    queries: Dict[str, Any] = {}
+    # o benchmark mede cada execução; o log de lentas só poluiria a saída
+    saved_threshold, slow_query_log.threshold_ms = slow_query_log.threshold_ms, float("inf")
+    try:
+        for query_request in requests:
+            durations, rows, stats = [], 0, {}
+            for i in range(warmup + iterations):
+                # sessão nova a cada execução, como numa requisição da API
+                async with AsyncSession(engine) as session:
+                    started = perf_counter()
+                    data = await crud.get_analytics_data(query_request, session, stats)
+                    elapsed_ms = (perf_counter() - started) * 1000
+                if i >= warmup:
+                    durations.append(elapsed_ms)
+                    rows = len(data)
+            fp, _shape = fingerprint(query_request)
+            # mesmo formato com outros valores: chave estável pela ordem na carga
+            base, n = fp, 1
+            while fp in queries:
+                n += 1
+                fp = f"{base}-{n}"
+            queries[fp] = {
+                "query": describe(query_request),
+                "source": "rollup" if crud.select_rollup(query_request) else "raw",
+                **summarize(durations, rows),
+            }
+            print(f"  {queries[fp]['p50_ms']:>9.1f} ms p50  {queries[fp]['p95_ms']:>9.1f} ms p95  "
+                  f"{rows:>6} linhas  {queries[fp]['query']}")
+    finally:
+        slow_query_log.threshold_ms = saved_threshold
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "iterations": iterations,
+            "warmup": warmup,
+            "rollups": rollups.ROLLUP_STATE["available"],
+            "partitioned": partitions.PARTITION_STATE["enabled"],
+            "dataset": dataset,
+        },
+        "queries": queries,
+    }
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any],
+                    threshold: float = DEFAULT_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Uma linha por fingerprint presente nos dois resultados, com a razão
+    p50 atual/baseline e `regression` quando ela passa de 1 + `threshold`.
+    """
+    rows = []
+    for fp, cur in current["queries"].items():
+        base = baseline["queries"].get(fp)
+        if base is None or not base.get("p50_ms"):
+            continue
+        ratio = cur["p50_ms"] / base["p50_ms"]
+        rows.append({
+            "fingerprint": fp,
+            "query": cur["query"],
+            "baseline_p50_ms": base["p50_ms"],
+            "p50_ms": cur["p50_ms"],
+            "baseline_p95_ms": base.get("p95_ms"),
+            "p95_ms": cur["p95_ms"],
+            "ratio": round(ratio, 3),
+            "regression": ratio > 1 + threshold,
+        })
+    return rows
+
+
+def _print_comparison(rows: List[Dict[str, Any]], current: Dict[str, Any], baseline: Dict[str, Any]) -> bool:
+    if current["meta"]["dataset"]["sales"] != baseline["meta"]["dataset"]["sales"]:
+        print("Aviso: datasets diferentes (contagem de vendas) entre o resultado e o baseline")
+    for row in rows:
+        flag = "REGRESSÃO" if row["regression"] else "ok"
+        print(f"  [{flag:>9}] {row['ratio']:>5.2f}x  {row['baseline_p50_ms']:.1f} -> {row['p50_ms']:.1f} ms  {row['query']}")
+    missing = set(current["queries"]) ^ set(baseline["queries"])
+    if missing:
+        print(f"  {len(missing)} formato(s) presentes em só um dos arquivos foram ignorados")
+    regressions = [row for row in rows if row["regression"]]
+    print(f"{len(regressions)} regressão(ões) em {len(rows)} formato(s) comparados")
+    return bool(regressions)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# =============================================================================
+# SEED
+# =============================================================================
+
+async def seed_database(engine: AsyncEngine, months: int, seed: int, end_date: str, reset: bool = False,
+                        workers: int = 1) -> None:
+    """Schema + `generate_data.py` determinístico + índices + rollups."""
+    async with engine.connect() as conn:
+        has_sales = (await conn.execute(text("SELECT to_regclass('sales')"))).scalar()
+        if has_sales and not reset:
+            raise SystemExit("O banco já tem o schema: use um banco vazio ou --reset (apaga o schema public)")
+
+    async with engine.begin() as conn:
+        if reset:
+            await conn.execute(text("DROP SCHEMA public CASCADE"))
+            await conn.execute(text("CREATE SCHEMA public"))
+        # asyncpg não executa vários comandos num statement preparado: via driver
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.execute((REPO_ROOT / "database-schema.sql").read_text())
+
+    # o gerador usa psycopg2 (URL síncrona)
+    sync_url = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    subprocess.run([
+        sys.executable, str(REPO_ROOT / "generate_data.py"), "--db-url", sync_url,
+        "--months", str(months), "--seed", str(seed), "--end-date", end_date, "--workers", str(workers),
+    ], check=True)
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await indexes.apply_indexes(conn)
+    async with engine.begin() as conn:
+        await rollups.ensure_rollup_schema(conn)
+    async with engine.begin() as conn:
+        await rollups.rebuild_rollups(conn)
+        await conn.execute(text("ANALYZE"))
+
+
+# =============================================================================
+# CLI
+# =============================================================================
+
+def _load(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+async def _run(args) -> int:
+    # import tardio: `database` exige DATABASE_URL definido
+    from .database import engine
+
+    try:
+        if args.command == "seed":
+            await seed_database(engine, args.months, args.seed, args.end_date, args.reset, args.workers)
+            print(f"✓ Dataset de {args.months} mês(es) pronto (seed={args.seed}, fim={args.end_date})")
+            return 0
+
+        results = await run_benchmark(engine, args.iterations, args.warmup)
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2, ensure_ascii=False)
+        print(f"✓ Resultados em {args.output}")
+        if args.baseline:
+            baseline = _load(args.baseline)
+            return 1 if _print_comparison(compare_results(results, baseline, args.threshold), results, baseline) else 0
+        return 0
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do construtor de queries do analytics")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    seed = sub.add_parser("seed", help="popula um banco vazio com um dataset determinístico")
+    seed.add_argument("--months", type=int, choices=SCALES, default=1)
+    seed.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    seed.add_argument("--end-date", default=DEFAULT_END_DATE, help="último dia de vendas (YYYY-MM-DD)")
+    seed.add_argument("--reset", action="store_true", help="apaga o schema public antes de popular")
+    seed.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                      help="processos do gerador (os dados não dependem desse número)")
+
+    run = sub.add_parser("run", help="executa a carga e grava os resultados")
+    run.add_argument("--iterations", type=int, default=20)
+    run.add_argument("--warmup", type=int, default=2)
+    run.add_argument("--output", default="benchmark-results.json")
+    run.add_argument("--baseline", help="resultado anterior para comparar (sai com 1 se houver regressão)")
+    run.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    compare = sub.add_parser("compare", help="compara um resultado com o baseline")
+    compare.add_argument("results")
+    compare.add_argument("baseline")
+    compare.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        current, baseline = _load(args.results), _load(args.baseline)
+        sys.exit(1 if _print_comparison(compare_results(current, baseline, args.threshold), current, baseline) else 0)
+    sys.exit(asyncio.run(_run(args)))
+
+
+if __name__ == "__main__":
+    main()
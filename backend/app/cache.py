@@ -0,0 +1,177 @@
+import os
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, date
+from typing import Any, Callable, Optional, Tuple
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import sales
+from .rollups import ROLLUP_STATE
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Cache de resultados em memória (por processo) para `/analytics`.
+# - canonical_query_key: forma canônica da requisição (filtros ordenados e
+#   com valores/datas normalizados), de modo que requisições equivalentes
+#   compartilhem a mesma entrada. Métricas e dimensões mantêm a ordem pedida:
+#   ela define o ranking do Top-N sem order_by, os desempates, a ordem do
+#   gap-fill e a das colunas na resposta.
+# - data_watermark: consulta barata (max(sales.id), resolvida pelo índice
+#   da PK) que muda sempre que novas vendas chegam; entradas gravadas com
+#   outro watermark são descartadas, então o cache nunca fica defasado em
+#   relação a inserções. Inclui também o `refreshed_at` dos rollups: a
+#   manutenção incremental (ver rollups.py) invalida o cache quando aplica
+#   updates/deletes ou vendas atrasadas aos buckets.
+# - QueryResultCache: LRU limitado por tamanho e com TTL (o TTL cobre
+#   alterações que não mudam o watermark, como updates de status quando os
+#   rollups não estão em uso).
+# - StatementCache: LRU de statements SQLAlchemy já montados, indexados pelo
+#   "formato" da requisição (ver `crud.prepare_analytics_query`); só os
+#   valores dos bind params mudam entre chamadas.
+# -------------------------------------------------------------
+
+CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_SIZE", "256"))
+CACHE_TTL_SECONDS = float(os.getenv("ANALYTICS_CACHE_TTL_SECONDS", "300"))
+STATEMENT_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_STATEMENT_CACHE_SIZE", "512"))
+
+
+def _normalize_value(val):
+    """Converte valores de filtro para uma forma estável e serializável."""
+    if isinstance(val, (datetime, date)):
+        return val.isoformat()
+    if isinstance(val, (list, tuple)):
+        return [_normalize_value(v) for v in val]
+    return val
+
+
+def _filter_payload(f):
+    get = f.get if isinstance(f, dict) else (lambda k: getattr(f, k, None))
+    operator = get("operator")
+    value = _normalize_value(get("value"))
+    # a ordem dos valores não importa para in/notin (mas importa para between)
+    if operator in ("in", "notin") and isinstance(value, list):
+        value = sorted(value, key=repr)
+    return {"field": get("field"), "operator": operator, "value": value}
+
+
+def canonical_query_key(query_request) -> str:
+    """Chave canônica (string JSON) para uma `AnalyticsQueryRequest`."""
+    if hasattr(query_request, "model_dump"):
+        payload = query_request.model_dump()
+    else:
+        payload = dict(vars(query_request))
+
+    payload["metrics"] = list(payload.get("metrics") or [])
+    payload["dimensions"] = list(payload.get("dimensions") or [])
+    payload["filters"] = _canonical_filters(payload.get("filters"))
+    return json.dumps(payload, sort_keys=True, default=str)
+
+
+def _canonical_filters(filters):
+    return sorted(
+        (_filter_payload(f) for f in filters or []),
+        key=lambda f: json.dumps(f, sort_keys=True, default=str),
+    )
+
+
+def canonical_filters_key(filters) -> str:
+    """Chave canônica apenas dos filtros (agrupa requisições no `/analytics/batch`)."""
+    return json.dumps(_canonical_filters(filters), sort_keys=True, default=str)
+
+
+async def data_watermark(db: AsyncSession):
+    """Watermark dos dados: maior `sales.id` (index-only scan na PK) + refresh dos rollups."""
+    result = await db.execute(select(func.max(sales.c.id)))
+    return result.scalar(), ROLLUP_STATE["refreshed_at"]
+
+
+class QueryResultCache:
+    """LRU com TTL cujas entradas são válidas apenas para um watermark."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[Any, float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key: str, watermark) -> Optional[Any]:
+        """Devolve o valor em cache ou None (miss, expirado ou watermark antigo)."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at, entry_watermark = entry
+            if entry_watermark == watermark and self._clock() - stored_at < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, watermark, value: Any) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = (value, self._clock(), watermark)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class StatementCache:
+    """LRU de statements montados, indexado pelo formato da consulta."""
+
+    def __init__(self, max_entries: int = STATEMENT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Devolve (statement, hit), montando e guardando o statement no miss."""
+        statement = self._entries.get(key)
+        if statement is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return statement, True
+        self.misses += 1
+        statement = build()
+        if self.max_entries > 0 and statement is not None:
+            self._entries[key] = statement
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return statement, False
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return round(self.hits / total, 4) if total else None
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Instâncias compartilhadas pelo processo (usadas por `api.execute_analytics_query`
+# e `crud.prepare_analytics_query`)
+result_cache = QueryResultCache()
+statement_cache = StatementCache()
@@ -0,0 +1,760 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import select, text
+
+from . import crud
+from .models import stores, channels, products, sales, product_sales
+
+try:
+    import numpy as np
+except ImportError:  # motor colunar indisponível sem o pacote
+    np = None
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Motor analítico colunar em memória (opcional, `ANALYTICS_COLUMNAR=1`).
+#   Carrega `sales`/`product_sales` em arrays NumPy no startup e responde
+#   `AnalyticsQueryRequest`s sem ir ao Postgres, com a mesma semântica de
+#   METRIC_MAP/DIMENSION_MAP/FILTER_MAP do caminho SQL (`crud.py`).
+# - Layout: uma linha por venda (id, created_at, loja, canal, hora, dia da
+#   semana, receita e nº de linhas da venda) e uma por linha de produto
+#   (índice da venda, produto, receita). Atributos das dimensões (nome do
+#   produto, categoria, cidade da loja...) são dictionary-encoded: cada
+#   tabela de dimensão vira um array código-por-id e a lista de valores.
+# - Filtros são avaliados uma vez por valor do dicionário e propagados aos
+#   fatos por indexação; o group-by combina os códigos das dimensões numa
+#   chave inteira e agrega com `np.bincount` (ou `np.unique` quando o espaço
+#   de chaves é grande demais para um array denso).
+# - Consultas só com dimensões/filtros de venda usam os agregados por venda
+#   (sem tocar nas linhas de produto); order_count por produto deduplica os
+#   pares (grupo, venda).
+# - Receita sai em Decimal arredondado a centavos, como `rollups.money`.
+#   Os dicionários de texto seguem a ordem do banco (ORDER BY na collation
+#   dele), e ordenações (Top-N, gap-fill) usam a posição no dicionário;
+#   filtros de intervalo sobre texto só rodam aqui se a collation for a
+#   binária ("C"), cuja ordem é a mesma das strings Python.
+# - Formatos não suportados (ex.: datas com fuso, tipos de filtro que o SQL
+#   coeriria) devolvem None e a API usa o caminho SQL, assim como um
+#   snapshot que ainda não alcançou o watermark pedido pela API.
+# - Atualização: a cada ANALYTICS_COLUMNAR_REFRESH_SECONDS anexa as vendas
+#   com id acima do último carregado; a cada
+#   ANALYTICS_COLUMNAR_RELOAD_SECONDS recarrega tudo (cobre updates,
+#   deletes e commits fora da ordem dos ids, como o TTL do cache).
+# -------------------------------------------------------------
+
+logger = logging.getLogger("nola")
+
+CENTS = Decimal("0.01")
+
+COLUMNAR_ENABLED = os.getenv("ANALYTICS_COLUMNAR", "0").strip().lower() in ("1", "true", "yes")
+COLUMNAR_REFRESH_SECONDS = float(os.getenv("ANALYTICS_COLUMNAR_REFRESH_SECONDS", "5"))
+COLUMNAR_RELOAD_SECONDS = float(os.getenv("ANALYTICS_COLUMNAR_RELOAD_SECONDS", "300"))
+
+# Maior espaço de chaves agregado com bincount denso; acima disso usa np.unique
+DENSE_GROUP_LIMIT = 1 << 22
+
+LOAD_BATCH_SIZE = 50_000
+
+US_PER_HOUR = 3_600_000_000
+US_PER_DAY = 24 * US_PER_HOUR
+EPOCH = datetime(1970, 1, 1)
+
+# to_char(created_at, 'Day'): nome em inglês completado com espaços até 9 caracteres
+DAY_NAMES = [f"{name:<9}" for name in (
+    "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday",
+)]
+# extract('hour', ...) devolve NUMERIC no Postgres
+HOUR_VALUES = [Decimal(h) for h in range(24)]
+
+# Campos da API resolvidos para (tabela de dimensão, atributo)
+DIMENSION_FIELDS = {
+    "product_name": ("product", "name"),
+    "product_category": ("product", "category"),
+    "product_id": ("product", "id"),
+    "channel_name": ("channel", "name"),
+    "channel_id": ("channel", "id"),
+    "store_name": ("store", "name"),
+    "store_city": ("store", "city"),
+    "store_state": ("store", "state"),
+    "store_id": ("store", "id"),
+    # mesma coluna escolhida em crud.DIMENSION_MAP['region']
+    "region": ("store", crud.DIMENSION_MAP["region"].element.name),
+}
+
+DIMENSION_TABLES = {"store": stores, "channel": channels, "product": products}
+
+SALE_COLUMNS = {"id": "int64", "created_at": "datetime64[us]", "store_id": "int32", "channel_id": "int32"}
+LINE_COLUMNS = {"sale_id": "int64", "product_id": "int32", "revenue": "float64"}
+
+# collations cuja ordem de texto é a ordem dos code points (a das strings Python)
+CODEPOINT_COLLATIONS = {"C", "POSIX", "C.UTF-8", "C.utf8", "ucs_basic"}
+RANGE_OPERATORS = {"gt", "gte", "lt", "lte", "between"}
+
+
+class _Unsupported(Exception):
+    """Requisição fora do que o motor colunar reproduz exatamente (usa o SQL)."""
+
+
+def _null_last(value):
+    return (value is None, value)
+
+
+class _Dictionary(NamedTuple):
+    codes: Any       # código do valor, indexado pelo id da tabela de dimensão
+    values: list     # valor de cada código (ordenados, NULL por último)
+    rank: dict       # valor -> código (posição na ordem do banco)
+
+
+def _dictionary(rows, attr, ordered=None) -> _Dictionary:
+    """Dicionário de `attr`; `ordered`: valores distintos na ordem do banco (ORDER BY)."""
+    values = list(ordered) if ordered is not None else sorted({row[attr] for row in rows}, key=_null_last)
+    index = {v: i for i, v in enumerate(values)}
+    codes = np.full(max((row["id"] for row in rows), default=-1) + 1, -1, dtype=np.int32)
+    for row in rows:
+        codes[row["id"]] = index[row[attr]]
+    return _Dictionary(codes, values, index)
+
+
+class ColumnarSnapshot:
+    """
+    Cópia imutável dos fatos em colunas. Atualizações montam um snapshot novo
+    e trocam a referência, então uma consulta sempre vê um estado consistente.
+    """
+
+    def __init__(self, sale_cols: Dict[str, Any], line_cols: Dict[str, Any], dimension_rows: Dict[str, list],
+                 dimension_order: Optional[Dict[tuple, list]] = None, collation: str = "C"):
+        self.sale_cols, self.line_cols = sale_cols, line_cols
+        self.dimension_rows = dimension_rows
+        # comparações de texto em Python só equivalem às do banco na collation binária
+        self.codepoint_collation = collation in CODEPOINT_COLLATIONS
+
+        order = np.argsort(sale_cols["id"], kind="stable")
+        self.sale_id = sale_cols["id"][order]
+        self.created_at = sale_cols["created_at"][order].view(np.int64)
+        self.store_id = sale_cols["store_id"][order]
+        self.channel_id = sale_cols["channel_id"][order]
+        self.day = self.created_at // US_PER_DAY
+        self.hour = ((self.created_at // US_PER_HOUR) % 24).astype(np.int8)
+        # 1970-01-01 foi uma quinta-feira; 0 = segunda
+        self.dow = ((self.day + 3) % 7).astype(np.int8)
+
+        # linhas ordenadas pela venda: as linhas de uma venda ficam contíguas
+        line_sale = np.searchsorted(self.sale_id, line_cols["sale_id"])
+        order = np.argsort(line_sale, kind="stable")
+        self.line_sale = line_sale[order]
+        self.line_product = line_cols["product_id"][order]
+        self.line_revenue = line_cols["revenue"][order]
+
+        n_sales = len(self.sale_id)
+        self.sale_revenue = np.bincount(self.line_sale, weights=self.line_revenue, minlength=n_sales)
+        self.sale_lines = np.bincount(self.line_sale, minlength=n_sales)
+
+        # atributos ausentes no banco (ex.: products.category) ficam sem dicionário
+        dimension_order = dimension_order or {}
+        self.dictionaries = {
+            (table, attr): _dictionary(dimension_rows[table], attr, dimension_order.get((table, attr)))
+            for table, attr in set(DIMENSION_FIELDS.values())
+            if not dimension_rows[table] or attr in dimension_rows[table][0]
+        }
+        self.max_sale_id = int(self.sale_id[-1]) if n_sales else 0
+
+    def dictionary(self, table, attr) -> _Dictionary:
+        d = self.dictionaries.get((table, attr))
+        if d is None:
+            raise _Unsupported
+        return d
+
+    def sale_dimension(self, table):
+        return self.store_id if table == "store" else self.channel_id
+
+    def nbytes(self) -> int:
+        arrays = [
+            self.sale_id, self.created_at, self.store_id, self.channel_id, self.day, self.hour,
+            self.dow, self.line_sale, self.line_product, self.line_revenue, self.sale_revenue,
+            self.sale_lines,
+        ]
+        return sum(a.nbytes for a in arrays)
+
+
+# =============================================================================
+# FILTROS
+# =============================================================================
+
+def _check_types(sample, values):
+    """O SQL coeriria (ou rejeitaria) comparações entre tipos diferentes: usa o SQL."""
+    numeric = isinstance(sample, (int, Decimal)) and not isinstance(sample, bool)
+    for v in values:
+        if v is None:
+            continue
+        if numeric and (isinstance(v, bool) or not isinstance(v, (int, float, Decimal))):
+            raise _Unsupported
+        if isinstance(sample, str) and not isinstance(v, str):
+            raise _Unsupported
+
+
+def _bind_values(operator, binds, name):
+    if operator == 'between':
+        return [binds[f"{name}_lo"], binds[f"{name}_hi"]]
+    value = binds[name]
+    return list(value) if operator in ('in', 'notin') else [value]
+
+
+def _matches(value, operator, binds, name) -> bool:
+    """Mesma semântica do filtro SQL para um valor do dicionário (NULL nunca passa)."""
+    if value is None:
+        return False
+    if operator == 'between':
+        lo, hi = binds[f"{name}_lo"], binds[f"{name}_hi"]
+        return lo is not None and hi is not None and lo <= value <= hi
+    x = binds[name]
+    if operator == 'in':
+        return value in x
+    if operator == 'notin':
+        return None not in x and value not in x
+    if x is None:
+        return False
+    if operator == 'eq':
+        return value == x
+    if operator == 'neq':
+        return value != x
+    if operator == 'gt':
+        return value > x
+    if operator == 'gte':
+        return value >= x
+    if operator == 'lt':
+        return value < x
+    return value <= x
+
+
+def _dictionary_mask(values, codes, operator, binds, name, codepoint_collation=True):
+    """Avalia o filtro uma vez por valor distinto e propaga pelos códigos."""
+    sample = next((v for v in values if v is not None), None)
+    if isinstance(sample, str) and operator in RANGE_OPERATORS and not codepoint_collation:
+        # a ordem do texto depende da collation do banco
+        raise _Unsupported
+    if values:
+        _check_types(sample, _bind_values(operator, binds, name))
+    keep = np.array([_matches(v, operator, binds, name) for v in values] + [False], dtype=bool)
+    # código -1 (id sem dimensão) cai no False extra do final
+    return keep[codes]
+
+
+def _raw_value(field, value):
+    if value is None:
+        return None
+    if field == "order_time":
+        if not isinstance(value, datetime) or value.tzinfo is not None:
+            raise _Unsupported
+        return (value - EPOCH) // timedelta(microseconds=1)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise _Unsupported
+    return value
+
+
+def _compare(array, field, operator, binds, name):
+    """Filtro vetorizado sobre uma coluna sem dicionário (order_time, order_id)."""
+    if operator == 'between':
+        lo = _raw_value(field, binds[f"{name}_lo"])
+        hi = _raw_value(field, binds[f"{name}_hi"])
+        if lo is None or hi is None:
+            return np.zeros(len(array), dtype=bool)
+        return (array >= lo) & (array <= hi)
+    if operator in ('in', 'notin'):
+        values = [_raw_value(field, v) for v in binds[name]]
+        if operator == 'notin' and None in values:
+            return np.zeros(len(array), dtype=bool)
+        mask = np.isin(array, [v for v in values if v is not None])
+        return mask if operator == 'in' else ~mask
+    x = _raw_value(field, binds[name])
+    if x is None:
+        return np.zeros(len(array), dtype=bool)
+    if operator == 'eq':
+        return array == x
+    if operator == 'neq':
+        return array != x
+    if operator == 'gt':
+        return array > x
+    if operator == 'gte':
+        return array >= x
+    if operator == 'lt':
+        return array < x
+    return array <= x
+
+
+def _filter_masks(snapshot, query_request):
+    """(máscara por venda, máscara por linha de produto); None = sem filtro."""
+    sale_mask = line_mask = None
+    for name, field, _column, operator, binds in crud._resolved_filters(query_request):
+        if binds is None:
+            continue
+        if field in DIMENSION_FIELDS:
+            table, attr = DIMENSION_FIELDS[field]
+            d = snapshot.dictionary(table, attr)
+            keep_by_id = _dictionary_mask(d.values, d.codes, operator, binds, name, snapshot.codepoint_collation)
+            if table == "product":
+                mask = keep_by_id[snapshot.line_product]
+                line_mask = mask if line_mask is None else line_mask & mask
+                continue
+            mask = keep_by_id[snapshot.sale_dimension(table)]
+        elif field == "order_hour":
+            mask = _dictionary_mask(HOUR_VALUES, np.arange(24), operator, binds, name)[snapshot.hour]
+        elif field == "order_day_of_week":
+            mask = _dictionary_mask(
+                DAY_NAMES, np.arange(7), operator, binds, name, snapshot.codepoint_collation
+            )[snapshot.dow]
+        elif field == "order_time":
+            mask = _compare(snapshot.created_at, field, operator, binds, name)
+        elif field == "order_id":
+            mask = _compare(snapshot.sale_id, field, operator, binds, name)
+        else:
+            raise _Unsupported
+        sale_mask = mask if sale_mask is None else sale_mask & mask
+    return sale_mask, line_mask
+
+
+# =============================================================================
+# GROUP BY
+# =============================================================================
+
+def _bucket_start(grain, value: datetime) -> datetime:
+    """date_trunc(grain, value)."""
+    day = datetime(value.year, value.month, value.day)
+    if grain == "day":
+        return day
+    if grain == "week":
+        return day - timedelta(days=day.weekday())
+    return datetime(value.year, value.month, 1)
+
+
+def _bucket_value(grain, number) -> datetime:
+    """Bucket (dias ou meses desde 1970) como datetime."""
+    if grain == "month":
+        return datetime(1970 + number // 12, number % 12 + 1, 1)
+    return EPOCH + timedelta(days=number)
+
+
+def _bucket_numbers(snapshot, grain, sale_idx):
+    days = snapshot.day[sale_idx]
+    if grain == "day":
+        return days
+    if grain == "week":
+        return days - (days + 3) % 7
+    return days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+
+def _next_bucket(grain, value: datetime) -> datetime:
+    if grain == "day":
+        return value + timedelta(days=1)
+    if grain == "week":
+        return value + timedelta(days=7)
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def _key_columns(snapshot, keys, grain, sale_idx, line_idx):
+    """(códigos, valores) de cada chave do group-by, alinhados às linhas selecionadas."""
+    columns = []
+    for key in keys:
+        if key in DIMENSION_FIELDS:
+            table, attr = DIMENSION_FIELDS[key]
+            d = snapshot.dictionary(table, attr)
+            ids = snapshot.line_product[line_idx] if table == "product" else snapshot.sale_dimension(table)[sale_idx]
+            columns.append((d.codes[ids].astype(np.int64), d.values))
+        elif key == "order_hour":
+            columns.append((snapshot.hour[sale_idx].astype(np.int64), HOUR_VALUES))
+        elif key == "order_day_of_week":
+            columns.append((snapshot.dow[sale_idx].astype(np.int64), DAY_NAMES))
+        elif key == "time_bucket":
+            numbers = _bucket_numbers(snapshot, grain, sale_idx)
+            first = int(numbers.min()) if len(numbers) else 0
+            last = int(numbers.max()) if len(numbers) else 0
+            if grain == "week":
+                values = [_bucket_value(grain, n) for n in range(first, last + 1, 7)]
+                columns.append(((numbers - first) // 7, values))
+            else:
+                values = [_bucket_value(grain, n) for n in range(first, last + 1)]
+                columns.append((numbers - first, values))
+        else:
+            raise _Unsupported
+    return columns
+
+
+def _group_ids(columns, size):
+    """Chave inteira por elemento e a chave de cada grupo (denso ou via np.unique)."""
+    key = np.zeros(size, dtype=np.int64)
+    space = 1
+    for codes, values in columns:
+        card = max(len(values), 1)
+        key = key * card + codes
+        space *= card
+    if space <= DENSE_GROUP_LIMIT:
+        return key, space, None
+    uniq, gid = np.unique(key, return_inverse=True)
+    return gid, len(uniq), uniq
+
+
+def _decode(group_keys, columns):
+    """Valores das chaves de cada grupo, na ordem de `columns`."""
+    decoded = []
+    rest = group_keys
+    for codes, values in reversed(columns):
+        card = max(len(values), 1)
+        rest, code = np.divmod(rest, card)
+        decoded.append([values[c] for c in code.tolist()])
+    return decoded[::-1]
+
+
+def _first_in_run(sale_idx):
+    """True na primeira linha de cada venda (linhas de uma venda são contíguas)."""
+    first = np.ones(len(sale_idx), dtype=bool)
+    first[1:] = sale_idx[1:] != sale_idx[:-1]
+    return first
+
+
+def _distinct_sales(gid, sale_idx, n_groups, per_sale_group):
+    """order_count por grupo: número de vendas distintas com linhas no grupo."""
+    if per_sale_group:
+        # o grupo depende só da venda: basta a primeira linha de cada venda
+        first = _first_in_run(sale_idx)
+        return np.bincount(gid[first], minlength=n_groups)
+    # linhas já vêm agrupadas por venda: a ordenação estável (timsort) é quase linear
+    pairs = np.sort(sale_idx.astype(np.int64) * n_groups + gid, kind="stable")
+    return np.bincount(pairs[_first_in_run(pairs)] % n_groups, minlength=n_groups)
+
+
+def _money(value):
+    """Como `rollups.money`: float8 -> numeric (15 dígitos, igual ao Postgres) e ROUND(..., 2)."""
+    if value is None:
+        return None
+    return Decimal(format(value, ".15g")).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def _metric_row(metric_ids, revenue, orders):
+    total = _money(revenue)
+    row = {}
+    for m in metric_ids:
+        if m == "total_revenue":
+            row[m] = total
+        elif m == "order_count":
+            row[m] = orders
+        else:
+            # como `rollups.money_ratio`: receita já em centavos / pedidos
+            row[m] = (total / orders).quantize(CENTS, rounding=ROUND_HALF_UP) if orders and total is not None else None
+    return row
+
+
+# =============================================================================
+# MOTOR
+# =============================================================================
+
+class ColumnarEngine:
+    """Motor em memória; `execute` devolve None quando o SQL deve responder."""
+
+    def __init__(self):
+        self.snapshot: Optional[ColumnarSnapshot] = None
+        self.loaded_at: Optional[datetime] = None
+        self.load_time_ms: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return np is not None and self.snapshot is not None
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            "enabled": COLUMNAR_ENABLED and np is not None,
+            "ready": self.ready,
+            "sales": len(snapshot.sale_id) if snapshot is not None else 0,
+            "lines": len(snapshot.line_sale) if snapshot is not None else 0,
+            "max_sale_id": snapshot.max_sale_id if snapshot is not None else None,
+            "memory_bytes": snapshot.nbytes() if snapshot is not None else 0,
+            "loaded_at": self.loaded_at,
+            "load_time_ms": self.load_time_ms,
+        }
+
+    def execute(self, query_request, stats: Optional[dict] = None,
+                min_sale_id: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        Responde a requisição em memória; None para formatos não suportados
+        ou quando o snapshot ainda não tem as vendas até `min_sale_id` (o
+        watermark do banco usado pela API no cache de resultados).
+        """
+        snapshot = self.snapshot
+        if np is None or snapshot is None:
+            return None
+        if min_sale_id is not None and snapshot.max_sale_id < min_sale_id:
+            return None
+        try:
+            data = _execute(snapshot, query_request)
+        except _Unsupported:
+            return None
+        if stats is not None:
+            stats["engine"] = "columnar"
+            stats["accuracy"] = "exact"
+        return data
+
+    async def load(self, db_engine, full: bool = False) -> int:
+        """
+        Carrega os fatos do banco. Sem `full`, anexa só as vendas com id acima
+        do último carregado. Retorna o número de vendas lidas.
+        """
+        started = time.perf_counter()
+        current = None if full else self.snapshot
+        after = current.max_sale_id if current is not None else 0
+
+        async with db_engine.connect() as conn:
+            # vendas, linhas e dimensões do mesmo snapshot do banco
+            conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+            async with conn.begin():
+                # a carga completa lê as tabelas inteiras: sem o statement_timeout do perfil prod
+                await conn.execute(text("SET LOCAL statement_timeout = 0"))
+                sale_cols = await _fetch_columns(
+                    conn,
+                    select(sales.c.id, sales.c.created_at, sales.c.store_id, sales.c.channel_id)
+                    .where(sales.c.id > after),
+                    SALE_COLUMNS,
+                )
+                loaded = len(sale_cols["id"])
+                if current is not None and not loaded:
+                    return 0
+                line_cols = await _fetch_columns(
+                    conn,
+                    select(product_sales.c.sale_id, product_sales.c.product_id, crud.LINE_REVENUE)
+                    .where(product_sales.c.sale_id > after),
+                    LINE_COLUMNS,
+                )
+                existing = set((await conn.execute(text(
+                    "SELECT table_name, column_name FROM information_schema.columns "
+                    "WHERE table_schema = current_schema()"
+                ))).all())
+                collation = (await conn.execute(text(
+                    "SELECT datcollate FROM pg_database WHERE datname = current_database()"
+                ))).scalar()
+                dimension_rows, dimension_order = {}, {}
+                for table, dim_table in DIMENSION_TABLES.items():
+                    attrs = sorted(
+                        {attr for t, attr in DIMENSION_FIELDS.values() if t == table} | {"id"}
+                    )
+                    columns = [dim_table.c[a] for a in attrs if (dim_table.name, a) in existing]
+                    result = await conn.execute(select(*columns))
+                    dimension_rows[table] = [dict(row) for row in result.mappings().all()]
+                    for column in columns:
+                        # ordem do ORDER BY do SQL (collation do banco, NULL por último)
+                        result = await conn.execute(select(column).distinct().order_by(column))
+                        dimension_order[(table, column.name)] = result.scalars().all()
+
+        if current is not None:
+            sale_cols = {k: np.concatenate([current.sale_cols[k], v]) for k, v in sale_cols.items()}
+            line_cols = {k: np.concatenate([current.line_cols[k], v]) for k, v in line_cols.items()}
+        # montagem dos arrays fora do event loop
+        self.snapshot = await asyncio.to_thread(
+            ColumnarSnapshot, sale_cols, line_cols, dimension_rows, dimension_order, collation
+        )
+        self.loaded_at = datetime.now()
+        self.load_time_ms = round((time.perf_counter() - started) * 1000, 2)
+        return loaded
+
+
+async def _fetch_columns(conn, query, dtypes: Dict[str, str]) -> Dict[str, Any]:
+    """Executa `query` em blocos (cursor do servidor) e devolve um array por coluna."""
+    chunks = {name: [] for name in dtypes}
+    result = await conn.stream(query.execution_options(yield_per=LOAD_BATCH_SIZE))
+    async for partition in result.partitions():
+        for name, values in zip(dtypes, zip(*partition)):
+            chunks[name].append(np.array(values, dtype=dtypes[name]))
+    return {
+        name: np.concatenate(parts) if parts else np.empty(0, dtype=dtypes[name])
+        for name, parts in chunks.items()
+    }
+
+
+def _execute(snapshot, query_request) -> List[Dict[str, Any]]:
+    metric_ids, dimension_ids = crud._requested_ids(query_request)
+    if not metric_ids and not dimension_ids:
+        return []
+    if len(set(dimension_ids)) != len(dimension_ids):
+        raise _Unsupported
+    grain = crud._time_grain(query_request)
+    keys = dimension_ids + (["time_bucket"] if grain else [])
+
+    sale_mask, line_mask = _filter_masks(snapshot, query_request)
+    product_dims = [d for d in dimension_ids if DIMENSION_FIELDS.get(d, ("",))[0] == "product"]
+    by_line = line_mask is not None or bool(product_dims)
+
+    if by_line:
+        # grão de linha de produto: filtros/dimensões de produto
+        mask = line_mask
+        if sale_mask is not None:
+            mask = sale_mask[snapshot.line_sale] if mask is None else mask & sale_mask[snapshot.line_sale]
+        if mask is None:
+            # sem filtros: os próprios arrays, sem cópia
+            line_idx = slice(None)
+        else:
+            line_idx = np.flatnonzero(mask)
+        sale_idx = snapshot.line_sale[line_idx]
+        weights = snapshot.line_revenue[line_idx]
+    else:
+        # só dimensões/filtros de venda: agregados por venda (vendas sem linhas ficam de fora)
+        mask = snapshot.sale_lines > 0
+        if sale_mask is not None:
+            mask &= sale_mask
+        line_idx = None
+        sale_idx = np.flatnonzero(mask)
+        weights = snapshot.sale_revenue[sale_idx]
+
+    columns = _key_columns(snapshot, keys, grain, sale_idx, line_idx)
+    gid, n_groups, uniq = _group_ids(columns, len(sale_idx))
+    revenue = np.bincount(gid, weights=weights, minlength=n_groups)
+    counts = np.bincount(gid, minlength=n_groups)
+    if by_line and crud.SALES_GRAIN_METRICS.intersection(metric_ids):
+        orders = _distinct_sales(gid, sale_idx, n_groups, per_sale_group=not product_dims)
+    else:
+        orders = counts
+
+    groups = np.flatnonzero(counts > 0)
+    group_keys = uniq[groups] if uniq is not None else groups
+    values = _decode(group_keys, columns)
+    revenue_list, orders_list = revenue[groups].tolist(), orders[groups].tolist()
+
+    rows = []
+    for i in range(len(groups)):
+        row = _metric_row(metric_ids, revenue_list[i], orders_list[i])
+        for key, key_values in zip(keys, values):
+            row[key] = key_values[i]
+        rows.append(row)
+
+    if not keys:
+        # agregação sem GROUP BY: sempre uma linha (SUM vazio é NULL)
+        rows = rows or [_metric_row(metric_ids, None, 0)]
+    if grain:
+        rows = _gap_fill(snapshot, rows, query_request, metric_ids, dimension_ids, grain)
+    if crud._has_top_n(query_request):
+        row_groups = groups.tolist()
+        rows = _top_n(snapshot, rows, row_groups, query_request, metric_ids, dimension_ids, grain,
+                      gid, sale_idx, weights, by_line)
+    return rows
+
+
+def _sort_key(snapshot, field):
+    """Chave de ordenação de um campo: dimensões pela posição no dicionário (ordem do banco)."""
+    if field in DIMENSION_FIELDS:
+        return snapshot.dictionary(*DIMENSION_FIELDS[field]).rank.__getitem__
+    return lambda value: value
+
+
+def _gap_fill(snapshot, rows, query_request, metric_ids, dimension_ids, grain):
+    """Como `crud._gap_fill`: série completa de buckets × combinações das dimensões."""
+    lo, hi = crud._time_bounds(query_request)
+    if any(b is not None and b.tzinfo is not None for b in (lo, hi)):
+        raise _Unsupported
+    by_key = {(tuple(r[d] for d in dimension_ids), r["time_bucket"]): r for r in rows}
+    start = _bucket_start(grain, lo) if lo is not None else min((b for _k, b in by_key), default=None)
+    end = _bucket_start(grain, hi) if hi is not None else max((b for _k, b in by_key), default=None)
+    if start is None or end is None:
+        return []
+
+    sort_keys = [_sort_key(snapshot, d) for d in dimension_ids]
+    keys = sorted(
+        {k for k, _b in by_key},
+        key=lambda k: tuple((v is None, None if v is None else f(v)) for f, v in zip(sort_keys, k)),
+    )
+    if not dimension_ids:
+        keys = [()]
+    filled = []
+    bucket = start
+    while bucket <= end:
+        for k in keys:
+            row = by_key.get((k, bucket))
+            if row is None:
+                row = {m: crud.METRIC_FILL.get(m) for m in metric_ids}
+                row.update(zip(dimension_ids, k))
+                row["time_bucket"] = bucket
+            filled.append(row)
+        bucket = _next_bucket(grain, bucket)
+    return filled
+
+
+def _ordered_indexes(snapshot, rows, query_request, metric_ids, dimension_ids, grain):
+    """Índices das linhas na ordem de `crud._order_columns` (NULLS LAST, desempate pelas chaves)."""
+    keys = [*metric_ids, *dimension_ids] + (["time_bucket"] if grain else [])
+    order, used = [], set()
+    for o in getattr(query_request, "order_by", None) or []:
+        if o.field in keys and o.field not in used:
+            order.append((o.field, o.direction == "desc"))
+            used.add(o.field)
+    if not order and metric_ids:
+        order.append((metric_ids[0], True))
+        used.add(metric_ids[0])
+    order += [(k, False) for k in keys if k not in used and k not in metric_ids]
+
+    # ordenações estáveis da última chave para a primeira
+    indexes = list(range(len(rows)))
+    for field, desc in reversed(order):
+        key = _sort_key(snapshot, field)
+        present = [i for i in indexes if rows[i][field] is not None]
+        present.sort(key=lambda i: key(rows[i][field]), reverse=desc)
+        indexes = present + [i for i in indexes if rows[i][field] is None]
+    return indexes
+
+
+def _as_text(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def _top_n(snapshot, rows, row_groups, query_request, metric_ids, dimension_ids, grain,
+           gid, sale_idx, weights, by_line):
+    """Como `crud._apply_top_n`; a linha 'Outros' é reagregada a partir dos fatos."""
+    order = _ordered_indexes(snapshot, rows, query_request, metric_ids, dimension_ids, grain)
+    limit = getattr(query_request, "limit", None)
+    with_others = getattr(query_request, "others", False) and limit and metric_ids and dimension_ids and not grain
+    if not with_others:
+        ordered = [rows[i] for i in order]
+        return ordered[:limit] if limit else ordered
+
+    head = order[:limit]
+    result = [
+        {**{m: rows[i][m] for m in metric_ids}, **{d: _as_text(rows[i][d]) for d in dimension_ids}}
+        for i in head
+    ]
+    if len(order) > limit:
+        in_head = np.zeros(int(gid.max()) + 1, dtype=bool)
+        in_head[[row_groups[i] for i in head]] = True
+        tail = ~in_head[gid]
+        revenue = float(weights[tail].sum())
+        orders = int(_first_in_run(sale_idx[tail]).sum()) if by_line else int(tail.sum())
+        result.append({
+            **_metric_row(metric_ids, revenue, orders),
+            **{d: crud.OTHERS_LABEL for d in dimension_ids},
+        })
+    return result
+
+
+columnar_engine = ColumnarEngine()
+
+
+async def maintain_columnar(db_engine, refresh_seconds: float = COLUMNAR_REFRESH_SECONDS,
+                            reload_seconds: float = COLUMNAR_RELOAD_SECONDS) -> None:
+    """Carga inicial e atualização do motor colunar, usado pelo lifespan da API."""
+    last_full = None
+    while True:
+        try:
+            if last_full is None or time.monotonic() - last_full >= reload_seconds:
+                loaded = await columnar_engine.load(db_engine, full=True)
+                last_full = time.monotonic()
+                logger.info(
+                    "Motor colunar carregado: %s vendas em %s ms", loaded, columnar_engine.load_time_ms
+                )
+            else:
+                await columnar_engine.load(db_engine)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Falha ao carregar o motor colunar: %s", exc)
+        if refresh_seconds <= 0:
+            return
+        await asyncio.sleep(refresh_seconds)
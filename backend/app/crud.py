@@ -1,10 +1,23 @@
-from sqlalchemy import select, func
-from sqlalchemy.sql.sqltypes import Date, DateTime
+import os
+import random
+from sqlalchemy import and_, select, func, cast, true, literal, literal_column, tuple_, exists, union_all, bindparam, Column, type_coerce
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.sql.sqltypes import DateTime, Float, Integer, NullType, String
+from sqlalchemy.sql.selectable import CTE
+from sqlalchemy.sql.util import ClauseAdapter
 from datetime import datetime, date, time
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Dict, Any
-from . import schemas
+from time import perf_counter
+from typing import List, Dict, Any, Optional, AsyncIterator, NamedTuple, Tuple
+from . import schemas, rollups, partitions
+from .cache import statement_cache
+from .slowlog import slow_query_log
 from .models import stores, channels, products, sales, product_sales
+from .rollups import money, money_ratio
 
 # -------------------------------------------------------------
 # Comentários (PT-BR):
@@ -18,6 +31,41 @@ from .models import stores, channels, products, sales, product_sales
 # - Helpers internos (ex: _to_datetime) garantem que valores 'date-like' sejam
 #   convertidos para `datetime` antes de serem passados ao driver do banco,
 #   evitando erros de operador entre TIMESTAMP e VARCHAR.
+# - FIELD_GRAIN + select_rollup: roteador que responde a requisição a partir
+#   do menor rollup (ver `rollups.py`) cujo grão cobre métricas, dimensões e
+#   filtros pedidos; caso nenhum cubra, usa as tabelas brutas.
+# - Poda de JOINs: o caminho bruto junta apenas as tabelas de dimensão
+#   (products/channels/stores) usadas pelas colunas e filtros pedidos.
+# - Métricas de pedido (order_count, avg_order_value) são calculadas no grão
+#   de venda: uma subquery agrupa por sales.id + dimensões e a query externa
+#   usa COUNT(*) — sem COUNT(DISTINCT) sobre o JOIN expandido.
+# - Receita (total_revenue, avg_order_value) sai em NUMERIC arredondado a
+#   centavos (`rollups.money`): a soma das linhas FLOAT dá o mesmo Decimal
+#   que os rollups e o motor colunar, e empates no Top-N são empates de fato.
+# - time_grain ('day' | 'week' | 'month'): adiciona a dimensão `time_bucket`
+#   (date_trunc), ordenada e com lacunas preenchidas via generate_series.
+# - Top-N (`order_by`, `limit`, `others`): ordenação e LIMIT aplicados no
+#   banco; com `others`, um ROW_NUMBER() separa os `limit` primeiros grupos e
+#   o restante vira UMA linha 'Outros', reagregada a partir da fonte (ver
+#   `_apply_top_n`).
+# - accuracy='approximate': quando nenhum rollup cobre a requisição, lê uma
+#   amostra das vendas (TABLESAMPLE, ANALYTICS_SAMPLE_PERCENT) e escala os
+#   totais pela fração amostrada; cada venda amostrada leva todas as suas
+#   linhas, então o ticket médio é uma razão sem escala. A query devolve
+#   também o erro padrão de cada métrica (`<métrica>_stderr`), convertido em
+#   `error_bounds` nos metadados (ver `_build_sampled_query`).
+# - build_fused_query / split_fused_rows: respondem várias requisições que
+#   compartilham os mesmos filtros com UMA query GROUPING SETS (endpoint
+#   `/analytics/batch`).
+# - prepare_analytics_query: cache de statements por formato da requisição
+#   (métricas, dimensões, campos/operadores dos filtros, rota...). Valores de
+#   filtros, limites de tempo e `limit` viram bind params nomeados (IN com
+#   binds "expanding"), então a query montada é reaproveitada entre chamadas
+#   e só os parâmetros mudam; o SQL idêntico também reaproveita o cache de
+#   compilação do SQLAlchemy e os prepared statements do asyncpg.
+# - stream_query_rows / stream_query_columns: leem o resultado por um cursor
+#   do lado do servidor, em blocos (linhas ou colunas), para as respostas em
+#   streaming (ver `streaming.py`).
 # -------------------------------------------------------------
 
 # =============================================================================
@@ -26,14 +74,14 @@ from .models import stores, channels, products, sales, product_sales
 
 # MAPEAMENTO DE MÉTRICAS
 METRIC_MAP = {
-    "total_revenue": func.sum(
+    "total_revenue": money(func.sum(
         product_sales.c.base_price * product_sales.c.quantity
-    ).label("total_revenue"),
+    )).label("total_revenue"),
     "order_count": func.count(func.distinct(sales.c.id)).label("order_count"),
     # avg_order_value: soma dos itens / número de pedidos distintos (protege divisão por zero com NULLIF)
-    "avg_order_value": (
-        func.sum(product_sales.c.base_price * product_sales.c.quantity) /
-        func.nullif(func.count(func.distinct(sales.c.id)), 0)
+    "avg_order_value": money_ratio(
+        func.sum(product_sales.c.base_price * product_sales.c.quantity),
+        func.count(func.distinct(sales.c.id)),
     ).label("avg_order_value"),
 }
 
@@ -44,7 +92,7 @@ DIMENSION_MAP = {
     "channel_name": channels.c.name.label("channel_name"),
     "store_name": stores.c.name.label("store_name"),
     # sales.created_at corresponde ao horário original do pedido (order_time)
-    "order_day_of_week": func.to_char(sales.c.created_at, 'Day').label("order_day_of_week"),
+    "order_day_of_week": func.to_char(sales.c.created_at, 'Day', type_=String).label("order_day_of_week"),
     "order_hour": func.extract('hour', sales.c.created_at).label("order_hour"),
     # O esquema não inclui uma coluna 'region' em sales; mapeamos para a cidade
     # da loja quando necessário. Prefira coluna 'district' (bairro) se presente;
@@ -60,136 +108,1000 @@ DIMENSION_MAP = {
 # MAPEAMENTO DE CAMPOS FILTRÁVEIS (para a cláusula WHERE)
 FILTER_MAP = {
     **DIMENSION_MAP,  # Inclui todas as dimensões
-    # Campos de IDs e datas que podem ser úteis em filtros diretos
+    # Campos de IDs e datas que podem ser úteis em filtros diretos.
+    # Ids de loja/canal/produto filtram a FK na tabela fato (mesmo resultado
+    # pelas FKs NOT NULL): dispensa o JOIN e usa os índices compostos
+    # sales(store_id, created_at) etc. (ver app/indexes.py).
     "order_time": sales.c.created_at,
     "order_id": sales.c.id,
-    "store_id": stores.c.id,
+    "store_id": sales.c.store_id,
     "store_state": stores.c.state,
     "store_city": stores.c.city,
-    "channel_id": channels.c.id,
-    "product_id": products.c.id,
+    "channel_id": sales.c.channel_id,
+    "product_id": product_sales.c.product_id,
 }
 
 
+# MAPEAMENTO DE GRÃOS (para o roteador de rollups)
+# Para cada campo filtrável/dimensão, quais grãos um rollup precisa preservar
+# para responder de forma exata. "time" e "hour" e "sale" nunca são cobertos
+# por rollups diários, o que força o caminho bruto.
+FIELD_GRAIN = {
+    "product_name": {"product"},
+    "product_category": {"product"},
+    "channel_name": {"channel"},
+    "store_name": {"store"},
+    "order_day_of_week": {"day"},
+    "order_hour": {"hour"},
+    "region": {"store"},
+    "order_time": {"time"},
+    "order_id": {"sale"},
+    "store_id": {"store"},
+    "store_state": {"store"},
+    "store_city": {"store"},
+    "channel_id": {"channel"},
+    "product_id": {"product"},
+}
+
+# Métricas que dependem do número de pedidos: calculadas no grão de venda
+# (ver `_build_sales_grain_query`) em vez de COUNT(DISTINCT sales.id).
+SALES_GRAIN_METRICS = {"order_count", "avg_order_value"}
+
+# Receita de uma linha de produto (mesma expressão usada em total_revenue)
+LINE_REVENUE = product_sales.c.base_price * product_sales.c.quantity
+
+# GRANULARIDADES DE TEMPO (time_grain -> passo do generate_series)
+TIME_GRAIN_STEPS = {
+    "day": "1 day",
+    "week": "1 week",
+    "month": "1 month",
+}
+
+# Valor usado para preencher buckets sem vendas. Métricas aditivas viram 0;
+# razões (ticket médio) ficam NULL, pois não há pedidos para dividir.
+METRIC_FILL = {
+    "total_revenue": 0,
+    "order_count": 0,
+}
+
+# Rótulo das dimensões na linha que agrega os grupos fora do Top-N
+OTHERS_LABEL = "Outros"
+
+# MODO APROXIMADO (accuracy='approximate')
+# Percentual de vendas amostradas e método do TABLESAMPLE. BERNOULLI sorteia
+# venda a venda (erros padrão válidos); SYSTEM sorteia páginas inteiras, lê
+# menos blocos, mas vendas da mesma página (mesmo horário) vêm juntas e os
+# erros reportados ficam otimistas.
+SAMPLE_PERCENT = float(os.getenv("ANALYTICS_SAMPLE_PERCENT", "10"))
+SAMPLE_METHOD = os.getenv("ANALYTICS_SAMPLE_METHOD", "bernoulli").strip().lower()
+STDERR_SUFFIX = "_stderr"
+# z do intervalo de 95% usado em `error_bounds`
+ERROR_BOUND_Z = 1.96
+
+# Tabelas de dimensão que um rollup precisa juntar para cada grão
+_GRAIN_JOINS = {
+    "store": (stores, "store_id"),
+    "channel": (channels, "channel_id"),
+    "product": (products, "product_id"),
+}
+
+
+# =============================================================================
+# HELPERS DE FILTRO
+# =============================================================================
+
+def _to_datetime(val, end_of_day=False):
+    """
+    Tenta coerir valores de data em string para datetimes quando a coluna
+    for do tipo Date/DateTime. Isso evita enviar binds VARCHAR para uma
+    coluna timestamp (o que causa o erro "operator does not exist" observado
+    no asyncpg).
+    """
+    # Se val já for date/datetime, normaliza para datetime
+    if isinstance(val, datetime):
+        return val
+    if isinstance(val, date) and not isinstance(val, datetime):
+        # date -> datetime no começo ou fim do dia
+        if end_of_day:
+            return datetime.combine(val, time.max)
+        return datetime.combine(val, time.min)
+    if isinstance(val, str):
+        # Tenta formatos ISO: YYYY-MM-DD ou YYYY-MM-DDTHH:MM:SS
+        try:
+            # datetime.fromisoformat lida com date e datetime
+            parsed = datetime.fromisoformat(val)
+            # Se uma string só com data for retornada como date,
+            # garante que retornamos um datetime
+            if isinstance(parsed, date) and not isinstance(parsed, datetime):
+                return datetime.combine(parsed, time.max if end_of_day else time.min)
+            # No Python 3.11+ 'YYYY-MM-DD' vira datetime às 00:00; respeita end_of_day
+            if len(val.strip()) == 10:
+                return datetime.combine(parsed.date(), time.max if end_of_day else time.min)
+            return parsed
+        except Exception:
+            # Fallback: tenta parsear YYYY-MM-DD por divisão de string
+            try:
+                parts = val.split('T')[0].split(' ')[0]
+                y, m, d = [int(x) for x in parts.split('-')]
+                dt = date(y, m, d)
+                return datetime.combine(dt, time.max if end_of_day else time.min)
+            except Exception:
+                return val
+    return val
+
+
+def _bind(name, value, column, expanding=False):
+    """Bind param nomeado com o tipo da coluna (como em `column == valor`)."""
+    type_ = None if isinstance(column.type, NullType) else column.type
+    return bindparam(name, value, type_=type_, expanding=expanding)
+
+
+def _filter_binds(column, operator, value, name) -> Optional[Dict[str, Any]]:
+    """
+    Valores dos bind params de um filtro, por nome (`name`, ou `name_lo` e
+    `name_hi` para 'between'), já coeridos para a coluna. Retorna None
+    quando o filtro não se aplica (operador desconhecido ou valor inválido).
+    """
+    # Para comparações de tipo timestamp, coerir entradas string para datetime.
+    # Colunas DATE (rollups) já recebem `date` alinhado por `_day_aligned_filter`.
+    is_date_column = hasattr(column, 'type') and isinstance(column.type, DateTime)
+
+    if operator in ('eq', 'neq', 'gt', 'gte'):
+        return {name: _to_datetime(value) if is_date_column else value}
+    if operator in ('lt', 'lte'):
+        return {name: _to_datetime(value, end_of_day=True) if is_date_column else value}
+    if operator in ('in', 'notin'):
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        return {name: [_to_datetime(v) for v in values] if is_date_column else values}
+    if operator == 'between' and isinstance(value, (list, tuple)) and len(value) == 2:
+        start, end = value[0], value[1]
+        if is_date_column:
+            start, end = _to_datetime(start, end_of_day=False), _to_datetime(end, end_of_day=True)
+        return {f"{name}_lo": start, f"{name}_hi": end}
+    return None
+
+
+def _apply_filter(query, column, operator, binds, name):
+    """Aplica um único filtro (operador + binds de `_filter_binds`) à query e a devolve."""
+    if binds is None:
+        return query
+    if operator == 'between':
+        lo, hi = f"{name}_lo", f"{name}_hi"
+        return query.where(column.between(_bind(lo, binds[lo], column), _bind(hi, binds[hi], column)))
+
+    param = _bind(name, binds[name], column, expanding=operator in ('in', 'notin'))
+    if operator == 'eq':
+        return query.where(column == param)
+    if operator == 'neq':
+        return query.where(column != param)
+    if operator == 'in':
+        return query.where(column.in_(param))
+    if operator == 'notin':
+        return query.where(~column.in_(param))
+    if operator == 'gt':
+        return query.where(column > param)
+    if operator == 'lt':
+        return query.where(column < param)
+    if operator == 'gte':
+        return query.where(column >= param)
+    return query.where(column <= param)
+
+
+def _is_day_start(val) -> bool:
+    return isinstance(val, datetime) and val.tzinfo is None and val.time() == time.min
+
+
+def _is_day_end(val) -> bool:
+    return isinstance(val, datetime) and val.tzinfo is None and val.time() == time.max
+
+
+def _day_aligned_filter(f):
+    """
+    Converte um filtro em `order_time` para um filtro equivalente sobre a
+    coluna `day` (DATE) dos rollups, retornando (operador, valor).
+
+    Só é equivalente quando os limites caem exatamente em fronteiras de dia
+    (ex.: 'between' vindo do seletor de datas, já normalizado para 00:00 e
+    23:59:59.999999). Retorna None quando não há equivalência exata.
+    """
+    op, value = f.operator, f.value
+    if op == 'between' and isinstance(value, (list, tuple)) and len(value) == 2:
+        start = _to_datetime(value[0], end_of_day=False)
+        end = _to_datetime(value[1], end_of_day=True)
+        if _is_day_start(start) and _is_day_end(end):
+            return 'between', [start.date(), end.date()]
+        return None
+    if op == 'gte':
+        val = _to_datetime(value)
+        return ('gte', val.date()) if _is_day_start(val) else None
+    if op == 'gt':
+        val = _to_datetime(value)
+        return ('gt', val.date()) if _is_day_end(val) else None
+    if op == 'lte':
+        val = _to_datetime(value, end_of_day=True)
+        return ('lte', val.date()) if _is_day_end(val) else None
+    if op == 'lt':
+        val = _to_datetime(value, end_of_day=True)
+        return ('lt', val.date()) if _is_day_start(val) else None
+    return None
+
+
+def _valid_filters(query_request):
+    """Filtros com campo conhecido em FILTER_MAP (os demais são ignorados)."""
+    return [
+        f for f in getattr(query_request, "filters", []) or []
+        if hasattr(f, "field") and f.field in FILTER_MAP and FILTER_MAP[f.field] is not None
+    ]
+
+
+def _resolved_filters(query_request, rollup=None):
+    """
+    Filtros válidos resolvidos para a fonte (tabelas brutas ou `rollup`):
+    lista de (bind name, campo, coluna, operador, binds). Usada tanto para montar
+    a query quanto para extrair os parâmetros de uma query já em cache.
+    """
+    resolved = []
+    for i, f in enumerate(_valid_filters(query_request)):
+        if rollup is None:
+            column, operator, value = FILTER_MAP[f.field], f.operator, f.value
+        else:
+            column = _rollup_column(rollup, f.field)
+            if f.field == "order_time":
+                operator, value = _day_aligned_filter(f)
+            else:
+                operator, value = f.operator, f.value
+        name = f"filter_{i}"
+        resolved.append((name, f.field, column, operator, _filter_binds(column, operator, value, name)))
+    return resolved
+
+
+def _time_grain(query_request) -> Optional[str]:
+    grain = getattr(query_request, "time_grain", None)
+    return grain if grain in TIME_GRAIN_STEPS else None
+
+
+def _time_bounds(query_request):
+    """
+    Limites (início, fim) implícitos nos filtros de `order_time`, usados
+    para delimitar a série de buckets. Cada limite pode ser None.
+    """
+    lo = hi = None
+    for f in _valid_filters(query_request):
+        if f.field != "order_time":
+            continue
+        start = end = None
+        if f.operator == 'between' and isinstance(f.value, (list, tuple)) and len(f.value) == 2:
+            start, end = _to_datetime(f.value[0]), _to_datetime(f.value[1], end_of_day=True)
+        elif f.operator in ('gt', 'gte'):
+            start = _to_datetime(f.value)
+        elif f.operator in ('lt', 'lte'):
+            end = _to_datetime(f.value, end_of_day=True)
+        elif f.operator == 'eq':
+            start = end = _to_datetime(f.value)
+        if isinstance(start, datetime):
+            lo = start if lo is None else max(lo, start)
+        if isinstance(end, datetime):
+            hi = end if hi is None else min(hi, end)
+    return lo, hi
+
+
+# =============================================================================
+# ROTEADOR DE ROLLUPS
+# =============================================================================
+
+def _required_grain(query_request) -> set:
+    """Conjunto de grãos exigidos pelas dimensões e filtros da requisição."""
+    grain = set()
+    for dim in getattr(query_request, "dimensions", []) or []:
+        if dim in DIMENSION_MAP and DIMENSION_MAP[dim] is not None:
+            grain |= FIELD_GRAIN[dim]
+    for f in _valid_filters(query_request):
+        if f.field == "order_time":
+            grain |= {"day"} if _day_aligned_filter(f) is not None else {"time"}
+        else:
+            grain |= FIELD_GRAIN[f.field]
+    # buckets de dia/semana/mês podem ser derivados da coluna `day`
+    if _time_grain(query_request):
+        grain |= {"day"}
+    return grain
+
+
+def select_rollup(query_request) -> Optional[Dict[str, Any]]:
+    """
+    Escolhe o menor rollup capaz de responder a requisição de forma exata.
+
+    Retorna o item do catálogo `rollups.ROLLUPS` ou None quando os rollups
+    não estão disponíveis ou nenhum cobre o grão/métricas pedidos.
+    """
+    if not rollups.ROLLUP_STATE["available"]:
+        return None
+    metrics = [m for m in getattr(query_request, "metrics", []) or [] if m in METRIC_MAP]
+    grain = _required_grain(query_request)
+    for rollup in rollups.ROLLUPS:
+        if grain <= rollup["grain"] and all(m in rollup["metrics"] for m in metrics):
+            return rollup
+    return None
+
+
+def _rollup_column(rollup, field):
+    """Resolve um campo da API para uma coluna/expressão sobre o rollup."""
+    table = rollup["table"]
+    if field == "order_day_of_week":
+        return func.to_char(cast(table.c.day, DateTime), 'Day', type_=String).label("order_day_of_week")
+    if field == "order_time":
+        return table.c.day
+    column = FILTER_MAP[field]
+    # ids na tabela fato (store_id, channel_id, product_id): mesma coluna no rollup
+    if getattr(column, "table", None) in (sales, product_sales):
+        return table.c[column.name]
+    # demais campos apontam para stores/channels/products, juntados por id
+    return column
+
+
+# =============================================================================
+# CONSTRUÇÃO DAS QUERIES
+# =============================================================================
+
+def _time_bucket(column, grain):
+    return cast(func.date_trunc(grain, column), DateTime).label("time_bucket")
+
+
+def _tables_of(expr) -> set:
+    """Tabelas referenciadas por uma expressão SQL (para podar JOINs)."""
+    return {
+        element.table for element in visitors.iterate(expr)
+        if isinstance(element, Column) and element.table is not None
+    }
+
+
+def _raw_source_query(query_request, *columns, where=None):
+    """
+    SELECT das colunas dadas sobre o JOIN bruto, já com os filtros aplicados.
+
+    sales → product_sales é sempre mantido (todas as métricas são definidas
+    sobre as linhas de produto). products/channels/stores só entram quando
+    alguma coluna ou filtro os referencia; as FKs NOT NULL garantem que
+    omiti-los não altera o resultado. `where` é um predicado extra opcional.
+
+    Com as tabelas particionadas por mês (app/partitions.py), o JOIN também
+    iguala as chaves de partição e cada filtro de `order_time` é repetido em
+    `product_sales.sale_created_at`: o Postgres só poda as partições de uma
+    tabela a partir de predicados na chave dela.
+    """
+    partitioned = partitions.PARTITION_STATE["enabled"]
+    filters = _resolved_filters(query_request)
+    needed = set()
+    extra = [where] if where is not None else []
+    for expr in [*columns, *[column for _name, _field, column, _op, _binds in filters], *extra]:
+        needed |= _tables_of(expr)
+
+    on = sales.c.id == product_sales.c.sale_id
+    if partitioned:
+        on = and_(on, product_sales.c.sale_created_at == sales.c.created_at)
+    source = sales.join(product_sales, on)
+    if products in needed:
+        source = source.join(products, product_sales.c.product_id == products.c.id)
+    if channels in needed:
+        source = source.join(channels, sales.c.channel_id == channels.c.id)
+    if stores in needed:
+        source = source.join(stores, sales.c.store_id == stores.c.id)
+    query = select(*columns).select_from(source)
+
+    # Aplica os filtros dinamicamente e de forma segura
+    for name, field, column, operator, binds in filters:
+        query = _apply_filter(query, column, operator, binds, name)
+        if partitioned and field == "order_time":
+            # mesmos bind params: nada muda no cache de statements
+            query = _apply_filter(query, product_sales.c.sale_created_at, operator, binds, name)
+    if where is not None:
+        query = query.where(where)
+    return query
+
+
+def _build_sales_grain_query(query_request, metric_ids, dimensions, where=None):
+    """
+    Agregação em dois níveis, sem fan-out nas métricas de pedido.
+
+    A subquery agrupa por sales.id + dimensões (cada venda aparece uma vez
+    por grupo, com a soma das suas linhas); a query externa agrega por
+    dimensão com SUM/COUNT(*). O resultado é idêntico ao de
+    COUNT(DISTINCT sales.id) sobre o JOIN expandido.
+    """
+    inner = (
+        _raw_source_query(query_request, *dimensions, func.sum(LINE_REVENUE).label("sale_revenue"), where=where)
+        .group_by(sales.c.id, *dimensions)
+        .subquery("sale_grain")
+    )
+    metric_columns = {
+        "total_revenue": money(func.sum(inner.c.sale_revenue)).label("total_revenue"),
+        "order_count": func.count().label("order_count"),
+        "avg_order_value": money_ratio(func.sum(inner.c.sale_revenue), func.count()).label("avg_order_value"),
+    }
+    outer_dimensions = [inner.c[d.name] for d in dimensions]
+    # select_from explícito: só com COUNT(*) nenhuma coluna referencia a subquery
+    query = select(*[metric_columns[m] for m in metric_ids], *outer_dimensions).select_from(inner)
+    if outer_dimensions:
+        query = query.group_by(*outer_dimensions)
+    return query
+
+
+def _build_raw_query(query_request, metric_ids, dimension_ids, where=None):
+    """
+    Query sobre as tabelas brutas (sales → product_sales → dimensões).
+
+    `where`, se dado, recebe uma função que resolve ids de dimensão para
+    expressões desta fonte e devolve um predicado extra (ver `_apply_top_n`).
+    """
+    if where is not None:
+        where = where(DIMENSION_MAP.__getitem__)
+    selected_dimensions = [DIMENSION_MAP[d] for d in dimension_ids]
+    grain = _time_grain(query_request)
+    if grain:
+        selected_dimensions.append(_time_bucket(sales.c.created_at, grain))
+
+    if SALES_GRAIN_METRICS.intersection(metric_ids):
+        return _build_sales_grain_query(query_request, metric_ids, selected_dimensions, where)
+
+    selected_metrics = [METRIC_MAP[m] for m in metric_ids]
+    query = _raw_source_query(query_request, *selected_metrics, *selected_dimensions, where=where)
+
+    # Adiciona o GROUP BY se houver dimensões selecionadas
+    if selected_dimensions:
+        query = query.group_by(*selected_dimensions)
+    return query
+
+
+def _build_rollup_query(query_request, rollup, metric_ids, dimension_ids, where=None):
+    """Query equivalente sobre um rollup, juntando apenas as dimensões usadas."""
+    table = rollup["table"]
+    selected_metrics = [rollup["metrics"][m] for m in metric_ids]
+    selected_dimensions = [_rollup_column(rollup, d) for d in dimension_ids]
+    grain = _time_grain(query_request)
+    if grain:
+        selected_dimensions.append(_time_bucket(cast(table.c.day, DateTime), grain))
+
+    query = select(*selected_metrics, *selected_dimensions).select_from(table)
+    for grain in sorted(_required_grain(query_request) & set(_GRAIN_JOINS)):
+        dim_table, fk = _GRAIN_JOINS[grain]
+        query = query.join(dim_table, table.c[fk] == dim_table.c.id)
+
+    for name, _field, column, operator, binds in _resolved_filters(query_request, rollup):
+        query = _apply_filter(query, column, operator, binds, name)
+    if where is not None:
+        query = query.where(where(lambda d: _rollup_column(rollup, d)))
+
+    if selected_dimensions:
+        query = query.group_by(*selected_dimensions)
+    return query
+
+
+def _gap_fill(query, query_request, metric_ids, dimension_ids):
+    """
+    Envolve a query agregada (que já agrupa por `time_bucket`) para devolver
+    uma linha por bucket × combinação das demais dimensões, preenchendo
+    buckets vazios com METRIC_FILL e ordenando por tempo.
+
+    A série vai do início ao fim do filtro de `order_time` quando houver;
+    senão, do primeiro ao último bucket com dados.
+    """
+    grain = _time_grain(query_request)
+    agg = query.cte("agg")
+
+    lo, hi = _time_bounds(query_request)
+    start = (
+        cast(func.date_trunc(grain, bindparam("time_lo", lo, type_=DateTime)), DateTime) if lo is not None
+        else select(func.min(agg.c.time_bucket)).scalar_subquery()
+    )
+    end = (
+        cast(func.date_trunc(grain, bindparam("time_hi", hi, type_=DateTime)), DateTime) if hi is not None
+        else select(func.max(agg.c.time_bucket)).scalar_subquery()
+    )
+    step = literal_column(f"interval '{TIME_GRAIN_STEPS[grain]}'")
+    buckets = select(
+        cast(func.generate_series(start, end, step), DateTime).label("time_bucket")
+    ).cte("buckets")
+
+    # cada combinação das demais dimensões recebe a série completa de buckets
+    source = buckets
+    on = agg.c.time_bucket == buckets.c.time_bucket
+    dimension_columns = []
+    if dimension_ids:
+        keys = select(*[agg.c[d] for d in dimension_ids]).distinct().cte("keys")
+        source = buckets.join(keys, true())
+        for d in dimension_ids:
+            on = on & agg.c[d].is_not_distinct_from(keys.c[d])
+            dimension_columns.append(keys.c[d].label(d))
+
+    metric_columns = [
+        func.coalesce(agg.c[m], METRIC_FILL[m]).label(m) if m in METRIC_FILL else agg.c[m].label(m)
+        for m in metric_ids
+    ]
+    return (
+        select(*metric_columns, *dimension_columns, buckets.c.time_bucket)
+        .select_from(source.outerjoin(agg, on))
+        .order_by(buckets.c.time_bucket, *[c for c in dimension_columns])
+    )
+
+
+def _has_top_n(query_request) -> bool:
+    return bool(getattr(query_request, "order_by", None) or getattr(query_request, "limit", None))
+
+
+def _order_columns(query_request, columns, metric_ids, dimension_ids):
+    """
+    Cláusulas ORDER BY sobre `columns` (colunas do resultado agregado).
+
+    Campos de `order_by` que não estão no resultado são ignorados. Sem
+    `order_by`, ordena pela primeira métrica (desc). As chaves do grupo
+    restantes entram como desempate, deixando o Top-N determinístico.
+    """
+    keys = [*metric_ids, *dimension_ids]
+    if _time_grain(query_request):
+        keys.append("time_bucket")
+
+    order, used = [], set()
+    for o in getattr(query_request, "order_by", None) or []:
+        if o.field in keys and o.field not in used:
+            column = columns[o.field]
+            order.append(column.asc().nulls_last() if o.direction == "asc" else column.desc().nulls_last())
+            used.add(o.field)
+    if not order and metric_ids:
+        order.append(columns[metric_ids[0]].desc().nulls_last())
+        used.add(metric_ids[0])
+    order += [columns[k].asc().nulls_last() for k in keys if k not in used and k not in metric_ids]
+    return order
+
+
+def _apply_top_n(query, query_request, metric_ids, dimension_ids, build):
+    """
+    Aplica `order_by`/`limit` (e opcionalmente `others`) sobre a query agregada.
+
+    Sem `others`, é um ORDER BY + LIMIT direto. Com `others`, ROW_NUMBER()
+    ranqueia os grupos; os `limit` primeiros saem como estão e os demais
+    viram uma linha com as dimensões iguais a OTHERS_LABEL. Essa linha é
+    reagregada a partir da fonte (`build` sem dimensões, excluindo os grupos
+    do topo), e não somada a partir dos grupos: assim order_count conta cada
+    pedido uma única vez mesmo quando ele aparece em vários grupos da cauda
+    (ex.: vários produtos), e avg_order_value continua exato.
+    """
+    limit = getattr(query_request, "limit", None)
+    limit_param = bindparam("top_n_limit", limit, type_=Integer)
+    with_others = (
+        getattr(query_request, "others", False) and limit and metric_ids and dimension_ids
+        and not _time_grain(query_request)
+    )
+    if not with_others:
+        grouped = query.subquery("grouped")
+        ordered = select(*grouped.c).order_by(
+            *_order_columns(query_request, grouped.c, metric_ids, dimension_ids)
+        )
+        return ordered.limit(limit_param) if limit else ordered
+
+    grouped = query.cte("grouped")
+    ranked = select(
+        *grouped.c,
+        func.row_number().over(
+            order_by=_order_columns(query_request, grouped.c, metric_ids, dimension_ids)
+        ).label("group_rank"),
+    ).cte("ranked")
+    in_head = ranked.c.group_rank <= limit_param
+
+    def outside_head(resolve):
+        same_group = [resolve(d).is_not_distinct_from(ranked.c[d]) for d in dimension_ids]
+        return ~exists().where(in_head, *same_group)
+
+    tail = build([], outside_head).subquery("tail")
+
+    # dimensões viram texto nas duas partes para caber o rótulo 'Outros'
+    head_rows = select(
+        *[ranked.c[m] for m in metric_ids],
+        *[cast(ranked.c[d], String).label(d) for d in dimension_ids],
+        ranked.c.group_rank,
+    ).where(in_head)
+    others_row = select(
+        *[tail.c[m] for m in metric_ids],
+        *[literal(OTHERS_LABEL, String).label(d) for d in dimension_ids],
+        (limit_param + 1).label("group_rank"),
+    ).where(exists().where(ranked.c.group_rank > limit_param))
+
+    top_n = union_all(head_rows, others_row).subquery("top_n")
+    return (
+        select(*[top_n.c[k] for k in [*metric_ids, *dimension_ids]])
+        .order_by(top_n.c.group_rank)
+    )
+
+
+def _is_sampled(query_request, rollup) -> bool:
+    """Modo aproximado só quando a requisição aceita e nenhum rollup responde exato."""
+    return (
+        getattr(query_request, "accuracy", "exact") == "approximate"
+        and rollup is None
+        and 0 < SAMPLE_PERCENT < 100
+    )
+
+
+def _build_sampled_query(query_request, metric_ids, dimension_ids, where=None):
+    """
+    Como `_build_sales_grain_query`, mas sobre uma amostra de `sales`.
+
+    Estimador de Horvitz-Thompson com fração q: totais = soma amostral / q,
+    com erro padrão sqrt((1 - q) * Σy²) / q (y = receita da venda ou 1).
+    O ticket médio é a razão Σy / n, com erro padrão linearizado
+    sqrt((1 - q) * Σ(y - R)²) / n. Cada métrica ganha a coluna
+    `<métrica>_stderr`. REPEATABLE(seed) faz as várias leituras da amostra
+    numa mesma query (ex.: linha 'Outros') verem as mesmas vendas.
+    """
+    if where is not None:
+        where = where(DIMENSION_MAP.__getitem__)
+    dimensions = [DIMENSION_MAP[d] for d in dimension_ids]
+    grain = _time_grain(query_request)
+    if grain:
+        dimensions.append(_time_bucket(sales.c.created_at, grain))
+
+    percent = bindparam("sample_percent", type_=Float)
+    method = func.system if SAMPLE_METHOD == "system" else func.bernoulli
+    sample = sales.tablesample(method(percent), name="sales_sample", seed=bindparam("sample_seed", type_=Integer))
+    exact = (
+        _raw_source_query(query_request, *dimensions, func.sum(LINE_REVENUE).label("sale_revenue"), where=where)
+        .group_by(sales.c.id, *dimensions)
+    )
+    adapter = ClauseAdapter(sample)
+    if where is not None:
+        # CTEs do Top-N referenciadas pelo predicado da cauda não podem ser
+        # copiadas pela troca de tabela (viraria outro CTE com o mesmo nome)
+        adapter.__traverse_options__["stop_on"].extend(
+            {id(e): e for e in visitors.iterate(where) if isinstance(e, CTE)}.values()
+        )
+    inner = adapter.traverse(exact).subquery("sale_grain")
+
+    q = percent / 100.0
+    n = func.count()
+    total = func.sum(inner.c.sale_revenue)
+    squares = func.sum(inner.c.sale_revenue * inner.c.sale_revenue)
+    ratio = total / func.nullif(n, 0)
+    columns = {
+        "total_revenue": (total / q, func.sqrt((1 - q) * squares) / q),
+        "order_count": (cast(func.round(n / q), Integer), func.sqrt((1 - q) * n) / q),
+        "avg_order_value": (
+            ratio,
+            func.sqrt((1 - q) * func.greatest(squares - 2 * ratio * total + ratio * ratio * n, 0))
+            / func.nullif(n, 0),
+        ),
+    }
+    outer_dimensions = [inner.c[d.name] for d in dimensions]
+    query = select(
+        *[columns[m][0].label(m) for m in metric_ids],
+        *[type_coerce(columns[m][1], Float).label(m + STDERR_SUFFIX) for m in metric_ids],
+        *outer_dimensions,
+    ).select_from(inner)
+    if outer_dimensions:
+        query = query.group_by(*outer_dimensions)
+    return query
+
+
+def build_analytics_query(query_request: schemas.AnalyticsQueryRequest):
+    """
+    Monta (sem executar) a query analítica para a requisição.
+
+    Usa o menor rollup que cobre a requisição quando disponível; caso
+    contrário, as tabelas brutas. Com `time_grain`, o resultado ganha a
+    coluna `time_bucket` com a série temporal completa (ver `_gap_fill`);
+    `order_by`/`limit`/`others` são aplicados por último (ver `_apply_top_n`).
+    Com accuracy='approximate' e sem rollup, lê uma amostra (ver
+    `_build_sampled_query`). Retorna None se nada foi solicitado.
+    """
+    # Seleciona as colunas e métricas a serem retornadas
+    metric_ids = [m for m in getattr(query_request, "metrics", []) if m in METRIC_MAP]
+    # Only include dimensions that map to a valid SQL column (not None)
+    dimension_ids = [d for d in getattr(query_request, "dimensions", []) if d in DIMENSION_MAP and DIMENSION_MAP[d] is not None]
+
+    if not metric_ids and not dimension_ids:
+        return None
+
+    rollup = select_rollup(query_request)
+    sampled = _is_sampled(query_request, rollup)
+    # colunas de erro padrão seguem as métricas pelos wrappers de gap-fill e Top-N
+    output_metrics = metric_ids + [m + STDERR_SUFFIX for m in metric_ids] if sampled else metric_ids
+
+    def build(dims, where=None):
+        if rollup is not None:
+            return _build_rollup_query(query_request, rollup, metric_ids, dims, where)
+        if sampled:
+            return _build_sampled_query(query_request, metric_ids, dims, where)
+        return _build_raw_query(query_request, metric_ids, dims, where)
+
+    query = build(dimension_ids)
+    if _time_grain(query_request):
+        query = _gap_fill(query, query_request, output_metrics, dimension_ids)
+    if _has_top_n(query_request):
+        query = _apply_top_n(query, query_request, output_metrics, dimension_ids, build)
+    return query
+
+
+# =============================================================================
+# FUSÃO DE REQUISIÇÕES (GROUPING SETS)
+# =============================================================================
+
+def _requested_ids(query_request):
+    metric_ids = [m for m in getattr(query_request, "metrics", []) if m in METRIC_MAP]
+    dimension_ids = [d for d in getattr(query_request, "dimensions", []) if d in DIMENSION_MAP and DIMENSION_MAP[d] is not None]
+    return metric_ids, dimension_ids
+
+
+def is_fusable(query_request) -> bool:
+    """
+    Indica se a requisição pode participar de uma query GROUPING SETS.
+
+    Requisições com time_grain (que têm o próprio wrapper de gap-fill), com
+    Top-N (ordenação/LIMIT próprios), aproximadas (amostra própria) ou
+    atendidas por um rollup (já baratas isoladamente) rodam sozinhas.
+    """
+    metric_ids, dimension_ids = _requested_ids(query_request)
+    if (not metric_ids and not dimension_ids) or _has_top_n(query_request):
+        return False
+    if getattr(query_request, "accuracy", "exact") == "approximate":
+        return False
+    return _time_grain(query_request) is None and select_rollup(query_request) is None
+
+
+def build_fused_query(query_requests):
+    """
+    Monta UMA query sobre o JOIN bruto que responde a todas as requisições
+    dadas, que devem compartilhar os mesmos filtros.
+
+    Seleciona a união das métricas e dimensões e agrupa por GROUPING SETS
+    (um conjunto por combinação distinta de dimensões). A coluna
+    `grouping_id` (função GROUPING) identifica o conjunto de cada linha.
+    Retorna (query, dimension_ids) para uso em `split_fused_rows`.
+    """
+    metric_ids, dimension_ids, sets = [], [], []
+    for query_request in query_requests:
+        req_metrics, req_dims = _requested_ids(query_request)
+        metric_ids += [m for m in req_metrics if m not in metric_ids]
+        dimension_ids += [d for d in req_dims if d not in dimension_ids]
+        if set(req_dims) not in [set(s) for s in sets]:
+            sets.append(req_dims)
+
+    columns = [METRIC_MAP[m] for m in metric_ids] + [DIMENSION_MAP[d] for d in dimension_ids]
+    if dimension_ids:
+        columns.append(func.grouping(*[DIMENSION_MAP[d] for d in dimension_ids]).label("grouping_id"))
+
+    # os filtros são iguais em todo o grupo: usa os da primeira requisição
+    query = _raw_source_query(query_requests[0], *columns)
+    if dimension_ids:
+        query = query.group_by(func.grouping_sets(
+            *[tuple_(*[DIMENSION_MAP[d] for d in s]) for s in sets]
+        ))
+    return query, dimension_ids
+
+
+def _grouping_mask(req_dims, dimension_ids) -> int:
+    """Valor esperado de GROUPING(...) para as linhas de um conjunto."""
+    mask = 0
+    for d in dimension_ids:
+        mask = (mask << 1) | (0 if d in req_dims else 1)
+    return mask
+
+
+def split_fused_rows(rows, query_requests, dimension_ids) -> List[List[Dict[str, Any]]]:
+    """Separa as linhas da query fundida em um resultado por requisição."""
+    results = []
+    for query_request in query_requests:
+        req_metrics, req_dims = _requested_ids(query_request)
+        mask = _grouping_mask(req_dims, dimension_ids)
+        keys = req_metrics + req_dims
+        results.append([
+            {k: row[k] for k in keys}
+            for row in rows
+            if not dimension_ids or row["grouping_id"] == mask
+        ])
+    return results
+
+
+async def get_fused_analytics_data(query_requests, db: AsyncSession) -> List[List[Dict[str, Any]]]:
+    """Executa `build_fused_query` e devolve uma lista de resultados por requisição."""
+    query, dimension_ids = build_fused_query(query_requests)
+    result = await db.execute(query)
+    return split_fused_rows(result.mappings().all(), query_requests, dimension_ids)
+
+
+# =============================================================================
+# CACHE DE STATEMENTS POR FORMATO
+# =============================================================================
+
+class PreparedQuery(NamedTuple):
+    statement: Any
+    params: Dict[str, Any]
+    cache_hit: bool
+    build_time_ms: float
+    sampled: bool = False
+
+
+def _statement_shape(query_request, rollup, resolved):
+    """
+    Chave do formato da requisição: tudo o que muda o SQL gerado, sem os
+    valores que viram bind params.
+    """
+    metric_ids, dimension_ids = _requested_ids(query_request)
+    grain = _time_grain(query_request)
+    lo, hi = _time_bounds(query_request) if grain else (None, None)
+    return (
+        rollup["name"] if rollup is not None else None,
+        tuple(metric_ids),
+        tuple(dimension_ids),
+        grain,
+        lo is not None,
+        hi is not None,
+        tuple(
+            (field, operator, tuple(binds) if binds is not None else None)
+            for _name, field, _column, operator, binds in resolved
+        ),
+        tuple((o.field, o.direction) for o in getattr(query_request, "order_by", None) or []),
+        getattr(query_request, "limit", None) is not None,
+        bool(getattr(query_request, "others", False)),
+        _is_sampled(query_request, rollup),
+        partitions.PARTITION_STATE["enabled"],
+    )
+
+
+def _statement_params(query_request, resolved, sampled=False) -> Dict[str, Any]:
+    """Valores dos bind params nomeados usados pelo builder para esta requisição."""
+    params = {}
+    for _name, _field, _column, _operator, binds in resolved:
+        if binds is not None:
+            params.update(binds)
+    if _time_grain(query_request):
+        lo, hi = _time_bounds(query_request)
+        if lo is not None:
+            params["time_lo"] = lo
+        if hi is not None:
+            params["time_hi"] = hi
+    if getattr(query_request, "limit", None) is not None:
+        params["top_n_limit"] = query_request.limit
+    if sampled:
+        params["sample_percent"] = SAMPLE_PERCENT
+        # nova amostra a cada execução (o cache de resultados guarda a primeira)
+        params["sample_seed"] = random.randrange(2 ** 31)
+    return params
+
+
+def prepare_analytics_query(query_request) -> PreparedQuery:
+    """
+    Statement para a requisição (do cache de formatos, ou montado no miss)
+    e os parâmetros a executar com ele. `statement` é None se nada foi pedido.
+    """
+    started = perf_counter()
+    rollup = select_rollup(query_request)
+    resolved = _resolved_filters(query_request, rollup)
+    sampled = _is_sampled(query_request, rollup)
+    statement, hit = statement_cache.get_or_build(
+        _statement_shape(query_request, rollup, resolved),
+        lambda: build_analytics_query(query_request),
+    )
+    params = _statement_params(query_request, resolved, sampled) if statement is not None else {}
+    build_time_ms = round((perf_counter() - started) * 1000, 3)
+    return PreparedQuery(statement, params, hit, build_time_ms, sampled and statement is not None)
+
+
+def compiled_sql(statement, params: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    SQL do statement (dialeto PostgreSQL, placeholders nomeados) e os valores
+    dos binds, com as listas de IN expandidas (um placeholder por valor).
+    """
+    expanded = statement.compile(dialect=postgresql.dialect()).construct_expanded_state(params)
+    return expanded.statement, expanded.parameters
+
+
+class Explain(Executable, ClauseElement):
+    """
+    `EXPLAIN (<opções>) <statement>` executável com os mesmos bind params do
+    statement (literais embutidos perderiam os tipos: ex. date_trunc ambíguo).
+    """
+    inherit_cache = False
+
+    def __init__(self, statement, options: str = "FORMAT JSON"):
+        self.statement = statement
+        self.options = options
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return f"EXPLAIN ({element.options}) " + compiler.process(element.statement, **kw)
+
+
+def pop_error_bounds(rows: List[Dict[str, Any]], metric_ids) -> Dict[str, Optional[float]]:
+    """
+    Remove as colunas `<métrica>_stderr` das linhas e devolve, por métrica, a
+    meia-largura relativa do intervalo de 95% na pior linha (ex.: 0.05 = ±5%).
+    None quando nenhuma linha tem estimativa não nula.
+    """
+    bounds: Dict[str, Optional[float]] = {m: None for m in metric_ids}
+    for row in rows:
+        for m in metric_ids:
+            stderr = row.pop(m + STDERR_SUFFIX, None)
+            value = row.get(m)
+            if stderr is None or not value:
+                continue
+            relative = ERROR_BOUND_Z * float(stderr) / abs(float(value))
+            bounds[m] = relative if bounds[m] is None else max(bounds[m], relative)
+    return {m: round(b, 4) if b is not None else None for m, b in bounds.items()}
+
+
 # =============================================================================
 # FUNÇÃO PRINCIPAL DO CONSTRUTOR DE QUERIES (UNIFICADA)
 # =============================================================================
 
 async def get_analytics_data(
-    query_request: schemas.AnalyticsQueryRequest, db: AsyncSession
+    query_request: schemas.AnalyticsQueryRequest, db: AsyncSession, stats: Optional[dict] = None
 ) -> List[Dict[str, Any]]:
     """
     Constrói e executa uma query analítica dinâmica com base na requisição.
 
-    Essa implementação é a fusão das duas versões previamente presentes no
-    arquivo. Suporta seleção dinâmica de métricas/dimensões, filtros
-    (incluindo 'between'), joins necessários e agrupamento quando houver
-    dimensões.
+    Suporta seleção dinâmica de métricas/dimensões, filtros (incluindo
+    'between'), joins necessários e agrupamento quando houver dimensões.
+    A query é respondida por um rollup quando possível (ver `select_rollup`)
+    e reaproveitada do cache de formatos (ver `prepare_analytics_query`).
+    Cada execução é registrada no log de consultas lentas (`slowlog.py`).
+    Se `stats` for dado, recebe `engine`, `statement_cache_hit`,
+    `build_time_ms`, `execute_time_ms`, `fetch_time_ms` e `accuracy` (com
+    `sample_percent`/`error_bounds` no modo aproximado).
     """
-    # Seleciona as colunas e métricas a serem retornadas
-    selected_metrics = [METRIC_MAP[metric] for metric in getattr(query_request, "metrics", []) if metric in METRIC_MAP]
-    # Only include dimensions that map to a valid SQL column (not None)
-    selected_dimensions = [DIMENSION_MAP[dim] for dim in getattr(query_request, "dimensions", []) if dim in DIMENSION_MAP and DIMENSION_MAP[dim] is not None]
+    prepared = prepare_analytics_query(query_request)
+    if stats is not None:
+        stats["engine"] = "sql"
+        stats["statement_cache_hit"] = prepared.cache_hit
+        stats["build_time_ms"] = prepared.build_time_ms
+        stats["accuracy"] = "approximate" if prepared.sampled else "exact"
 
     # Se nada for solicitado, retorna lista vazia (JSON-friendly)
-    if not selected_metrics and not selected_dimensions:
+    if prepared.statement is None:
         return []
 
-    # Define a base da query com todos os JOINs necessários
-    # Build query joining sales -> product_sales -> products and sales -> channels/stores
-    base_query = (
-        select(*selected_metrics, *selected_dimensions)
-        .select_from(sales)
-        .join(product_sales, sales.c.id == product_sales.c.sale_id)
-        .join(products, product_sales.c.product_id == products.c.id)
-        .join(channels, sales.c.channel_id == channels.c.id)
-        .join(stores, sales.c.store_id == stores.c.id)
-    )
+    # Executa a query no banco de dados (o asyncpg já traz todas as linhas aqui)
+    started = perf_counter()
+    try:
+        result = await db.execute(prepared.statement, prepared.params)
+        executed = perf_counter()
 
-    # Aplica os filtros dinamicamente e de forma segura
-    for f in getattr(query_request, "filters", []) or []:
-        if not hasattr(f, "field"):
-            continue
-    # resolve a coluna a partir do mapa de filtros
-        if f.field in FILTER_MAP and FILTER_MAP[f.field] is not None:
-            column = FILTER_MAP[f.field]
-            # Helper: tentar coerir valores de data em string para datetimes
-            # quando a coluna for do tipo Date/DateTime. Isso evita enviar binds
-            # VARCHAR para uma coluna timestamp (o que causa o erro
-            # "operator does not exist" observado no asyncpg).
-            def _to_datetime(val, end_of_day=False):
-                # Se val já for date/datetime, normaliza para datetime
-                if isinstance(val, datetime):
-                    return val
-                if isinstance(val, date) and not isinstance(val, datetime):
-                    # date -> datetime no começo ou fim do dia
-                    if end_of_day:
-                        return datetime.combine(val, time.max)
-                    return datetime.combine(val, time.min)
-                if isinstance(val, str):
-                    # Tenta formatos ISO: YYYY-MM-DD ou YYYY-MM-DDTHH:MM:SS
-                    try:
-                        # datetime.fromisoformat lida com date e datetime
-                        parsed = datetime.fromisoformat(val)
-                        # Se uma string só com data for retornada como date,
-                        # garante que retornamos um datetime
-                        if isinstance(parsed, date) and not isinstance(parsed, datetime):
-                            return datetime.combine(parsed, time.max if end_of_day else time.min)
-                        return parsed
-                    except Exception:
-                        # Fallback: tenta parsear YYYY-MM-DD por divisão de string
-                        try:
-                            parts = val.split('T')[0].split(' ')[0]
-                            y, m, d = [int(x) for x in parts.split('-')]
-                            dt = date(y, m, d)
-                            return datetime.combine(dt, time.max if end_of_day else time.min)
-                        except Exception:
-                            return val
-                return val
+        # Converte o resultado em uma lista de dicionários (formato JSON-friendly)
+        data = [dict(row) for row in result.mappings().all()]
+    finally:
+        # inclusive execuções que falharam (ex.: statement_timeout)
+        slow_query_log.record(
+            query_request,
+            prepared.build_time_ms + (perf_counter() - started) * 1000,
+            lambda: compiled_sql(prepared.statement, prepared.params),
+        )
+    if stats is not None:
+        stats["execute_time_ms"] = round((executed - started) * 1000, 3)
+        stats["fetch_time_ms"] = round((perf_counter() - executed) * 1000, 3)
+    if prepared.sampled:
+        bounds = pop_error_bounds(data, _requested_ids(query_request)[0])
+        if stats is not None:
+            stats["sample_percent"] = SAMPLE_PERCENT
+            stats["error_bounds"] = bounds
+    return data
 
-            # Para comparações de tipo date, coerir entradas string para datetime
-            is_date_column = hasattr(column, 'type') and isinstance(column.type, (Date, DateTime))
-
-            if f.operator == 'eq':
-                val = _to_datetime(f.value) if is_date_column else f.value
-                base_query = base_query.where(column == val)
-            elif f.operator == 'neq':
-                val = _to_datetime(f.value) if is_date_column else f.value
-                base_query = base_query.where(column != val)
-            elif f.operator == 'in':
-                vals = [_to_datetime(v) for v in f.value] if is_date_column else f.value
-                base_query = base_query.where(column.in_(vals))
-            elif f.operator == 'notin':
-                vals = [_to_datetime(v) for v in f.value] if is_date_column else f.value
-                base_query = base_query.where(~column.in_(vals))
-            elif f.operator == 'gt':
-                val = _to_datetime(f.value) if is_date_column else f.value
-                base_query = base_query.where(column > val)
-            elif f.operator == 'lt':
-                val = _to_datetime(f.value, end_of_day=True) if is_date_column else f.value
-                base_query = base_query.where(column < val)
-            elif f.operator == 'gte':
-                val = _to_datetime(f.value) if is_date_column else f.value
-                base_query = base_query.where(column >= val)
-            elif f.operator == 'lte':
-                val = _to_datetime(f.value, end_of_day=True) if is_date_column else f.value
-                base_query = base_query.where(column <= val)
-            elif f.operator == 'between' and isinstance(f.value, (list, tuple)) and len(f.value) == 2:
-                start, end = f.value[0], f.value[1]
-                if is_date_column:
-                    start_dt = _to_datetime(start, end_of_day=False)
-                    end_dt = _to_datetime(end, end_of_day=True)
-                    base_query = base_query.where(column.between(start_dt, end_dt))
-                else:
-                    base_query = base_query.where(column.between(start, end))
 
-    # Adiciona o GROUP BY se houver dimensões selecionadas
-    if selected_dimensions:
-        base_query = base_query.group_by(*selected_dimensions)
+async def stream_query_rows(
+    query, db: AsyncSession, batch_size: int, params: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Executa a query com cursor do lado do servidor (`stream` + `yield_per`)
+    e produz blocos de até `batch_size` linhas, sem materializar o resultado.
+    """
+    result = await db.stream(query.execution_options(yield_per=batch_size), params)
+    async for partition in result.mappings().partitions():
+        yield [dict(row) for row in partition]
 
-    # Executa a query no banco de dados
-    result = await db.execute(base_query)
 
-    # Converte o resultado em uma lista de dicionários (formato JSON-friendly)
-    data = [dict(row) for row in result.mappings().all()]
-    return data
\ No newline at end of file
+async def stream_query_columns(
+    query, db: AsyncSession, batch_size: int, params: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[List[tuple]]:
+    """
+    Como `stream_query_rows`, mas cada bloco vem transposto em colunas (uma
+    tupla de valores por coluna selecionada), sem montar um dict por linha.
+    """
+    result = await db.stream(query.execution_options(yield_per=batch_size), params)
+    async for partition in result.partitions():
+        yield list(zip(*partition))
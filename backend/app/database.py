@@ -1,6 +1,12 @@
 import os
+from time import perf_counter
 from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from . import metrics
 
 # Carrega as variáveis de ambiente do arquivo.env
 load_dotenv()
@@ -19,13 +25,174 @@ else:
 if not DATABASE_URL:
     raise ValueError("A variável de ambiente DATABASE_URL não foi definida no arquivo .env ou está vazia")
 
-# Cria o "engine" assíncrono do SQLAlchemy.
-# echo=True é útil para desenvolvimento, pois imprime as queries SQL executadas.
+# =============================================================================
+# PERFIL DO ENGINE (pool, timeouts e logging de SQL)
+# =============================================================================
+# DB_PROFILE escolhe um preset; cada opção pode ser sobrescrita por uma
+# variável de ambiente própria (ver ENGINE_ENV e `.env.example`).
+# - dev: echo=True (imprime as queries SQL executadas), pool pequeno, sem
+#   statement_timeout.
+# - prod: sem echo, pool maior com pre-ping/recycle (conexões derrubadas
+#   por proxies/failover são descartadas) e statement_timeout por sessão,
+#   para que uma query patológica não prenda uma conexão indefinidamente.
+
+ENGINE_PROFILES = {
+    "dev": {
+        "echo": True,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_pre_ping": False,
+        "pool_recycle": -1,
+        "prepared_statement_cache_size": 100,
+        "statement_timeout_ms": 0,
+        "application_name": "nola-analytics-dev",
+    },
+    "prod": {
+        "echo": False,
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        "prepared_statement_cache_size": 500,
+        "statement_timeout_ms": 30000,
+        "application_name": "nola-analytics",
+    },
+}
+
+# opção do perfil -> variável de ambiente que a sobrescreve
+ENGINE_ENV = {
+    "echo": "DB_ECHO",
+    "pool_size": "DB_POOL_SIZE",
+    "max_overflow": "DB_MAX_OVERFLOW",
+    "pool_timeout": "DB_POOL_TIMEOUT",
+    "pool_pre_ping": "DB_POOL_PRE_PING",
+    "pool_recycle": "DB_POOL_RECYCLE",
+    "prepared_statement_cache_size": "DB_PREPARED_STATEMENT_CACHE_SIZE",
+    "statement_timeout_ms": "DB_STATEMENT_TIMEOUT_MS",
+    "application_name": "DB_APPLICATION_NAME",
+}
+
+
+def _parse_setting(raw: str, default):
+    """Converte o valor da variável de ambiente para o tipo do valor do preset."""
+    if isinstance(default, bool):
+        return raw.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(raw)
+    return raw
+
+
+def engine_settings(profile: str = None, environ=os.environ) -> dict:
+    """Preset do perfil (DB_PROFILE, padrão 'dev') com os overrides do ambiente."""
+    profile = (profile or environ.get("DB_PROFILE") or "dev").strip().lower()
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"DB_PROFILE inválido: {profile!r} (use {', '.join(ENGINE_PROFILES)})")
+    settings = dict(ENGINE_PROFILES[profile], profile=profile)
+    for key, env_name in ENGINE_ENV.items():
+        raw = environ.get(env_name)
+        if raw is not None and raw.strip() != "":
+            settings[key] = _parse_setting(raw, ENGINE_PROFILES[profile][key])
+    return settings
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Pool padrão do engine assíncrono que mede a espera por uma conexão (ver `metrics.POOL_WAIT`)."""
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            POOL_COUNTERS["timeouts"] += 1
+            raise
+        finally:
+            metrics.POOL_WAIT.observe(perf_counter() - started)
+
+
+def engine_kwargs(url: str, settings: dict) -> dict:
+    """Argumentos de `create_async_engine` para as configurações dadas."""
+    kwargs = {"echo": settings["echo"]}
+    if url.startswith("sqlite"):
+        # SQLite (apenas desenvolvimento) não usa as opções de pool/servidor
+        return kwargs
+    kwargs.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_timeout=settings["pool_timeout"],
+        pool_pre_ping=settings["pool_pre_ping"],
+        pool_recycle=settings["pool_recycle"],
+    )
+    if url.startswith("postgresql+asyncpg"):
+        server_settings = {"application_name": settings["application_name"]}
+        if settings["statement_timeout_ms"] > 0:
+            # aplicado a cada conexão (sessão) aberta pelo pool
+            server_settings["statement_timeout"] = str(settings["statement_timeout_ms"])
+        kwargs["connect_args"] = {
+            "prepared_statement_cache_size": settings["prepared_statement_cache_size"],
+            "server_settings": server_settings,
+        }
+    return kwargs
+
+
+ENGINE_SETTINGS = engine_settings()
+
+# Cria o "engine" assíncrono do SQLAlchemy com o perfil escolhido.
 engine = create_async_engine(
     DATABASE_URL,
-    echo=True,
+    **engine_kwargs(DATABASE_URL, ENGINE_SETTINGS),
 )
 
+
+# =============================================================================
+# ESTATÍSTICAS DO POOL
+# =============================================================================
+# Contadores atualizados pelos eventos de checkout/checkin do pool (custo de
+# um incremento por conexão emprestada). `exhausted_checkouts` conta os
+# empréstimos que ocuparam a última conexão disponível: a partir daí novas
+# requisições ficam na fila até `pool_timeout` (`timeouts` conta as que
+# desistiram). O tempo de espera vai para o histograma `metrics.POOL_WAIT`.
+
+POOL_COUNTERS = {"checkouts": 0, "peak_checked_out": 0, "exhausted_checkouts": 0, "timeouts": 0}
+
+
+def _pool_capacity(pool):
+    if not hasattr(pool, "size"):
+        return None
+    return pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _on_checkout(_dbapi_conn, _record, _proxy):
+    pool = engine.sync_engine.pool
+    checked_out = pool.checkedout() if hasattr(pool, "checkedout") else 0
+    POOL_COUNTERS["checkouts"] += 1
+    POOL_COUNTERS["peak_checked_out"] = max(POOL_COUNTERS["peak_checked_out"], checked_out)
+    capacity = _pool_capacity(pool)
+    if capacity is not None and checked_out >= capacity:
+        POOL_COUNTERS["exhausted_checkouts"] += 1
+
+
+def pool_stats() -> dict:
+    """Ocupação atual do pool e contadores acumulados desde o startup."""
+    pool = engine.sync_engine.pool
+    stats = {"profile": ENGINE_SETTINGS["profile"], "pool": type(pool).__name__, **POOL_COUNTERS}
+    capacity = _pool_capacity(pool)
+    if capacity is not None:
+        checked_out = pool.checkedout()
+        stats.update(
+            size=pool.size(),
+            max_overflow=capacity - pool.size(),
+            capacity=capacity,
+            checked_in=pool.checkedin(),
+            checked_out=checked_out,
+            overflow=max(pool.overflow(), 0),
+            saturation=round(checked_out / capacity, 4) if capacity else None,
+        )
+    return stats
+
 # Cria uma fábrica de sessões assíncronas.
 # `expire_on_commit=False` é importante para o padrão do FastAPI.
 AsyncSessionFactory = async_sessionmaker(
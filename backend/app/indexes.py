@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import json
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from sqlalchemy import text, select, func
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.schema import Column
+
+from . import crud, schemas
+from .models import sales, product_sales
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Gerência dos índices usados pelo caminho bruto de `/analytics`.
+# - O conjunto de índices é DERIVADO da camada semântica de crud.py
+#   (FILTER_MAP/DIMENSION_MAP), e não mantido à mão: cada coluna
+#   referenciada por um campo da API vira um índice na tabela fato.
+#   * sales.created_at (order_time, dia da semana, hora, time_grain): BRIN.
+#     As vendas são gravadas em ordem cronológica, então um BRIN de poucos
+#     KB delimita intervalos de datas tão bem quanto um B-tree de MBs.
+#   * FKs da tabela fato (store_id, channel_id, product_id) e atributos das
+#     dimensões (store_state, channel_name, product_name, ...): B-tree na
+#     FK seguida da coluna que delimita a busca (created_at em sales,
+#     sale_id em product_sales), ex.: sales(store_id, created_at).
+#   * JOIN sales → product_sales (presente em toda query): B-tree em
+#     product_sales(sale_id) com INCLUDE das colunas das métricas, para
+#     index-only scans sem visitar o heap.
+# - `apply` cria os que faltam com CREATE INDEX CONCURRENTLY (sem bloquear
+#   escritas); índices inválidos deixados por uma criação interrompida são
+#   removidos e recriados. Em tabelas particionadas (app/partitions.py) o
+#   índice é criado partição a partição e anexado ao do pai.
+# - `verify` roda EXPLAIN sobre uma carga canônica de requisições e mostra
+#   quais índices cada plano usa; `report` lista índices nunca usados
+#   (pg_stat_user_indexes.idx_scan = 0) desde o último reset das estatísticas
+#   e os redundantes (prefixo de outro índice). Nada é removido automaticamente.
+# - CLI: `python -m app.indexes status|apply|verify|report`.
+# -------------------------------------------------------------
+
+# tabelas fato e a coluna que segue a FK nos índices compostos
+FACT_RANGE_COLUMN = {
+    "sales": "created_at",
+    "product_sales": "sale_id",
+}
+
+
+class IndexSpec(NamedTuple):
+    name: str
+    table: str
+    columns: Tuple[str, ...]
+    method: str = "btree"
+    include: Tuple[str, ...] = ()
+    fields: Tuple[str, ...] = ()
+
+    def ddl(self, concurrently: bool = True, only: bool = False) -> str:
+        """CREATE INDEX; `only` cria só o índice da tabela particionada (ON ONLY)."""
+        include = f" INCLUDE ({', '.join(self.include)})" if self.include else ""
+        return (
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {self.name} "
+            f"ON {'ONLY ' if only else ''}{self.table} USING {self.method} ({', '.join(self.columns)}){include}"
+        )
+
+
+def _columns_of(expr) -> List[Column]:
+    """Colunas de tabela referenciadas por uma expressão, na ordem em que aparecem."""
+    seen = {}
+    for element in visitors.iterate(expr):
+        if isinstance(element, Column) and element.table is not None:
+            seen.setdefault((element.table.name, element.name), element)
+    return list(seen.values())
+
+
+def _spec(table: str, columns, method="btree", include=(), fields=()) -> IndexSpec:
+    suffix = "_brin" if method == "brin" else ("_cover" if include else "")
+    name = f"idx_{table}_{'_'.join(columns)}{suffix}"
+    return IndexSpec(name, table, tuple(columns), method, tuple(include), tuple(fields))
+
+
+def _fact_foreign_keys(dimension_table):
+    """FKs das tabelas fato que apontam para `dimension_table`."""
+    return [
+        fk.parent for fact in (sales, product_sales) for fk in fact.foreign_keys
+        if fk.column.table is dimension_table
+    ]
+
+
+def required_indexes() -> List[IndexSpec]:
+    """
+    Índices que o caminho bruto precisa, derivados de FILTER_MAP/DIMENSION_MAP.
+    Cada índice lista em `fields` os campos da API que o motivam.
+    """
+    by_key: Dict[Tuple, IndexSpec] = {}
+
+    def add(spec: IndexSpec, field: str):
+        key = (spec.table, spec.method, spec.columns, spec.include)
+        current = by_key.setdefault(key, spec)
+        if field not in current.fields:
+            by_key[key] = current._replace(fields=current.fields + (field,))
+
+    for field, expr in {**crud.DIMENSION_MAP, **crud.FILTER_MAP}.items():
+        for column in _columns_of(expr):
+            if column.primary_key and column.table.name in FACT_RANGE_COLUMN:
+                continue  # ex.: order_id -> sales_pkey
+            if column is sales.c.created_at:
+                add(_spec("sales", ["created_at"], method="brin"), field)
+                continue
+            # coluna da própria tabela fato (FK) ou atributo de uma dimensão
+            fks = [column] if column.table.name in FACT_RANGE_COLUMN else _fact_foreign_keys(column.table)
+            for fk in fks:
+                fact = fk.table.name
+                add(_spec(fact, [fk.name, FACT_RANGE_COLUMN[fact]]), field)
+
+    # JOIN sales -> product_sales, coberto com as colunas das métricas
+    join_fk = _fact_foreign_keys(sales)[0]
+    include = [c.name for c in _columns_of(crud.LINE_REVENUE)]
+    for fk in product_sales.foreign_keys:
+        if fk.parent is not join_fk:
+            include.insert(0, fk.parent.name)
+    add(_spec("product_sales", [join_fk.name], include=include), "metrics")
+
+    return list(by_key.values())
+
+
+# =============================================================================
+# ÍNDICES EXISTENTES
+# =============================================================================
+
+EXISTING_SQL = """
+    SELECT i.relname AS name, t.relname AS "table", am.amname AS method,
+           ARRAY(SELECT pg_get_indexdef(ix.indexrelid, k, true)
+                 FROM generate_series(1, ix.indnkeyatts) k) AS columns,
+           ARRAY(SELECT pg_get_indexdef(ix.indexrelid, k, true)
+                 FROM generate_series(ix.indnkeyatts + 1, ix.indnatts) k) AS include,
+           ix.indisvalid AS valid,
+           ix.indisunique AS is_unique,
+           ix.indpred IS NOT NULL AS partial,
+           EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid) AS is_constraint,
+           coalesce(s.idx_scan, parts.idx_scan, 0) AS scans,
+           coalesce(parts.size, pg_relation_size(ix.indexrelid)) AS size_bytes
+    FROM pg_index ix
+    JOIN pg_class i ON i.oid = ix.indexrelid
+    JOIN pg_class t ON t.oid = ix.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_am am ON am.oid = i.relam
+    -- índice de tabela particionada: scans e tamanho somados das partições
+    LEFT JOIN LATERAL (
+        SELECT sum(ps.idx_scan) AS idx_scan, sum(pg_relation_size(ps.indexrelid)) AS size
+        FROM pg_inherits inh JOIN pg_stat_user_indexes ps ON ps.indexrelid = inh.inhrelid
+        WHERE inh.inhparent = ix.indexrelid
+    ) parts ON i.relkind = 'I'
+    LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = ix.indexrelid
+    WHERE n.nspname = current_schema() AND NOT i.relispartition
+    ORDER BY t.relname, i.relname
+"""
+
+
+async def existing_indexes(conn: AsyncConnection) -> List[Dict[str, Any]]:
+    rows = (await conn.execute(text(EXISTING_SQL))).mappings().all()
+    return [{**row, "columns": tuple(row["columns"]), "include": tuple(row["include"])} for row in rows]
+
+
+def _matches(spec: IndexSpec, index: Dict[str, Any]) -> bool:
+    return (
+        index["table"] == spec.table and index["method"] == spec.method
+        and index["columns"] == spec.columns and sorted(index["include"]) == sorted(spec.include)
+        and not index["partial"]
+    )
+
+
+def index_status(specs: List[IndexSpec], existing: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Situação de cada índice necessário: 'present' (um índice válido com a
+    mesma definição existe, com qualquer nome), 'invalid' (criação
+    interrompida), 'conflict' (o nome já é usado por outra definição) ou
+    'missing'.
+    """
+    result = []
+    for spec in specs:
+        match = next((ix for ix in existing if _matches(spec, ix) and ix["valid"]), None)
+        named = next((ix for ix in existing if ix["name"] == spec.name), None)
+        if match is not None:
+            status, name = "present", match["name"]
+        elif named is not None and not named["valid"]:
+            status, name = "invalid", spec.name
+        elif named is not None:
+            status, name = "conflict", spec.name
+        else:
+            status, name = "missing", spec.name
+        result.append({"spec": spec, "status": status, "index": name})
+    return result
+
+
+PARTITIONS_SQL = """
+    SELECT c.relname AS partition,
+           (SELECT ci.relname FROM pg_inherits ii
+            JOIN pg_class ci ON ci.oid = ii.inhrelid
+            JOIN pg_index x ON x.indexrelid = ci.oid
+            WHERE ii.inhparent = to_regclass(:index) AND x.indrelid = c.oid) AS attached
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(:table)
+    ORDER BY c.relname
+"""
+
+
+async def _apply_partitioned(conn: AsyncConnection, spec: IndexSpec, existing, log) -> None:
+    """
+    Tabela particionada não aceita CREATE INDEX CONCURRENTLY: cria o índice
+    só no pai (ON ONLY, inválido até receber todas as partições), cada
+    partição CONCURRENTLY e anexa. Partições criadas depois herdam o índice.
+    """
+    await conn.execute(text(spec.ddl(concurrently=False, only=True)))
+    rows = (await conn.execute(text(PARTITIONS_SQL), {"index": spec.name, "table": spec.table})).mappings().all()
+    invalid = {ix["name"] for ix in existing if not ix["valid"]}
+    for row in rows:
+        if row["attached"] is not None:
+            continue
+        part = spec._replace(name=f"{spec.name}_{row['partition']}", table=row["partition"])
+        if part.name in invalid:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {part.name}"))
+        await conn.execute(text(part.ddl()))
+        await conn.execute(text(f"ALTER INDEX {spec.name} ATTACH PARTITION {part.name}"))
+        log(f"  ✓ {part.name}")
+
+
+async def apply_indexes(conn: AsyncConnection, log=print) -> List[str]:
+    """
+    Cria os índices ausentes com CREATE INDEX CONCURRENTLY e roda ANALYZE
+    nas tabelas alteradas. `conn` precisa estar em AUTOCOMMIT (CONCURRENTLY
+    não roda dentro de transação). Retorna os nomes criados.
+    """
+    # a criação de um índice em tabela grande passa do statement_timeout do perfil prod
+    await conn.execute(text("SET statement_timeout = 0"))
+    partitioned = set((await conn.execute(text(
+        "SELECT partrelid::regclass::text FROM pg_partitioned_table"
+    ))).scalars())
+    existing = await existing_indexes(conn)
+    created, tables = [], set()
+    for item in index_status(required_indexes(), existing):
+        spec, status = item["spec"], item["status"]
+        if status == "present":
+            continue
+        if status == "conflict":
+            log(f"! {spec.name}: nome já usado por outra definição; ignorado")
+            continue
+        started = time.perf_counter()
+        if spec.table in partitioned:
+            await _apply_partitioned(conn, spec, existing, log)
+        else:
+            if status == "invalid":
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {spec.name}"))
+            await conn.execute(text(spec.ddl()))
+        log(f"✓ {spec.name} ({time.perf_counter() - started:.1f}s)")
+        created.append(spec.name)
+        tables.add(spec.table)
+    for table in sorted(tables):
+        await conn.execute(text(f"ANALYZE {table}"))
+    return created
+
+
+# =============================================================================
+# VERIFICAÇÃO (EXPLAIN) E RELATÓRIO
+# =============================================================================
+
+def canonical_workload(last_day) -> List[schemas.AnalyticsQueryRequest]:
+    """
+    Requisições típicas dos dashboards, em janelas terminando em `last_day`
+    (último dia com vendas). Incluem dimensões/filtros que os rollups não
+    cobrem (hora, produto × loja), que exercitam o caminho bruto.
+    """
+    week = [str(last_day - timedelta(days=6)), str(last_day)]
+    month = [str(last_day - timedelta(days=29)), str(last_day)]
+    bodies = [
+        {"metrics": ["total_revenue", "order_count"], "dimensions": ["order_hour"],
+         "filters": [{"field": "order_time", "operator": "between", "value": week}]},
+        {"metrics": ["total_revenue"], "dimensions": ["store_name"], "time_grain": "day",
+         "filters": [{"field": "order_time", "operator": "between", "value": week},
+                     {"field": "store_id", "operator": "in", "value": [1, 2, 3]}]},
+        {"metrics": ["order_count", "avg_order_value"], "dimensions": ["order_hour"],
+         "filters": [{"field": "order_time", "operator": "between", "value": month},
+                     {"field": "channel_id", "operator": "eq", "value": 1}]},
+        {"metrics": ["total_revenue"], "dimensions": ["product_name"], "limit": 10,
+         "filters": [{"field": "order_time", "operator": "between", "value": week},
+                     {"field": "store_state", "operator": "eq", "value": "SP"}]},
+        {"metrics": ["order_count"], "dimensions": ["region"],
+         "filters": [{"field": "product_id", "operator": "in", "value": [1, 2]},
+                     {"field": "order_time", "operator": "between", "value": month}]},
+        {"metrics": ["total_revenue"], "dimensions": ["channel_name", "order_hour"],
+         "filters": [{"field": "store_city", "operator": "eq", "value": "São Paulo"},
+                     {"field": "order_time", "operator": "between", "value": week}]},
+    ]
+    return [schemas.AnalyticsQueryRequest(**body) for body in bodies]
+
+
+def plan_nodes(plan: Dict[str, Any]):
+    """Percorre os nós de um plano do EXPLAIN (FORMAT JSON)."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+async def explain_workload(conn: AsyncConnection, requests=None) -> List[Dict[str, Any]]:
+    """
+    EXPLAIN (FORMAT JSON) de cada requisição da carga: índices usados,
+    tabelas fato lidas por Seq Scan, partições lidas (tabelas particionadas)
+    e custo estimado. Partições e seus índices aparecem pelo nome do pai.
+    """
+    if requests is None:
+        last = (await conn.execute(select(func.max(sales.c.created_at)))).scalar()
+        requests = canonical_workload(last.date()) if last is not None else []
+    parent_of = dict((await conn.execute(text("""
+        SELECT c.relname, p.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+    """))).all())
+    results = []
+    for query_request in requests:
+        prepared = crud.prepare_analytics_query(query_request)
+        if prepared.statement is None:
+            continue
+        raw = (await conn.execute(crud.Explain(prepared.statement), prepared.params)).scalar()
+        plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+        nodes = list(plan_nodes(plan))
+        relations = [n["Relation Name"] for n in nodes if "Relation Name" in n]
+        results.append({
+            "request": query_request,
+            "indexes": sorted({parent_of.get(n["Index Name"], n["Index Name"]) for n in nodes if "Index Name" in n}),
+            "seq_scans": sorted({
+                parent_of.get(n["Relation Name"], n["Relation Name"]) for n in nodes
+                if n.get("Node Type") == "Seq Scan"
+                and parent_of.get(n["Relation Name"], n["Relation Name"]) in FACT_RANGE_COLUMN
+            }),
+            "partitions": sorted({r for r in relations if parent_of.get(r) in FACT_RANGE_COLUMN}),
+            "cost": plan.get("Total Cost"),
+        })
+    return results
+
+
+def unused_indexes(existing: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Índices sem nenhum scan registrado, exceto os que sustentam constraints (PK/UNIQUE)."""
+    return [ix for ix in existing if ix["scans"] == 0 and not ix["is_constraint"]]
+
+
+def redundant_indexes(existing: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], str]]:
+    """
+    B-trees cujas colunas são prefixo de outro índice da mesma tabela (que
+    também cobre o INCLUDE), ex.: product_sales(sale_id) diante de
+    product_sales(sale_id) INCLUDE (...). Pares (índice, quem o cobre).
+    """
+    def covers(other, ix):
+        width = len(ix["columns"])
+        return (
+            other is not ix and other["table"] == ix["table"] and other["method"] == "btree"
+            and other["valid"] and not other["partial"] and other["columns"][:width] == ix["columns"]
+            and set(ix["include"]) <= set(other["columns"]) | set(other["include"])
+            # definições idênticas: só um dos dois é marcado
+            and (len(other["columns"]) + len(other["include"]) > width + len(ix["include"])
+                 or other["name"] < ix["name"])
+        )
+
+    result = []
+    for ix in existing:
+        if ix["method"] != "btree" or ix["is_constraint"] or ix["partial"]:
+            continue
+        other = next((o for o in existing if covers(o, ix)), None)
+        if other is not None:
+            result.append((ix, other["name"]))
+    return result
+
+
+# =============================================================================
+# CLI
+# =============================================================================
+
+def _describe(spec: IndexSpec) -> str:
+    include = f" INCLUDE ({', '.join(spec.include)})" if spec.include else ""
+    return f"{spec.table} USING {spec.method} ({', '.join(spec.columns)}){include}"
+
+
+async def _run(command: str) -> None:
+    # import tardio: `database` exige DATABASE_URL definido
+    from .database import engine
+
+    try:
+        async with engine.connect() as conn:
+            if command == "apply":
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                created = await apply_indexes(conn)
+                print(f"{len(created)} índice(s) criado(s)")
+
+            if command in ("status", "apply"):
+                status = index_status(required_indexes(), await existing_indexes(conn))
+                for item in status:
+                    spec = item["spec"]
+                    print(f"[{item['status']:>8}] {item['index']}: {_describe(spec)} <- {', '.join(spec.fields)}")
+
+            if command == "verify":
+                names = {item["index"] for item in index_status(required_indexes(), await existing_indexes(conn))}
+                used = set()
+                for result in await explain_workload(conn):
+                    req = result["request"]
+                    used.update(result["indexes"])
+                    print(f"- {req.metrics} por {req.dimensions or '-'} "
+                          f"(filtros: {[f.field for f in req.filters]}) custo={result['cost']}")
+                    print(f"    índices: {', '.join(result['indexes']) or 'nenhum'}"
+                          + (f" | seq scan: {', '.join(result['seq_scans'])}" if result["seq_scans"] else "")
+                          + (f" | partições: {', '.join(result['partitions'])}" if result["partitions"] else ""))
+                unused = sorted(names - used)
+                print(f"Índices necessários sem uso na carga canônica: {', '.join(unused) or 'nenhum'}")
+
+            if command == "report":
+                stats_reset = (await conn.execute(text(
+                    "SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()"
+                ))).scalar()
+                existing = await existing_indexes(conn)
+                required = {item["index"] for item in index_status(required_indexes(), existing)}
+                print(f"Índices sem uso desde {stats_reset or 'a criação do banco'}:")
+                for ix in unused_indexes(existing):
+                    note = " (necessário pelo analytics)" if ix["name"] in required else ""
+                    print(f"  {ix['table']}.{ix['name']}: {ix['size_bytes'] / 1024 / 1024:.1f} MB{note}")
+                print("Índices redundantes (cobertos por outro índice):")
+                for ix, covered_by in redundant_indexes(existing):
+                    print(f"  {ix['table']}.{ix['name']}: coberto por {covered_by}")
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gerencia os índices usados pelo analytics")
+    parser.add_argument("command", choices=["status", "apply", "verify", "report"],
+                        help="status: índices necessários e situação; apply: cria os ausentes "
+                             "(CONCURRENTLY); verify: EXPLAIN da carga canônica; report: índices sem uso")
+    args = parser.parse_args()
+    asyncio.run(_run(args.command))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from .api import router as api_router  
-from .database import engine
+from .database import engine, ENGINE_SETTINGS
+from . import rollups, columnar, partitions, metrics
 from sqlalchemy import text
 import logging
 from contextlib import asynccontextmanager
@@ -20,7 +22,12 @@ async def lifespan(app: FastAPI):
         try:
             async with engine.connect() as conn:
                 await conn.execute(text("SELECT 1"))
-            logger.info("Conexão com o banco validada com sucesso.")
+            logger.info(
+                "Conexão com o banco validada com sucesso (perfil=%s, pool_size=%s, max_overflow=%s).",
+                ENGINE_SETTINGS["profile"],
+                ENGINE_SETTINGS["pool_size"],
+                ENGINE_SETTINGS["max_overflow"],
+            )
             break
         except Exception as exc:
             wait = min(2 * attempt, 10)
@@ -36,10 +43,53 @@ async def lifespan(app: FastAPI):
                 raise
             await asyncio.sleep(wait)
 
+    # Carrega o estado dos rollups; sem rollups a API usa as tabelas brutas
+    try:
+        async with engine.connect() as conn:
+            state = await rollups.load_rollup_state(conn)
+        logger.info("Rollups disponíveis: %s (max_sale_id=%s)", state["available"], state["max_sale_id"])
+    except Exception as exc:
+        logger.warning("Não foi possível carregar o estado dos rollups: %s", exc)
+
+    # Tabelas particionadas por mês: o crud passa a emitir predicados na chave de partição
+    try:
+        async with engine.connect() as conn:
+            await partitions.load_partition_state(conn)
+        logger.info("Tabelas particionadas: %s", partitions.PARTITION_STATE["enabled"])
+    except Exception as exc:
+        logger.warning("Não foi possível verificar o particionamento: %s", exc)
+
+    # Partições dos próximos meses criadas em background (0 desliga)
+    partition_maintenance = None
+    if partitions.PARTITION_STATE["enabled"] and partitions.PARTITION_CHECK_SECONDS > 0:
+        partition_maintenance = asyncio.create_task(
+            partitions.maintain_partitions(engine, partitions.PARTITION_CHECK_SECONDS)
+        )
+
+    # Manutenção incremental dos rollups em background (0 desliga)
+    maintenance = None
+    if rollups.ROLLUP_REFRESH_SECONDS > 0:
+        maintenance = asyncio.create_task(rollups.maintain_rollups(engine, rollups.ROLLUP_REFRESH_SECONDS))
+
+    # Motor colunar em memória (opcional): carrega em background; até lá o SQL responde
+    columnar_loader = None
+    if columnar.COLUMNAR_ENABLED:
+        if columnar.np is None:
+            logger.warning("ANALYTICS_COLUMNAR=1, mas o pacote 'numpy' não está instalado.")
+        else:
+            columnar_loader = asyncio.create_task(columnar.maintain_columnar(engine))
+
     # application started
     yield
 
-    # application shutdown (no-op for now, place to clean resources if needed)
+    # application shutdown
+    for task in (maintenance, columnar_loader, partition_maintenance):
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
 
 # Cria a instância principal da aplicação FastAPI com lifespan
 app = FastAPI(
@@ -62,10 +112,19 @@ app.add_middleware(
     allow_headers=["*"],       # Permite todos os cabeçalhos
 )
 
+# Conta respostas de erro por rota para o /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Inclui as rotas definidas no arquivo api.py na aplicação principal
 app.include_router(api_router)
 
 # Endpoint raiz para verificar se a API está no ar
 @app.get("/")
 async def root():
-    return {"message": "Bem-vindo à API da Nola Analytics!"}
\ No newline at end of file
+    return {"message": "Bem-vindo à API da Nola Analytics!"}
+
+
+# Métricas no formato do Prometheus (latência do /analytics, pool e caches)
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,269 @@
+import os
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Métricas no formato texto do Prometheus (`GET /metrics`), sem
+#   dependências: contadores e histogramas em dicts do processo. Registrar
+#   uma observação custa um lookup no dict, um `bisect` e dois incrementos
+#   (microssegundos); o texto só é montado no scrape.
+# - Não há locks: tudo roda no event loop (uma thread por processo). Com
+#   vários workers do uvicorn cada processo expõe as próprias séries.
+# - Latência de `/analytics` é rotulada pelo formato da consulta (métricas +
+#   dimensões + campos filtrados, sem os valores). Para não explodir a
+#   cardinalidade, só os primeiros METRICS_MAX_SHAPES formatos ganham série
+#   própria; os demais caem em `shape="other"`.
+# - Pool de conexões e caches são lidos no momento do scrape (gauges e
+#   contadores acumulados em `database.POOL_COUNTERS` e nos caches).
+# -------------------------------------------------------------
+
+METRICS_MAX_SHAPES = int(os.getenv("ANALYTICS_METRICS_MAX_SHAPES", "200"))
+OTHER_SHAPE = "other"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monotônico por combinação de rótulos."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+class Histogram:
+    """
+    Histograma com buckets fixos. Cada série guarda contagens por bucket (não
+    acumuladas), soma e total; o acumulado do formato Prometheus é feito no scrape.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            # [contagem por bucket..., +Inf, soma, total]
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, labels: tuple = ()) -> int:
+        series = self._series.get(labels)
+        return series[-1] if series else 0
+
+    def samples(self) -> Iterable[str]:
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-2])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}"
+
+    def clear(self) -> None:
+        self._series.clear()
+
+
+# =============================================================================
+# MÉTRICAS DA API
+# =============================================================================
+
+ANALYTICS_LATENCY = Histogram(
+    "analytics_request_duration_seconds",
+    "Tempo total de POST /api/v1/analytics (JSON), por formato de consulta.",
+    ("shape", "engine", "cache"),
+)
+ANALYTICS_DB_LATENCY = Histogram(
+    "analytics_db_duration_seconds",
+    "Tempo de execução da query analítica no Postgres, por formato de consulta.",
+    ("shape",),
+)
+ANALYTICS_ROWS = Histogram(
+    "analytics_rows_returned",
+    "Linhas devolvidas por POST /api/v1/analytics, por formato de consulta.",
+    ("shape",),
+    buckets=ROWS_BUCKETS,
+)
+HTTP_ERRORS = Counter(
+    "http_errors_total",
+    "Respostas com status >= 400 e exceções não tratadas, por rota.",
+    ("route", "status"),
+)
+POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Tempo para obter uma conexão do pool (fila + abertura de conexões novas).",
+)
+
+REGISTRY = [ANALYTICS_LATENCY, ANALYTICS_DB_LATENCY, ANALYTICS_ROWS, HTTP_ERRORS, POOL_WAIT]
+
+_shapes: Dict[tuple, str] = {}
+
+
+def query_shape(query_request) -> str:
+    """
+    Rótulo do formato da consulta: métricas | dimensões | campos filtrados
+    (ordenados, sem valores). Ex.: `order_count,total_revenue|store_name|order_time`.
+    """
+    key = (
+        tuple(sorted(query_request.metrics)),
+        tuple(sorted(query_request.dimensions)),
+        tuple(sorted({f.field for f in query_request.filters or []})),
+    )
+    shape = _shapes.get(key)
+    if shape is None:
+        if len(_shapes) >= METRICS_MAX_SHAPES:
+            return OTHER_SHAPE
+        shape = _shapes[key] = "|".join(",".join(part) for part in key)
+    return shape
+
+
+def observe_analytics(query_request, metadata, rows: int) -> None:
+    """Registra uma resposta de `/analytics` (tempos vêm de `ResponseMetadata`, em ms)."""
+    shape = query_shape(query_request)
+    total_ms = metadata.execution_time_ms + (metadata.serialize_time_ms or 0)
+    ANALYTICS_LATENCY.observe(
+        total_ms / 1000, (shape, metadata.engine or "none", "hit" if metadata.cache_hit else "miss")
+    )
+    if metadata.execute_time_ms is not None:
+        ANALYTICS_DB_LATENCY.observe(metadata.execute_time_ms / 1000, (shape,))
+    ANALYTICS_ROWS.observe(rows, (shape,))
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que conta respostas de erro (status >= 400) e exceções
+    não tratadas por rota (o template do path, não a URL, para manter a
+    cardinalidade baixa).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status = status or 500
+            raise
+        finally:
+            if status is None or status >= 400:
+                route = scope.get("route")
+                HTTP_ERRORS.inc((getattr(route, "path", "unmatched"), str(status or 500)))
+
+
+# =============================================================================
+# SCRAPE
+# =============================================================================
+
+def _family(name: str, kind: str, documentation: str, samples: Iterable[str]) -> List[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", *samples]
+
+
+def _gauge(name: str, documentation: str, value, kind: str = "gauge",
+           labels: Optional[List[Tuple[str, ...]]] = None) -> List[str]:
+    if labels is None:
+        return _family(name, kind, documentation, [f"{name} {_number(value)}"])
+    return _family(name, kind, documentation, [
+        f"{name}{_labels(('cache',), label)} {_number(v)}" for label, v in zip(labels, value)
+    ])
+
+
+def _runtime_families() -> List[str]:
+    """Pool e caches lidos no momento do scrape."""
+    # import tardio: database importa este módulo (POOL_WAIT)
+    from . import database
+    from .cache import result_cache, statement_cache
+
+    lines: List[str] = []
+    pool = database.pool_stats()
+    if "capacity" in pool:
+        lines += _gauge("db_pool_size", "Conexões mantidas pelo pool (pool_size).", pool["size"])
+        lines += _gauge("db_pool_capacity", "Conexões máximas (pool_size + max_overflow).", pool["capacity"])
+        lines += _gauge("db_pool_checked_out", "Conexões emprestadas agora.", pool["checked_out"])
+        lines += _gauge("db_pool_overflow", "Conexões abertas além de pool_size agora.", pool["overflow"])
+    lines += _gauge("db_pool_checkouts_total", "Empréstimos de conexão desde o startup.",
+                    pool["checkouts"], kind="counter")
+    lines += _gauge("db_pool_exhausted_checkouts_total",
+                    "Empréstimos que ocuparam a última conexão disponível.",
+                    pool["exhausted_checkouts"], kind="counter")
+    lines += _gauge("db_pool_timeouts_total", "Esperas por conexão que estouraram pool_timeout.",
+                    pool["timeouts"], kind="counter")
+
+    caches = [("results",), ("statements",)]
+    stats = [
+        {"size": len(result_cache), "hits": result_cache.hits, "misses": result_cache.misses},
+        statement_cache.stats(),
+    ]
+    lines += _gauge("analytics_cache_hits_total", "Acertos dos caches de consultas.",
+                    [s["hits"] for s in stats], kind="counter", labels=caches)
+    lines += _gauge("analytics_cache_misses_total", "Faltas dos caches de consultas.",
+                    [s["misses"] for s in stats], kind="counter", labels=caches)
+    lines += _gauge("analytics_cache_entries", "Entradas nos caches de consultas.",
+                    [s["size"] for s in stats], labels=caches)
+    return lines
+
+
+def render() -> str:
+    """Texto do endpoint `/metrics` (formato de exposição 0.0.4)."""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines += _family(metric.name, metric.kind, metric.documentation, metric.samples())
+    lines += _runtime_families()
+    return "\n".join(lines) + "\n"
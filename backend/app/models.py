@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Table, MetaData, Column, String, DateTime, Integer, Numeric, ForeignKey
+    Table, MetaData, Column, String, Date, DateTime, Integer, Numeric, ForeignKey
 )
 
 metadata = MetaData()
@@ -54,5 +54,48 @@ product_sales = Table('product_sales', metadata,
     Column('product_id', Integer, ForeignKey('products.id')),
     Column('quantity', Integer),
     Column('base_price', Numeric),
-    Column('total_price', Numeric)
-)
\ No newline at end of file
+    Column('total_price', Numeric),
+    # só existe com o layout particionado (app/partitions.py): created_at da venda
+    Column('sale_created_at', DateTime)
+)
+
+# =============================================================================
+# TABELAS DE ROLLUP (pré-agregadas) — ver `app/rollups.py`
+# =============================================================================
+# As tabelas abaixo NÃO fazem parte de `database-schema.sql`: são criadas e
+# populadas pelo comando `python -m app.rollups rebuild`. A receita é
+# NUMERIC (somas exatas); as métricas de receita são arredondadas a centavos
+# nos dois caminhos (ver `rollups.money`), então o resultado é o mesmo
+# Decimal com ou sem rollup.
+
+# Grão: dia × loja × canal (nível de venda — permite contar pedidos)
+sales_daily_rollup = Table('analytics_sales_daily', metadata,
+    Column('day', Date, primary_key=True),
+    Column('store_id', Integer, primary_key=True),
+    Column('channel_id', Integer, primary_key=True),
+    Column('order_count', Integer),
+    Column('revenue', Numeric)
+)
+
+# Grão: dia × produto (nível de linha de produto — só métricas aditivas)
+product_daily_rollup = Table('analytics_product_daily', metadata,
+    Column('day', Date, primary_key=True),
+    Column('product_id', Integer, primary_key=True),
+    Column('revenue', Numeric)
+)
+
+# Grão: dia × loja × canal × produto (nível de linha de produto)
+store_product_daily_rollup = Table('analytics_store_product_daily', metadata,
+    Column('day', Date, primary_key=True),
+    Column('store_id', Integer, primary_key=True),
+    Column('channel_id', Integer, primary_key=True),
+    Column('product_id', Integer, primary_key=True),
+    Column('revenue', Numeric)
+)
+
+# Estado dos rollups: watermark (maior sales.id incluído) e data do rebuild
+rollup_state = Table('analytics_rollup_state', metadata,
+    Column('name', String, primary_key=True),
+    Column('max_sale_id', Integer),
+    Column('refreshed_at', DateTime)
+)
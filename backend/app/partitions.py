@@ -0,0 +1,322 @@
+import os
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Particionamento mensal por intervalo (RANGE) de `sales` e
+#   `product_sales`. product_sales ganha a coluna desnormalizada
+#   `sale_created_at` (= sales.created_at da venda), que é a sua chave de
+#   partição: assim um filtro de período poda as duas tabelas.
+# - PARTITION_STATE: o crud só emite predicados em `sale_created_at`
+#   quando `enabled` é True (carregado no startup por `load_partition_state`);
+#   bancos não migrados continuam funcionando como antes.
+# - migrate_to_partitions: converte as tabelas em uma única transação
+#   (renomeia, cria as particionadas, copia, recria PK/índices/triggers e
+#   remove as antigas). Chaves primárias passam a incluir a chave de
+#   partição: (id, created_at) e (id, sale_created_at).
+#   FKs de outras tabelas para sales/product_sales (payments,
+#   delivery_sales, item_product_sales, ...) não podem apontar para uma
+#   tabela particionada sem a chave de partição: elas são removidas e o
+#   ON DELETE CASCADE/SET NULL passa a ser feito por triggers por statement.
+#   product_sales → sales vira a FK composta (sale_id, sale_created_at).
+#   As FKs de saída (sales → stores/channels/customers/sub_brands,
+#   product_sales → products) não são copiadas pelo LIKE: são lidas com
+#   pg_get_constraintdef antes da troca e recriadas nas tabelas novas.
+# - analytics_ensure_partitions(início, fim) (função no banco): cria as
+#   partições mensais que faltam no intervalo; usada pela migração, pela
+#   manutenção em background da API (meses à frente) e pelo generate_data.
+#   Linhas fora das partições mensais caem na partição default.
+# - CLI: `python -m app.partitions migrate|ensure|status`.
+# -------------------------------------------------------------
+
+logger = logging.getLogger("nola")
+
+# tabela -> coluna de partição
+PARTITIONED_TABLES = {
+    "sales": "created_at",
+    "product_sales": "sale_created_at",
+}
+
+# Quantos meses à frente manter criados e de quanto em quanto tempo verificar (0 desliga)
+PARTITION_PREMAKE_MONTHS = int(os.getenv("ANALYTICS_PARTITION_PREMAKE_MONTHS", "3"))
+PARTITION_CHECK_SECONDS = float(os.getenv("ANALYTICS_PARTITION_CHECK_SECONDS", "3600"))
+
+PARTITION_STATE: Dict[str, Any] = {"enabled": False}
+
+ENSURE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION analytics_ensure_partitions(range_start timestamp, range_end timestamp)
+    RETURNS integer LANGUAGE plpgsql AS $$
+    DECLARE
+        month timestamp := date_trunc('month', range_start);
+        parent text;
+        partition text;
+        created integer := 0;
+    BEGIN
+        WHILE month <= range_end LOOP
+            FOREACH parent IN ARRAY ARRAY['sales', 'product_sales'] LOOP
+                partition := format('%s_p%s', parent, to_char(month, 'YYYY_MM'));
+                IF to_regclass(partition) IS NULL THEN
+                    BEGIN
+                        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                                       partition, parent, month, month + interval '1 month');
+                        created := created + 1;
+                    EXCEPTION WHEN check_violation THEN
+                        -- a partição default já tem linhas deste mês: continuam lá
+                        RAISE WARNING 'partição % não criada: %', partition, SQLERRM;
+                    END;
+                END IF;
+            END LOOP;
+            month := month + interval '1 month';
+        END LOOP;
+        RETURN created;
+    END $$
+"""
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    return bool((await conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('product_sales'))"
+    ))).scalar())
+
+
+async def load_partition_state(conn: AsyncConnection) -> Dict[str, Any]:
+    PARTITION_STATE["enabled"] = await is_partitioned(conn)
+    return PARTITION_STATE
+
+
+async def ensure_partitions(conn: AsyncConnection, range_start: datetime, range_end: datetime) -> int:
+    """Cria as partições mensais que faltam entre `range_start` e `range_end`."""
+    return (await conn.execute(
+        text("SELECT analytics_ensure_partitions(:range_start, :range_end)"),
+        {"range_start": range_start, "range_end": range_end},
+    )).scalar()
+
+
+def _months_ahead(now: datetime, months: int) -> datetime:
+    month = now.month - 1 + months
+    return now.replace(year=now.year + month // 12, month=month % 12 + 1, day=1)
+
+
+# =============================================================================
+# MIGRAÇÃO
+# =============================================================================
+
+REFERENCING_FKS_SQL = """
+    SELECT c.conname AS name, c.conrelid::regclass::text AS child,
+           c.confrelid::regclass::text AS parent, c.confdeltype::text AS on_delete,
+           a.attname AS column
+    FROM pg_constraint c
+    JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+    WHERE c.contype = 'f' AND c.confrelid IN (to_regclass('sales'), to_regclass('product_sales'))
+    ORDER BY c.conname
+"""
+
+# FKs das próprias tabelas para as demais (a de product_sales → sales é recriada à parte)
+OUTBOUND_FKS_SQL = """
+    SELECT conrelid::regclass::text AS relation, conname AS name, pg_get_constraintdef(oid) AS definition
+    FROM pg_constraint
+    WHERE conrelid IN ('sales'::regclass, 'product_sales'::regclass) AND contype = 'f'
+      AND confrelid NOT IN ('sales'::regclass, 'product_sales'::regclass)
+    ORDER BY conrelid, conname
+"""
+
+
+def _cascade_triggers(fks: List[Dict[str, Any]]) -> List[str]:
+    """
+    Triggers por statement que reproduzem o ON DELETE CASCADE/SET NULL das
+    FKs removidas (uma função por tabela pai, com transition table).
+    """
+    ddl = []
+    for parent in PARTITIONED_TABLES:
+        actions = []
+        for fk in fks:
+            if fk["parent"] != parent:
+                continue
+            if fk["on_delete"] == "c":
+                actions.append(f"DELETE FROM {fk['child']} WHERE {fk['column']} IN (SELECT id FROM old_rows);")
+            elif fk["on_delete"] == "n":
+                actions.append(
+                    f"UPDATE {fk['child']} SET {fk['column']} = NULL WHERE {fk['column']} IN (SELECT id FROM old_rows);"
+                )
+        if not actions:
+            continue
+        body = "\n            ".join(actions)
+        ddl.append(f"""
+            CREATE OR REPLACE FUNCTION analytics_cascade_{parent}_delete() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+            {body}
+            RETURN NULL;
+            END $$
+        """)
+        ddl.append(f"""
+            CREATE TRIGGER analytics_cascade_{parent}_delete AFTER DELETE ON {parent}
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION analytics_cascade_{parent}_delete()
+        """)
+    return ddl
+
+
+async def migrate_to_partitions(conn: AsyncConnection, premake_months: int = PARTITION_PREMAKE_MONTHS) -> Dict[str, Any]:
+    """
+    Converte `sales`/`product_sales` em tabelas particionadas por mês, na
+    transação de `conn` (bloqueia as duas tabelas até o commit). Cria as
+    partições do primeiro mês com vendas até `premake_months` à frente,
+    mais uma partição default. Retorna contagens para conferência.
+    """
+    # import tardio: indexes/rollups importam crud, que importa este módulo
+    from . import indexes, rollups
+
+    if await is_partitioned(conn):
+        return {"migrated": False}
+
+    await conn.execute(text("LOCK TABLE sales, product_sales IN ACCESS EXCLUSIVE MODE"))
+    first, counts_before = (await conn.execute(text(
+        "SELECT min(created_at), (SELECT count(*) FROM product_sales) FROM sales"
+    ))).one()
+
+    fks = [dict(row) for row in (await conn.execute(text(REFERENCING_FKS_SQL))).mappings()]
+    for fk in fks:
+        await conn.execute(text(f"ALTER TABLE {fk['child']} DROP CONSTRAINT {fk['name']}"))
+    outbound = [dict(row) for row in (await conn.execute(text(OUTBOUND_FKS_SQL))).mappings()]
+
+    for table, key in PARTITIONED_TABLES.items():
+        await conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_legacy"))
+        await conn.execute(text(
+            f"CREATE TABLE {table} (LIKE {table}_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS"
+            + (f", {key} TIMESTAMP NOT NULL" if table == "product_sales" else "")
+            + f") PARTITION BY RANGE ({key})"
+        ))
+        await conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+        # a sequência do id (SERIAL) passa para a tabela nova antes do DROP da antiga
+        await conn.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+
+    await conn.execute(text(ENSURE_FUNCTION))
+    now = datetime.now()
+    await ensure_partitions(conn, first or now, _months_ahead(now, premake_months))
+
+    # ordem de id preserva a correlação física com created_at (BRIN)
+    await conn.execute(text("INSERT INTO sales SELECT * FROM sales_legacy ORDER BY id"))
+    await conn.execute(text("""
+        INSERT INTO product_sales
+        SELECT ps.*, s.created_at FROM product_sales_legacy ps
+        JOIN sales_legacy s ON s.id = ps.sale_id
+        ORDER BY ps.id
+    """))
+    await conn.execute(text("DROP TABLE product_sales_legacy, sales_legacy"))
+
+    await conn.execute(text("ALTER TABLE sales ADD PRIMARY KEY (id, created_at)"))
+    await conn.execute(text("ALTER TABLE product_sales ADD PRIMARY KEY (id, sale_created_at)"))
+    await conn.execute(text("""
+        ALTER TABLE product_sales ADD CONSTRAINT product_sales_sale_fkey
+        FOREIGN KEY (sale_id, sale_created_at) REFERENCES sales (id, created_at)
+        ON DELETE CASCADE ON UPDATE CASCADE
+    """))
+    for fk in outbound:
+        await conn.execute(text(f"ALTER TABLE {fk['relation']} ADD CONSTRAINT {fk['name']} {fk['definition']}"))
+    for ddl in _cascade_triggers([fk for fk in fks if fk["child"] not in PARTITIONED_TABLES]):
+        await conn.execute(text(ddl))
+    # tabela nova ainda invisível para as outras sessões: índices sem CONCURRENTLY
+    for spec in indexes.required_indexes():
+        await conn.execute(text(spec.ddl(concurrently=False)))
+    if (await conn.execute(text("SELECT to_regclass('analytics_rollup_changes')"))).scalar():
+        await rollups.ensure_rollup_schema(conn)
+
+    counts_after = (await conn.execute(text("SELECT count(*) FROM product_sales"))).scalar()
+    if counts_after != counts_before:
+        raise RuntimeError(f"product_sales: {counts_before} linhas antes e {counts_after} depois da migração")
+    for table in PARTITIONED_TABLES:
+        await conn.execute(text(f"ANALYZE {table}"))
+    return {
+        "migrated": True,
+        "product_sales": counts_after,
+        "dropped_fks": [f"{fk['child']}.{fk['name']}" for fk in fks],
+        "recreated_fks": [f"{fk['relation']}.{fk['name']}" for fk in outbound],
+    }
+
+
+async def partition_sizes(conn: AsyncConnection) -> List[Dict[str, Any]]:
+    rows = await conn.execute(text("""
+        SELECT p.relname AS parent, c.relname AS partition,
+               pg_get_expr(c.relpartbound, c.oid) AS bounds,
+               c.reltuples::bigint AS estimated_rows
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.oid IN (to_regclass('sales'), to_regclass('product_sales')) AND c.relkind IN ('r', 'p')
+        ORDER BY p.relname, c.relname
+    """))
+    return [dict(row) for row in rows.mappings()]
+
+
+async def maintain_partitions(engine, interval: float = PARTITION_CHECK_SECONDS) -> None:
+    """Loop do lifespan: mantém `PARTITION_PREMAKE_MONTHS` meses de partições à frente."""
+    while True:
+        try:
+            async with engine.begin() as conn:
+                now = datetime.now()
+                created = await ensure_partitions(conn, now, _months_ahead(now, PARTITION_PREMAKE_MONTHS))
+            if created:
+                logger.info("Partições mensais criadas: %s", created)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Falha ao criar partições futuras: %s", exc)
+        await asyncio.sleep(interval)
+
+
+# =============================================================================
+# CLI
+# =============================================================================
+
+async def _run(command: str) -> None:
+    # import tardio: `database` exige DATABASE_URL definido
+    from .database import engine
+
+    try:
+        if command == "migrate":
+            async with engine.begin() as conn:
+                # cópia e índices de uma base grande passam do statement_timeout do perfil prod
+                await conn.execute(text("SET LOCAL statement_timeout = 0"))
+                result = await migrate_to_partitions(conn)
+            if not result["migrated"]:
+                print("Tabelas já particionadas")
+            else:
+                print(f"✓ sales/product_sales particionadas ({result['product_sales']:,} linhas de produto)")
+                for fk in result["dropped_fks"]:
+                    print(f"  FK removida (cascade via trigger): {fk}")
+
+        if command == "ensure":
+            async with engine.begin() as conn:
+                now = datetime.now()
+                created = await ensure_partitions(conn, now, _months_ahead(now, PARTITION_PREMAKE_MONTHS))
+            print(f"✓ {created} partição(ões) criada(s)")
+
+        async with engine.connect() as conn:
+            if not await is_partitioned(conn):
+                print("Tabelas não particionadas (rode `python -m app.partitions migrate`)")
+                return
+            for row in await partition_sizes(conn):
+                print(f"  {row['partition']}: {row['bounds']} (~{max(row['estimated_rows'], 0):,} linhas)")
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Particionamento mensal de sales/product_sales")
+    parser.add_argument("command", choices=["migrate", "ensure", "status"],
+                        help="migrate: converte as tabelas; ensure: cria as partições dos "
+                             "próximos meses; status: lista as partições")
+    args = parser.parse_args()
+    asyncio.run(_run(args.command))
+
+
+if __name__ == "__main__":
+    main()
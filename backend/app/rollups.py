@@ -0,0 +1,551 @@
+import os
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from sqlalchemy import text, func, cast, literal_column, Numeric
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .models import (
+    sales_daily_rollup, product_daily_rollup, store_product_daily_rollup,
+)
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Este arquivo implementa a camada de rollups (tabelas pré-agregadas)
+#   usada pelo roteador de `crud.build_analytics_query`.
+# - ROLLUPS: catálogo de rollups, ordenado do MENOR para o maior. Cada item
+#   declara a tabela, o conjunto de "grãos" que ela preserva (dia, loja,
+#   canal, produto) e as métricas que consegue responder de forma exata.
+# - ROLLUP_STATE: estado em memória (disponibilidade + watermark). O
+#   roteador só usa rollups quando `available` é True, o que acontece após
+#   `load_rollup_state` encontrar um rebuild concluído no banco.
+# - rebuild_rollups: recria o conteúdo das tabelas a partir de
+#   `sales`/`product_sales` até um watermark (maior `sales.id`).
+# - Manutenção incremental: triggers por statement (com transition tables)
+#   em `sales` e `product_sales` registram em `analytics_rollup_changes` os
+#   buckets dia × loja × canal afetados por INSERT/UPDATE/DELETE — inclusive
+#   vendas que chegam atrasadas (created_at antigo), cancelamentos/edições
+#   de `sale_status_desc`, loja ou canal, e linhas de produto alteradas.
+#   refresh_rollups consome esse log e reescreve apenas os buckets
+#   afetados; `maintain_rollups` roda isso em loop no lifespan da API.
+#   O log (e não só `sales.id > watermark`) é a fonte das mudanças porque a
+#   ordem dos ids não é a ordem de commit: uma transação longa pode gravar
+#   um id menor depois que o watermark já passou por ele.
+# - CLI: `python -m app.rollups rebuild|refresh|status`.
+# -------------------------------------------------------------
+
+logger = logging.getLogger("nola")
+
+# Permite desligar o roteamento sem remover as tabelas (ex.: para depuração)
+USE_ROLLUPS = os.getenv("ANALYTICS_USE_ROLLUPS", "1").strip().lower() not in ("0", "false", "no")
+
+# Intervalo (segundos) da manutenção incremental no lifespan; 0 desliga
+ROLLUP_REFRESH_SECONDS = float(os.getenv("ANALYTICS_ROLLUP_REFRESH_SECONDS", "5"))
+
+# Chave do advisory lock que serializa rebuild/refresh entre processos
+ROLLUP_LOCK_KEY = 7_410_001
+
+# =============================================================================
+# CATÁLOGO DE ROLLUPS
+# =============================================================================
+
+
+def money(total):
+    """
+    Receita arredondada a centavos, em NUMERIC: ROUND(total::numeric, 2).
+
+    As linhas de `product_sales` são FLOAT; uma soma em ponto flutuante só
+    difere do valor exato nas últimas casas e depende da ordem da soma. Com
+    o arredondamento, o caminho bruto (soma FLOAT), os rollups (NUMERIC) e o
+    motor colunar devolvem o mesmo Decimal.
+    """
+    # 2 literal (e não bind param): o SQL do formato não muda
+    return func.round(cast(total, Numeric), literal_column("2"), type_=Numeric)
+
+
+def money_ratio(total, count):
+    """Ticket médio: receita em centavos / pedidos, arredondado a centavos."""
+    return money(money(total) / func.nullif(count, 0))
+
+
+ROLLUPS = [
+    {
+        "name": "analytics_sales_daily",
+        "table": sales_daily_rollup,
+        "grain": {"day", "store", "channel"},
+        "metrics": {
+            "total_revenue": money(func.sum(sales_daily_rollup.c.revenue)).label("total_revenue"),
+            # soma de contagens por grupo: cada venda pertence a um único grupo
+            "order_count": func.coalesce(
+                func.sum(sales_daily_rollup.c.order_count), 0
+            ).label("order_count"),
+            "avg_order_value": money_ratio(
+                func.sum(sales_daily_rollup.c.revenue), func.sum(sales_daily_rollup.c.order_count)
+            ).label("avg_order_value"),
+        },
+    },
+    {
+        "name": "analytics_product_daily",
+        "table": product_daily_rollup,
+        "grain": {"day", "product"},
+        "metrics": {
+            "total_revenue": money(func.sum(product_daily_rollup.c.revenue)).label("total_revenue"),
+        },
+    },
+    {
+        "name": "analytics_store_product_daily",
+        "table": store_product_daily_rollup,
+        "grain": {"day", "store", "channel", "product"},
+        "metrics": {
+            "total_revenue": money(func.sum(store_product_daily_rollup.c.revenue)).label("total_revenue"),
+        },
+    },
+]
+
+ROLLUP_STATE: Dict[str, Any] = {
+    "available": False,
+    "max_sale_id": None,
+    "refreshed_at": None,
+}
+
+# =============================================================================
+# DDL E SQL DE REBUILD
+# =============================================================================
+
+DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS analytics_sales_daily (
+        day DATE NOT NULL,
+        store_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        order_count INTEGER NOT NULL,
+        revenue NUMERIC NOT NULL,
+        PRIMARY KEY (day, store_id, channel_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_product_daily (
+        day DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        revenue NUMERIC NOT NULL,
+        PRIMARY KEY (day, product_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_store_product_daily (
+        day DATE NOT NULL,
+        store_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        revenue NUMERIC NOT NULL,
+        PRIMARY KEY (day, store_id, channel_id, product_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_rollup_state (
+        name VARCHAR(100) PRIMARY KEY,
+        max_sale_id INTEGER NOT NULL,
+        refreshed_at TIMESTAMP NOT NULL
+    )
+    """,
+    # rollups criados antes com receita DOUBLE PRECISION: somas exatas (NUMERIC)
+    """
+    DO $$
+    DECLARE
+        rollup text;
+    BEGIN
+        FOR rollup IN
+            SELECT table_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND column_name = 'revenue'
+              AND data_type = 'double precision'
+              AND table_name IN ('analytics_sales_daily', 'analytics_product_daily', 'analytics_store_product_daily')
+        LOOP
+            EXECUTE format('ALTER TABLE %I ALTER COLUMN revenue TYPE NUMERIC', rollup);
+        END LOOP;
+    END $$
+    """,
+    # log de buckets afetados (preenchido pelos triggers abaixo)
+    """
+    CREATE TABLE IF NOT EXISTS analytics_rollup_changes (
+        id BIGSERIAL PRIMARY KEY,
+        day DATE NOT NULL,
+        store_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL
+    )
+    """,
+    # o refresh busca as linhas de produto das vendas de cada bucket; mesma
+    # definição do índice de JOIN derivado em app/indexes.py
+    "CREATE INDEX IF NOT EXISTS idx_product_sales_sale_id_cover ON product_sales "
+    "USING btree (sale_id) INCLUDE (product_id, base_price, quantity)",
+    """
+    CREATE OR REPLACE FUNCTION analytics_log_sales_change() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO analytics_rollup_changes (day, store_id, channel_id)
+            SELECT DISTINCT created_at::date, store_id, channel_id FROM old_rows;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO analytics_rollup_changes (day, store_id, channel_id)
+            SELECT DISTINCT created_at::date, store_id, channel_id FROM new_rows;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION analytics_log_product_sales_change() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO analytics_rollup_changes (day, store_id, channel_id)
+            SELECT DISTINCT s.created_at::date, s.store_id, s.channel_id
+            FROM old_rows r JOIN sales s ON s.id = r.sale_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO analytics_rollup_changes (day, store_id, channel_id)
+            SELECT DISTINCT s.created_at::date, s.store_id, s.channel_id
+            FROM new_rows r JOIN sales s ON s.id = r.sale_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+]
+
+# Triggers por statement: uma única inserção no log por comando (e não por
+# linha), o que mantém barata a carga em lote do gerador de dados.
+TRIGGERS = {
+    f"analytics_{table}_{op.lower()}": f"""
+        CREATE TRIGGER analytics_{table}_{op.lower()}
+        AFTER {op} ON {table}
+        REFERENCING {referencing}
+        FOR EACH STATEMENT EXECUTE FUNCTION analytics_log_{table}_change()
+    """
+    for table in ("sales", "product_sales")
+    for op, referencing in (
+        ("INSERT", "NEW TABLE AS new_rows"),
+        ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+        ("DELETE", "OLD TABLE AS old_rows"),
+    )
+}
+
+# Cada venda é pré-agregada por sale_id antes do GROUP BY, então o número
+# de pedidos é um COUNT(*) simples (sem COUNT DISTINCT). Vendas sem linhas
+# de produto ficam de fora, exatamente como no JOIN do caminho bruto.
+REBUILD_SQL = {
+    "analytics_sales_daily": """
+        INSERT INTO analytics_sales_daily (day, store_id, channel_id, order_count, revenue)
+        SELECT s.created_at::date, s.store_id, s.channel_id, count(*), sum(ps.revenue)
+        FROM sales s
+        JOIN (
+            SELECT sale_id, sum(base_price * quantity) AS revenue
+            FROM product_sales
+            GROUP BY sale_id
+        ) ps ON ps.sale_id = s.id
+        WHERE s.id <= :max_sale_id
+        GROUP BY 1, 2, 3
+    """,
+    "analytics_product_daily": """
+        INSERT INTO analytics_product_daily (day, product_id, revenue)
+        SELECT s.created_at::date, ps.product_id, sum(ps.base_price * ps.quantity)
+        FROM sales s
+        JOIN product_sales ps ON ps.sale_id = s.id
+        WHERE s.id <= :max_sale_id
+        GROUP BY 1, 2
+    """,
+    "analytics_store_product_daily": """
+        INSERT INTO analytics_store_product_daily (day, store_id, channel_id, product_id, revenue)
+        SELECT s.created_at::date, s.store_id, s.channel_id, ps.product_id,
+               sum(ps.base_price * ps.quantity)
+        FROM sales s
+        JOIN product_sales ps ON ps.sale_id = s.id
+        WHERE s.id <= :max_sale_id
+        GROUP BY 1, 2, 3, 4
+    """,
+}
+
+
+async def ensure_rollup_schema(conn: AsyncConnection) -> None:
+    """
+    Cria (se faltarem) as tabelas de rollup, o log de mudanças e os triggers.
+
+    Triggers existentes não são recriados: DROP/CREATE TRIGGER bloqueia
+    escritas em `sales` até o fim da transação.
+    """
+    # a conversão de colunas (DDL) reescreve tabelas: sem o statement_timeout do perfil prod
+    await conn.execute(text("SET LOCAL statement_timeout = 0"))
+    for ddl in DDL:
+        await conn.execute(text(ddl))
+    existing = set((await conn.execute(
+        text("SELECT tgname FROM pg_trigger WHERE tgname LIKE 'analytics\\_%'")
+    )).scalars())
+    for name, ddl in TRIGGERS.items():
+        if name not in existing:
+            await conn.execute(text(ddl))
+
+
+async def _write_state(conn: AsyncConnection, max_sale_id: int) -> None:
+    refreshed_at = datetime.now()
+    for rollup in ROLLUPS:
+        await conn.execute(
+            text("""
+                INSERT INTO analytics_rollup_state (name, max_sale_id, refreshed_at)
+                VALUES (:name, :max_sale_id, :refreshed_at)
+                ON CONFLICT (name) DO UPDATE
+                SET max_sale_id = EXCLUDED.max_sale_id, refreshed_at = EXCLUDED.refreshed_at
+            """),
+            {"name": rollup["name"], "max_sale_id": max_sale_id, "refreshed_at": refreshed_at},
+        )
+
+
+async def rebuild_rollups(conn: AsyncConnection) -> Dict[str, int]:
+    """
+    Recria todas as tabelas de rollup a partir das tabelas brutas.
+
+    Deve ser chamada dentro de uma transação (de preferência REPEATABLE READ,
+    como faz a CLI) para que o watermark e os INSERTs vejam o mesmo snapshot.
+    Mudanças registradas no log e visíveis nesse snapshot já estão incluídas
+    e são descartadas; as posteriores ficam para o próximo refresh.
+    Retorna o número de linhas gravadas por rollup.
+    """
+    # reagregar a base inteira passa do statement_timeout do perfil prod
+    await conn.execute(text("SET LOCAL statement_timeout = 0"))
+    await ensure_rollup_schema(conn)
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ROLLUP_LOCK_KEY})
+
+    max_sale_id = (await conn.execute(text("SELECT coalesce(max(id), 0) FROM sales"))).scalar()
+    await conn.execute(text("DELETE FROM analytics_rollup_changes"))
+
+    counts = {}
+    for rollup in ROLLUPS:
+        name = rollup["name"]
+        await conn.execute(text(f"TRUNCATE {name}"))
+        result = await conn.execute(text(REBUILD_SQL[name]), {"max_sale_id": max_sale_id})
+        counts[name] = result.rowcount
+        # atualiza estatísticas para o planner escolher bons planos logo de início
+        await conn.execute(text(f"ANALYZE {name}"))
+    await _write_state(conn, max_sale_id)
+
+    return counts
+
+
+# =============================================================================
+# MANUTENÇÃO INCREMENTAL
+# =============================================================================
+
+# Passos de `refresh_rollups`, executados em ordem na mesma transação. Cada
+# bucket afetado é reescrito por inteiro (DELETE + INSERT do bucket), o que
+# também cobre buckets que ficaram vazios. analytics_product_daily é
+# derivado de analytics_store_product_daily apenas para os pares
+# (dia, produto) tocados.
+REFRESH_SQL = [
+    """
+    CREATE TEMP TABLE analytics_dirty_buckets (
+        day DATE, store_id INTEGER, channel_id INTEGER
+    ) ON COMMIT DROP
+    """,
+    "CREATE TEMP TABLE analytics_dirty_products (day DATE, product_id INTEGER) ON COMMIT DROP",
+    # consome o log visível no snapshot; o que for gravado depois fica para a próxima rodada
+    """
+    WITH claimed AS (
+        DELETE FROM analytics_rollup_changes RETURNING day, store_id, channel_id
+    )
+    INSERT INTO analytics_dirty_buckets SELECT DISTINCT day, store_id, channel_id FROM claimed
+    """,
+    """
+    WITH removed AS (
+        DELETE FROM analytics_store_product_daily t USING analytics_dirty_buckets d
+        WHERE t.day = d.day AND t.store_id = d.store_id AND t.channel_id = d.channel_id
+        RETURNING t.day, t.product_id
+    )
+    INSERT INTO analytics_dirty_products SELECT day, product_id FROM removed
+    """,
+    """
+    WITH added AS (
+        INSERT INTO analytics_store_product_daily (day, store_id, channel_id, product_id, revenue)
+        SELECT d.day, d.store_id, d.channel_id, ps.product_id, sum(ps.base_price * ps.quantity)
+        FROM analytics_dirty_buckets d
+        JOIN sales s
+          ON s.created_at::date = d.day AND s.store_id = d.store_id AND s.channel_id = d.channel_id
+        JOIN product_sales ps ON ps.sale_id = s.id
+        GROUP BY 1, 2, 3, 4
+        RETURNING day, product_id
+    )
+    INSERT INTO analytics_dirty_products SELECT day, product_id FROM added
+    """,
+    """
+    DELETE FROM analytics_sales_daily t USING analytics_dirty_buckets d
+    WHERE t.day = d.day AND t.store_id = d.store_id AND t.channel_id = d.channel_id
+    """,
+    """
+    INSERT INTO analytics_sales_daily (day, store_id, channel_id, order_count, revenue)
+    SELECT d.day, d.store_id, d.channel_id, count(*), sum(ps.revenue)
+    FROM analytics_dirty_buckets d
+    JOIN sales s
+      ON s.created_at::date = d.day AND s.store_id = d.store_id AND s.channel_id = d.channel_id
+    JOIN LATERAL (
+        SELECT sum(base_price * quantity) AS revenue FROM product_sales WHERE sale_id = s.id
+    ) ps ON ps.revenue IS NOT NULL
+    GROUP BY 1, 2, 3
+    """,
+    """
+    DELETE FROM analytics_product_daily t USING (
+        SELECT DISTINCT day, product_id FROM analytics_dirty_products
+    ) p
+    WHERE t.day = p.day AND t.product_id = p.product_id
+    """,
+    """
+    INSERT INTO analytics_product_daily (day, product_id, revenue)
+    SELECT t.day, t.product_id, sum(t.revenue)
+    FROM analytics_store_product_daily t
+    JOIN (SELECT DISTINCT day, product_id FROM analytics_dirty_products) p
+      ON t.day = p.day AND t.product_id = p.product_id
+    GROUP BY 1, 2
+    """,
+]
+
+
+async def refresh_rollups(conn: AsyncConnection) -> Optional[Dict[str, int]]:
+    """
+    Aplica aos rollups as mudanças registradas em `analytics_rollup_changes`.
+
+    Deve rodar numa transação REPEATABLE READ (como `refresh_once`). Retorna
+    {"buckets": n, "max_sale_id": ...} ou None quando os rollups ainda não
+    foram criados ou outro processo já está atualizando.
+    """
+    if not (await conn.execute(text("SELECT to_regclass('analytics_rollup_changes')"))).scalar():
+        return None
+    locked = (await conn.execute(
+        text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ROLLUP_LOCK_KEY}
+    )).scalar()
+    if not locked:
+        return None
+
+    # um lote grande de mudanças (ex.: carga atrasada) pode passar do statement_timeout do perfil prod
+    await conn.execute(text("SET LOCAL statement_timeout = 0"))
+    max_sale_id = (await conn.execute(text("SELECT coalesce(max(id), 0) FROM sales"))).scalar()
+    for sql in REFRESH_SQL[:3]:
+        await conn.execute(text(sql))
+    buckets = (await conn.execute(text("SELECT count(*) FROM analytics_dirty_buckets"))).scalar()
+    if buckets:
+        for sql in REFRESH_SQL[3:]:
+            await conn.execute(text(sql))
+        # refreshed_at só muda quando algo mudou (invalida o cache de resultados)
+        await _write_state(conn, max_sale_id)
+    return {"buckets": buckets, "max_sale_id": max_sale_id}
+
+
+async def refresh_once(engine) -> Optional[Dict[str, int]]:
+    """Um ciclo de manutenção: refresh incremental + recarga de ROLLUP_STATE."""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+        async with conn.begin():
+            result = await refresh_rollups(conn)
+    async with engine.connect() as conn:
+        await load_rollup_state(conn)
+    return result
+
+
+async def maintain_rollups(engine, interval: float = ROLLUP_REFRESH_SECONDS) -> None:
+    """Loop de manutenção incremental usado pelo lifespan da API."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = await refresh_once(engine)
+            if result and result["buckets"]:
+                logger.info(
+                    "Rollups atualizados: %s buckets (max_sale_id=%s)",
+                    result["buckets"], result["max_sale_id"],
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Falha na manutenção incremental dos rollups: %s", exc)
+
+
+async def load_rollup_state(conn: AsyncConnection) -> Dict[str, Any]:
+    """
+    Lê `analytics_rollup_state` e atualiza ROLLUP_STATE.
+
+    Os rollups só são marcados como disponíveis quando TODOS os itens do
+    catálogo foram reconstruídos com o mesmo watermark; caso contrário o
+    roteador continua usando as tabelas brutas.
+    """
+    # calcula o novo estado antes de publicar: requisições concorrentes nunca
+    # veem um estado intermediário
+    state = {"available": False, "max_sale_id": None, "refreshed_at": None}
+
+    exists = (await conn.execute(text("SELECT to_regclass('analytics_rollup_state')"))).scalar()
+    if not exists:
+        ROLLUP_STATE.update(state)
+        return ROLLUP_STATE
+
+    rows = (await conn.execute(
+        text("SELECT name, max_sale_id, refreshed_at FROM analytics_rollup_state")
+    )).fetchall()
+    by_name = {r[0]: r for r in rows}
+    if all(r["name"] in by_name for r in ROLLUPS):
+        watermarks = {by_name[r["name"]][1] for r in ROLLUPS}
+        if len(watermarks) == 1:
+            state.update(
+                available=USE_ROLLUPS,
+                max_sale_id=watermarks.pop(),
+                refreshed_at=min(by_name[r["name"]][2] for r in ROLLUPS),
+            )
+    ROLLUP_STATE.update(state)
+    return ROLLUP_STATE
+
+
+# =============================================================================
+# CLI
+# =============================================================================
+
+async def _run(command: str) -> None:
+    # import tardio: `database` exige DATABASE_URL definido
+    from .database import engine
+
+    try:
+        if command == "rebuild":
+            # tabelas/triggers em uma transação própria: mudanças feitas a partir
+            # daqui entram no log, mesmo as que o snapshot do rebuild não vê
+            async with engine.begin() as conn:
+                await ensure_rollup_schema(conn)
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+                async with conn.begin():
+                    counts = await rebuild_rollups(conn)
+            for name, count in counts.items():
+                print(f"✓ {name}: {count:,} linhas")
+
+        if command == "refresh":
+            result = await refresh_once(engine)
+            if result is None:
+                print("Refresh ignorado: rollups não criados ou outro processo está atualizando")
+            else:
+                print(f"✓ {result['buckets']:,} buckets atualizados (max_sale_id={result['max_sale_id']})")
+
+        async with engine.connect() as conn:
+            state = await load_rollup_state(conn)
+        print(
+            f"Rollups disponíveis: {state['available']} "
+            f"(max_sale_id={state['max_sale_id']}, refreshed_at={state['refreshed_at']})"
+        )
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gerencia as tabelas de rollup do analytics")
+    parser.add_argument("command", choices=["rebuild", "refresh", "status"],
+                        help="rebuild: recria os rollups; refresh: aplica só as mudanças "
+                             "pendentes; status: mostra o watermark atual")
+    args = parser.parse_args()
+    asyncio.run(_run(args.command))
+
+
+if __name__ == "__main__":
+    main()
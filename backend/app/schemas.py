@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict, model_validator
-from typing import List, Any, Literal, Optional
+from typing import Dict, List, Any, Literal, Optional
 from datetime import datetime, date, time
 
 # -------------------------------------------------------------
@@ -11,9 +11,12 @@ from datetime import datetime, date, time
 #   (campo, operador, valor). Contém um `model_validator` que já normaliza
 #   valores date-like antes do restante da validação.
 # - `AnalyticsQueryRequest`: modelo do corpo da requisição para o endpoint
-#   de analytics (métricas, dimensões, filtros e time_grain).
+#   de analytics (métricas, dimensões, filtros, time_grain e Top-N:
+#   `order_by`, `limit` e `others`).
 # - `AnalyticsQueryResponse` e `ResponseMetadata`: modelos para a resposta
 #   que descrevem a estrutura retornada ao frontend.
+# - `AnalyticsBatchRequest` / `AnalyticsBatchResponse`: várias consultas em
+#   uma única chamada (`/analytics/batch`), com resultados na mesma ordem.
 # -------------------------------------------------------------
 
 
@@ -35,6 +38,9 @@ def _parse_date_value(val, *, end_of_day=False):
         # garantimos que iremos retornar um datetime
             if isinstance(parsed, date) and not isinstance(parsed, datetime):
                 return datetime.combine(parsed, time.max if end_of_day else time.min)
+        # No Python 3.11+ 'YYYY-MM-DD' vira datetime às 00:00; respeita end_of_day
+            if len(val.strip()) == 10:
+                return datetime.combine(parsed.date(), time.max if end_of_day else time.min)
             return parsed
         except Exception:
             # Tentativa alternativa para strings como 'YYYY-MM-DD ...'
@@ -107,6 +113,12 @@ class Filter(BaseModel):
         return values
 
 
+class OrderBy(BaseModel):
+    """Critério de ordenação do resultado."""
+    field: str = Field(..., description="Métrica ou dimensão pedida (ou 'time_bucket'). Ex: 'total_revenue'")
+    direction: Literal['asc', 'desc'] = Field(default='desc', description="'asc' ou 'desc'.")
+
+
 class AnalyticsQueryRequest(BaseModel):
     """Define o corpo da requisição para o endpoint principal de analytics."""
     metrics: List[str] = Field(
@@ -125,8 +137,45 @@ class AnalyticsQueryRequest(BaseModel):
     )
     time_grain: Optional[Literal['day', 'week', 'month']] = Field(
         default=None,
-        description="Agrupamento de tempo para séries temporais (opcional)."
+        description=(
+            "Agrupamento de tempo para séries temporais (opcional). Adiciona a coluna "
+            "`time_bucket` ao resultado, ordenada e sem lacunas (buckets vazios com 0)."
+        )
+    )
+    order_by: List[OrderBy] = Field(
+        default=[],
+        description=(
+            "Ordenação do resultado. Com `limit` e sem `order_by`, ordena pela "
+            "primeira métrica em ordem decrescente."
+        )
+    )
+    limit: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Quantidade máxima de grupos retornados (Top-N), aplicada no banco."
+    )
+    others: bool = Field(
+        default=False,
+        description=(
+            "Com `limit`, agrega os grupos restantes numa linha extra com as dimensões "
+            "iguais a 'Outros'. Não combina com `time_grain`."
+        )
     )
+    accuracy: Literal['exact', 'approximate'] = Field(
+        default='exact',
+        description=(
+            "'approximate' aceita estimativas a partir de uma amostra das vendas quando "
+            "não há resposta exata barata (rollup/memória). Os erros vão em `metadata.error_bounds`."
+        )
+    )
+
+    @model_validator(mode='after')
+    def _check_top_n(self):
+        if self.others and self.limit is None:
+            raise ValueError("'others' requer 'limit'")
+        if self.others and self.time_grain is not None:
+            raise ValueError("'others' não pode ser combinado com 'time_grain'")
+        return self
 
 
 # ===================================================================
@@ -137,9 +186,117 @@ class ResponseMetadata(BaseModel):
     """Metadados sobre a consulta executada."""
     query: AnalyticsQueryRequest
     execution_time_ms: float
+    cache_hit: bool = Field(
+        default=False,
+        description="True quando o resultado veio do cache em memória (sem ir ao banco)."
+    )
+    coalesced: bool = Field(
+        default=False,
+        description="True quando a requisição reaproveitou uma execução idêntica já em andamento."
+    )
+    statement_cache_hit: Optional[bool] = Field(
+        default=None,
+        description=(
+            "True quando a query já montada foi reaproveitada do cache de formatos "
+            "(só os parâmetros mudaram). None quando nenhuma query foi montada (cache de resultados)."
+        )
+    )
+    build_time_ms: Optional[float] = Field(
+        default=None,
+        description="Tempo para obter a query montada (lookup no cache ou construção), em ms."
+    )
+    execute_time_ms: Optional[float] = Field(
+        default=None,
+        description="Tempo de execução da query no Postgres (inclui a transferência das linhas), em ms."
+    )
+    fetch_time_ms: Optional[float] = Field(
+        default=None,
+        description="Tempo para converter as linhas do driver em dicionários, em ms."
+    )
+    serialize_time_ms: Optional[float] = Field(
+        default=None,
+        description="Tempo para serializar `data` em JSON, em ms (não incluído em execution_time_ms)."
+    )
+    accuracy: Optional[Literal['exact', 'approximate']] = Field(
+        default=None,
+        description="Como o resultado foi calculado (também num hit do cache de resultados)."
+    )
+    sample_percent: Optional[float] = Field(
+        default=None,
+        description="Percentual de vendas amostradas no modo aproximado."
+    )
+    error_bounds: Optional[Dict[str, Optional[float]]] = Field(
+        default=None,
+        description=(
+            "Modo aproximado: por métrica, meia-largura relativa do intervalo de 95% "
+            "na pior linha (0.05 = ±5%)."
+        )
+    )
+    engine: Optional[Literal['sql', 'columnar']] = Field(
+        default=None,
+        description=(
+            "Quem calculou o resultado: 'sql' (Postgres) ou 'columnar' (motor em memória), "
+            "mesmo quando ele veio do cache."
+        )
+    )
 
 
 class AnalyticsQueryResponse(BaseModel):
     """Define a estrutura completa da resposta do endpoint de analytics."""
     data: List[Any]
-    metadata: ResponseMetadata
\ No newline at end of file
+    metadata: ResponseMetadata
+
+
+# ===================================================================
+# Modelos do endpoint em lote (/analytics/batch)
+# ===================================================================
+
+class AnalyticsBatchRequest(BaseModel):
+    """Lista de consultas (ex.: todos os widgets de um dashboard)."""
+    queries: List[AnalyticsQueryRequest] = Field(
+        ...,
+        min_length=1,
+        description="Consultas a executar; consultas com os mesmos filtros são fundidas numa só query."
+    )
+
+
+class BatchItemMetadata(ResponseMetadata):
+    """Metadados de um item do lote."""
+    group: int = Field(..., description="Índice do grupo de execução ao qual a consulta pertenceu.")
+    fused: bool = Field(
+        default=False,
+        description="True quando respondida por uma query GROUPING SETS compartilhada com outras consultas."
+    )
+    error: Optional[str] = Field(
+        default=None,
+        description="Erro da execução do grupo desta consulta (ex.: statement_timeout); `data` vem vazio."
+    )
+
+
+class AnalyticsBatchItem(BaseModel):
+    data: List[Any]
+    metadata: BatchItemMetadata
+
+
+class AnalyticsBatchResponse(BaseModel):
+    """Resultados na mesma ordem de `AnalyticsBatchRequest.queries`."""
+    results: List[AnalyticsBatchItem]
+    execution_time_ms: float
+
+# ===================================================================
+# Modelo do endpoint de diagnóstico (/analytics/explain)
+# ===================================================================
+
+class AnalyticsExplainResponse(BaseModel):
+    """SQL gerado para a requisição e o plano executado pelo Postgres."""
+    sql: Optional[str] = Field(
+        default=None,
+        description="Query compilada, com placeholders nomeados; None quando nada foi pedido."
+    )
+    params: Dict[str, Any] = Field(default_factory=dict, description="Valores dos placeholders de `sql`.")
+    plan: Optional[Any] = Field(
+        default=None,
+        description="Saída de EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) da query (a query é executada)."
+    )
+    build_time_ms: Optional[float] = None
+    explain_time_ms: Optional[float] = None
@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Coalescência "single-flight" de queries analíticas idênticas.
+# - Requisições concorrentes com a mesma chave (requisição canônica +
+#   watermark) compartilham UMA execução no banco; todas recebem o mesmo
+#   resultado ou a mesma exceção.
+# - A execução roda numa task própria e cada requisição aguarda via
+#   `asyncio.shield`: se um cliente desconecta (cancelamento), apenas a sua
+#   espera é cancelada. A query só é cancelada quando não resta nenhuma
+#   requisição aguardando por ela.
+# -------------------------------------------------------------
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Agrupa chamadas concorrentes com a mesma chave numa única execução."""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _on_done(self, key: Hashable, flight: _Flight, task: "asyncio.Task") -> None:
+        self._forget(key, flight)
+        # marca a exceção como consumida mesmo que todos os waiters tenham saído
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Executa `fn()` ou aguarda a execução já em andamento para `key`.
+
+        Retorna (resultado, compartilhado), onde `compartilhado` é True quando
+        esta chamada reaproveitou uma execução iniciada por outra requisição.
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda t: self._on_done(key, flight, t))
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            # último interessado desistiu: cancela a query em andamento
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+            raise
+        except BaseException:
+            flight.waiters -= 1
+            raise
+        flight.waiters -= 1
+        return result, shared
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+# Instância compartilhada pelo processo (usada por `api.execute_analytics_query`)
+analytics_flights = SingleFlight()
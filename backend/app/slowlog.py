@@ -0,0 +1,163 @@
+import os
+import json
+import math
+import random
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("nola")
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Registro de consultas lentas de `crud.get_analytics_data`. Cada
+#   requisição é identificada por um fingerprint do seu formato (métricas,
+#   dimensões, campos/operadores filtrados, time_grain, ordenação, Top-N e
+#   accuracy), sem os valores: os widgets de um dashboard viram poucas
+#   entradas, não uma por combinação de filtros.
+# - Por fingerprint: contagem, tempo total/máximo e uma janela das últimas
+#   SLOWLOG_WINDOW durações, de onde saem p50/p95/p99. O número de
+#   fingerprints é limitado (SLOWLOG_MAX_FINGERPRINTS); ao estourar sai o
+#   menos recente.
+# - Execuções acima de SLOW_QUERY_MS são logadas (logger "nola", WARNING)
+#   com o SQL compilado e os binds, para uma fração SLOW_QUERY_SAMPLE delas.
+#   O SQL só é compilado quando a execução é amostrada; a última amostra
+#   fica guardada no fingerprint.
+# - `GET /api/v1/admin/slow-queries` devolve os N fingerprints mais lentos.
+# -------------------------------------------------------------
+
+SLOW_QUERY_MS = float(os.getenv("ANALYTICS_SLOW_QUERY_MS", "500"))
+SLOW_QUERY_SAMPLE = float(os.getenv("ANALYTICS_SLOW_QUERY_SAMPLE", "1.0"))
+SLOWLOG_MAX_FINGERPRINTS = int(os.getenv("ANALYTICS_SLOWLOG_MAX_FINGERPRINTS", "500"))
+SLOWLOG_WINDOW = int(os.getenv("ANALYTICS_SLOWLOG_WINDOW", "200"))
+
+ORDER_KEYS = ("p50_ms", "p95_ms", "p99_ms", "max_ms", "mean_ms", "total_ms", "count", "slow_count")
+
+
+def request_shape(query_request) -> Dict[str, Any]:
+    """Formato normalizado da requisição (sem valores literais dos filtros)."""
+    return {
+        "metrics": sorted(getattr(query_request, "metrics", None) or []),
+        "dimensions": sorted(getattr(query_request, "dimensions", None) or []),
+        "filters": sorted(f"{f.field} {f.operator}" for f in getattr(query_request, "filters", None) or []),
+        "time_grain": getattr(query_request, "time_grain", None),
+        "order_by": [f"{o.field} {o.direction}" for o in getattr(query_request, "order_by", None) or []],
+        "top_n": getattr(query_request, "limit", None) is not None,
+        "others": getattr(query_request, "others", False),
+        "accuracy": getattr(query_request, "accuracy", "exact"),
+    }
+
+
+def fingerprint(query_request) -> Tuple[str, Dict[str, Any]]:
+    """Identificador curto (hash do formato) e o formato em si."""
+    shape = request_shape(query_request)
+    digest = hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()[:12]
+    return digest, shape
+
+
+def percentile(ordered: List[float], q: float) -> Optional[float]:
+    """Percentil por posição mais próxima (nearest-rank) de uma lista ordenada."""
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(q * len(ordered)), 1) - 1]
+
+
+class _FingerprintStats:
+    __slots__ = ("shape", "count", "slow_count", "total_ms", "max_ms", "recent", "last_seen", "sample")
+
+    def __init__(self, shape: Dict[str, Any], window: int):
+        self.shape = shape
+        self.count = 0
+        self.slow_count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent = deque(maxlen=window)
+        self.last_seen = None
+        self.sample = None
+
+    def summary(self, fp: str) -> Dict[str, Any]:
+        ordered = sorted(self.recent)
+        return {
+            "fingerprint": fp,
+            "shape": self.shape,
+            "count": self.count,
+            "slow_count": self.slow_count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": percentile(ordered, 0.50),
+            "p95_ms": percentile(ordered, 0.95),
+            "p99_ms": percentile(ordered, 0.99),
+            "last_seen": self.last_seen.isoformat() if self.last_seen else None,
+            "sample": self.sample,
+        }
+
+
+class SlowQueryLog:
+    """Estatísticas por fingerprint com limite de entradas (LRU pelo último uso)."""
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, sample_rate: float = SLOW_QUERY_SAMPLE,
+                 max_fingerprints: int = SLOWLOG_MAX_FINGERPRINTS, window: int = SLOWLOG_WINDOW,
+                 rng: Callable[[], float] = random.random):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.max_fingerprints = max_fingerprints
+        self.window = window
+        self._rng = rng
+        self._entries: "OrderedDict[str, _FingerprintStats]" = OrderedDict()
+
+    def record(self, query_request, duration_ms: float,
+               compile_sql: Optional[Callable[[], Tuple[str, Dict[str, Any]]]] = None) -> None:
+        """
+        Registra uma execução. `compile_sql` devolve (sql, binds) e só é
+        chamado quando a execução é lenta e sorteada para o log.
+        """
+        if self.max_fingerprints <= 0:
+            return
+        fp, shape = fingerprint(query_request)
+        stats = self._entries.get(fp)
+        if stats is None:
+            stats = self._entries[fp] = _FingerprintStats(shape, self.window)
+            if len(self._entries) > self.max_fingerprints:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(fp)
+
+        duration_ms = round(duration_ms, 3)
+        stats.count += 1
+        stats.total_ms += duration_ms
+        stats.max_ms = max(stats.max_ms, duration_ms)
+        stats.recent.append(duration_ms)
+        stats.last_seen = datetime.now(timezone.utc)
+
+        if duration_ms < self.threshold_ms:
+            return
+        stats.slow_count += 1
+        if compile_sql is None or self._rng() >= self.sample_rate:
+            return
+        try:
+            sql, params = compile_sql()
+        except Exception as exc:  # o log não pode derrubar a requisição
+            logger.warning("Consulta lenta %s (%.1f ms): SQL indisponível (%s)", fp, duration_ms, exc)
+            return
+        stats.sample = {"duration_ms": duration_ms, "sql": sql, "params": params,
+                        "captured_at": stats.last_seen.isoformat()}
+        logger.warning("Consulta lenta %s (%.1f ms): %s | params=%r", fp, duration_ms, sql, params)
+
+    def top(self, limit: int = 10, order_by: str = "p95_ms") -> List[Dict[str, Any]]:
+        """Os `limit` fingerprints com maior `order_by` (um de ORDER_KEYS)."""
+        summaries = [stats.summary(fp) for fp, stats in self._entries.items()]
+        summaries.sort(key=lambda s: s[order_by] if s[order_by] is not None else -1, reverse=True)
+        return summaries[:limit]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Instância compartilhada pelo processo (alimentada por `crud.get_analytics_data`)
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,188 @@
+import csv
+import io
+import json
+from datetime import datetime, date
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.sql.sqltypes import DateTime, Integer, Numeric
+
+from . import crud, database
+
+try:
+    import pyarrow as pa
+except ImportError:  # formato Arrow indisponível sem o pacote
+    pa = None
+
+# -------------------------------------------------------------
+# Comentários (PT-BR):
+# - Respostas em streaming para resultados grandes de `/analytics`
+#   (`?format=ndjson|csv` ou header Accept correspondente).
+# - As linhas vêm de um cursor do lado do servidor (`AsyncSession.stream`
+#   com `yield_per`) e são serializadas em blocos conforme chegam, então a
+#   memória da API não cresce com o tamanho do resultado e o primeiro byte
+#   sai antes de a query terminar de ser lida.
+# - Valores são serializados como na resposta JSON: Decimal como string e
+#   datas em ISO 8601.
+# - `arrow` (application/vnd.apache.arrow.stream): cada bloco do cursor vira
+#   um RecordBatch montado coluna a coluna (sem dict por linha). O schema
+#   vem dos tipos SQL das colunas da query (não dos valores do primeiro
+#   bloco, que podem ser todos NULL): métricas saem como float64/int64,
+#   `time_bucket` como timestamp e dimensões texto com dictionary encoding;
+#   o dicionário é mantido entre blocos e só os valores novos são enviados
+#   (dictionary deltas).
+# -------------------------------------------------------------
+
+STREAM_BATCH_SIZE = 2000
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def negotiate_format(format_param: Optional[str], accept: Optional[str]) -> str:
+    """Resolve o formato pedido: o parâmetro `format` tem prioridade sobre Accept."""
+    if format_param:
+        return format_param
+    accept = (accept or "").lower()
+    for fmt, media_type in STREAM_MEDIA_TYPES.items():
+        if media_type in accept:
+            return fmt
+    return "json"
+
+
+def _to_text(val):
+    if isinstance(val, Decimal):
+        return str(val)
+    if isinstance(val, (datetime, date)):
+        return val.isoformat()
+    return val
+
+
+def _ndjson_chunk(rows: List[Dict[str, Any]]) -> str:
+    return "".join(
+        json.dumps({k: _to_text(v) for k, v in row.items()}, ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def _csv_chunk(rows, columns=None) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if columns is not None:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow(["" if v is None else _to_text(v) for v in row.values()])
+    return buffer.getvalue()
+
+
+async def _row_chunks(query_request, fmt: str) -> AsyncIterator[str]:
+    # no modo aproximado as colunas `<métrica>_stderr` seguem junto (não há metadados)
+    query, params = crud.prepare_analytics_query(query_request)[:2]
+    if fmt == "csv":
+        # cabeçalho sai antes da primeira linha (e mesmo sem linhas)
+        yield _csv_chunk([], columns=list(query.selected_columns.keys()) if query is not None else [])
+    if query is None:
+        return
+
+    # sessão própria: a sessão da dependência é encerrada quando o handler
+    # retorna, antes de o corpo em streaming terminar de ser enviado
+    async with database.AsyncSessionFactory() as session:
+        async for rows in crud.stream_query_rows(query, session, STREAM_BATCH_SIZE, params):
+            yield _csv_chunk(rows) if fmt == "csv" else _ndjson_chunk(rows)
+
+
+def _arrow_type(sql_type):
+    """Tipo Arrow de uma coluna pelo tipo SQL (tipos não mapeados viram texto)."""
+    if isinstance(sql_type, Integer):
+        return pa.int64()
+    if isinstance(sql_type, Numeric):
+        return pa.float64()
+    if isinstance(sql_type, DateTime):
+        return pa.timestamp("us")
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+class _DictionaryColumn:
+    """Dicionário de uma coluna texto, acumulado entre os blocos do stream."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def encode(self, values):
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            value = value if isinstance(value, str) else _to_text(value)
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+            indices.append(code)
+        # o dicionário anterior é prefixo do novo: o writer envia só o delta
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.values, pa.string()))
+
+
+def _arrow_array(values, arrow_type):
+    if pa.types.is_floating(arrow_type):
+        # Decimal -> float valor a valor (escalas podem variar dentro do bloco)
+        values = [None if v is None else float(v) for v in values]
+    return pa.array(values, arrow_type)
+
+
+async def _arrow_chunks(query_request) -> AsyncIterator[bytes]:
+    query, params = crud.prepare_analytics_query(query_request)[:2]
+    selected = list(query.selected_columns) if query is not None else []
+    schema = pa.schema([(c.key, _arrow_type(c.type)) for c in selected])
+    dictionaries = {
+        i: _DictionaryColumn() for i, field in enumerate(schema) if pa.types.is_dictionary(field.type)
+    }
+    sink = io.BytesIO()
+    # resultado vazio: stream só com o schema
+    writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    if query is not None:
+        async with database.AsyncSessionFactory() as session:
+            async for columns in crud.stream_query_columns(query, session, STREAM_BATCH_SIZE, params):
+                writer.write_batch(pa.record_batch(
+                    [
+                        dictionaries[i].encode(values) if i in dictionaries else _arrow_array(values, field.type)
+                        for i, (values, field) in enumerate(zip(columns, schema))
+                    ],
+                    schema=schema,
+                ))
+                yield _drain(sink)
+
+    writer.close()
+    yield _drain(sink)
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    """Bytes escritos no buffer desde a última leitura (o buffer é esvaziado)."""
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def stream_analytics_response(query_request, fmt: str) -> StreamingResponse:
+    """StreamingResponse com as linhas da consulta no formato `fmt` (ndjson|csv|arrow)."""
+    headers = {}
+    if fmt == "csv":
+        headers["Content-Disposition"] = 'attachment; filename="analytics.csv"'
+    if fmt == "arrow":
+        if pa is None:
+            raise HTTPException(status_code=406, detail="Formato Arrow indisponível: instale o pacote 'pyarrow'.")
+        return StreamingResponse(_arrow_chunks(query_request), media_type=STREAM_MEDIA_TYPES[fmt])
+    return StreamingResponse(
+        _row_chunks(query_request, fmt),
+        media_type=STREAM_MEDIA_TYPES[fmt],
+        headers=headers,
+    )
@@ -0,0 +1,16 @@
+from decimal import Decimal
+
+from app import schemas
+
+
+def _request(**kwargs):
+    """AnalyticsQueryRequest com `dimensions` vazio por padrão."""
+    kwargs.setdefault("dimensions", [])
+    return schemas.AnalyticsQueryRequest(**kwargs)
+
+
+def _as_comparable(rows):
+    """Linhas ordenadas, com números arredondados (SQL e caminhos em Python somam em ordens diferentes)."""
+    def norm(v):
+        return round(float(v), 4) if isinstance(v, (Decimal, float)) else v
+    return sorted((tuple(sorted((k, norm(v)) for k, v in row.items())) for row in rows), key=repr)
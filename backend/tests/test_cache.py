@@ -0,0 +1,131 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app import database
+from app.database import get_db
+from app.cache import QueryResultCache, canonical_query_key, result_cache
+from conftest import _request
+
+
+def test_canonical_key_ignores_filter_ordering_and_date_formats():
+    a = _request(
+        metrics=["order_count", "total_revenue"],
+        dimensions=["store_name", "channel_name"],
+        filters=[
+            {"field": "channel_name", "operator": "in", "value": ["Rappi", "iFood"]},
+            {"field": "order_time", "operator": "between", "value": ["2025-01-01", "2025-01-31"]},
+        ],
+    )
+    b = _request(
+        metrics=["order_count", "total_revenue"],
+        dimensions=["store_name", "channel_name"],
+        filters=[
+            {"field": "order_time", "operator": "between",
+             "value": ["2025-01-01T00:00:00", "2025-01-31T23:59:59.999999"]},
+            {"field": "channel_name", "operator": "in", "value": ["iFood", "Rappi"]},
+        ],
+    )
+    assert canonical_query_key(a) == canonical_query_key(b)
+
+    c = _request(metrics=["total_revenue", "order_count"], dimensions=["channel_name", "store_name"])
+    assert canonical_query_key(a) != canonical_query_key(c)
+
+
+def test_canonical_key_keeps_metric_and_dimension_order():
+    # Top-N sem order_by ranqueia pela primeira métrica; empates e o
+    # gap-fill seguem a ordem das dimensões: permutações não são equivalentes
+    a = _request(metrics=["total_revenue", "order_count"], dimensions=["store_name", "channel_name"], limit=5)
+    b = _request(metrics=["order_count", "total_revenue"], dimensions=["store_name", "channel_name"], limit=5)
+    c = _request(metrics=["total_revenue", "order_count"], dimensions=["channel_name", "store_name"], limit=5)
+    assert len({canonical_query_key(a), canonical_query_key(b), canonical_query_key(c)}) == 3
+
+
+def test_lru_eviction_ttl_and_watermark():
+    now = [0.0]
+    cache = QueryResultCache(max_entries=2, ttl_seconds=10, clock=lambda: now[0])
+
+    cache.set("a", 1, ["A"])
+    cache.set("b", 1, ["B"])
+    assert cache.get("a", 1) == ["A"]  # "a" passa a ser o mais recente
+    cache.set("c", 1, ["C"])           # evicta "b" (menos recente)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == ["A"]
+
+    # novas vendas mudam o watermark: entrada descartada
+    assert cache.get("a", 2) is None
+    assert cache.get("a", 1) is None
+
+    # TTL expirado
+    now[0] = 11.0
+    assert cache.get("c", 1) is None
+    assert len(cache) == 0
+
+
+class DummyResult:
+    def __init__(self, rows, watermark):
+        self._rows = rows
+        self._watermark = watermark
+
+    def scalar(self):
+        return self._watermark
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self._rows
+
+
+class DummySession:
+    """Sessão stub: devolve o watermark atual e conta as queries analíticas."""
+    watermark = 100
+    analytics_calls = 0
+
+    async def execute(self, query, *_args, **_kwargs):
+        if "max(sales.id)" not in str(query):
+            DummySession.analytics_calls += 1
+        return DummyResult([{"channel_name": "iFood", "order_count": 1}], DummySession.watermark)
+
+    async def rollback(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc):
+        return False
+
+
+async def override_get_db():
+    yield DummySession()
+
+
+def test_analytics_endpoint_reports_cache_hits(monkeypatch):
+    app.dependency_overrides[get_db] = override_get_db
+    # a execução analítica usa uma sessão própria (ver singleflight.py)
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    result_cache.clear()
+    DummySession.watermark = 100
+    DummySession.analytics_calls = 0
+    client = TestClient(app)
+    body = {"metrics": ["order_count"], "dimensions": ["channel_name"]}
+
+    try:
+        first = client.post("/api/v1/analytics", json=body).json()
+        second = client.post("/api/v1/analytics", json=body).json()
+        assert first["metadata"]["cache_hit"] is False
+        assert second["metadata"]["cache_hit"] is True
+        assert second["data"] == first["data"]
+        assert DummySession.analytics_calls == 1
+        # metadados do resultado são guardados junto dos dados
+        assert first["metadata"]["engine"] == second["metadata"]["engine"] == "sql"
+        assert first["metadata"]["accuracy"] == second["metadata"]["accuracy"] == "exact"
+
+        # novas vendas (watermark maior) invalidam o resultado em cache
+        DummySession.watermark = 101
+        third = client.post("/api/v1/analytics", json=body).json()
+        assert third["metadata"]["cache_hit"] is False
+        assert DummySession.analytics_calls == 2
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        result_cache.clear()
@@ -16,7 +16,7 @@ class DummySession:
     def __init__(self):
         self.last_q = None
 
-    async def execute(self, query):
+    async def execute(self, query, params=None):
         # armazena a query para que o teste possa inspecionar sua forma SQL/texto
         self.last_q = query
         return DummyResult()
@@ -47,3 +47,51 @@ def test_get_analytics_builds_query_and_returns_empty():
     q_text = str(session.last_q)
     assert "total_revenue" in q_text.lower(), "total_revenue não encontrado na query construída"
     assert "product_category" in q_text.lower(), "product_category não encontrado na query construída"
+
+
+def test_time_grain_adds_ordered_gap_filled_bucket():
+    """time_grain adiciona a dimensão `time_bucket` via date_trunc, com generate_series e ORDER BY."""
+    query_request = SimpleNamespace(
+        metrics=["total_revenue", "order_count"],
+        dimensions=["channel_name"],
+        filters=[SimpleNamespace(field="order_time", operator="between", value=["2025-01-01", "2025-01-31"])],
+        time_grain="week",
+    )
+
+    session = DummySession()
+    result = asyncio.run(crud.get_analytics_data(query_request, session))
+    assert result == []
+
+    q_text = str(session.last_q).lower()
+    assert "date_trunc" in q_text
+    assert "generate_series" in q_text
+    assert "time_bucket" in q_text
+    assert "order by buckets.time_bucket" in q_text
+    # buckets vazios viram 0 nas métricas aditivas
+    assert "coalesce(agg.total_revenue" in q_text
+
+
+def test_unused_dimension_tables_are_not_joined():
+    """Só as tabelas usadas por métricas/dimensões/filtros entram no JOIN."""
+    query_request = SimpleNamespace(
+        metrics=["total_revenue"],
+        dimensions=["channel_name"],
+        filters=[SimpleNamespace(field="store_state", operator="eq", value="SP")],
+    )
+    q_text = str(crud.build_analytics_query(query_request)).lower()
+    assert "join channels" in q_text
+    assert "join stores" in q_text  # exigida pelo filtro
+    assert "join products" not in q_text
+
+
+def test_order_metrics_use_sales_grain_without_count_distinct():
+    """order_count/avg_order_value são agregados por venda, sem COUNT(DISTINCT)."""
+    query_request = SimpleNamespace(
+        metrics=["order_count", "avg_order_value"],
+        dimensions=["product_name"],
+        filters=[],
+    )
+    q_text = str(crud.build_analytics_query(query_request)).lower()
+    assert "distinct" not in q_text
+    assert "group by sales.id" in q_text
+    assert "count(*) as order_count" in q_text
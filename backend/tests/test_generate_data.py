@@ -0,0 +1,165 @@
+import sys
+import gzip
+import json
+import random
+import shutil
+from argparse import Namespace
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import count
+from pathlib import Path
+
+import numpy as np
+import pytest
+from faker import Faker
+
+# generate_data.py fica na raiz do repositório, fora do pacote do backend
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+import generate_data  # noqa: E402
+
+
+START = datetime(2025, 1, 1)
+DAYS = [START + timedelta(days=30), START + timedelta(days=31), START + timedelta(days=95)]
+
+
+@pytest.fixture(scope="module")
+def base_data(tmp_path_factory):
+    """Tabelas base pequenas, escritas por um ShardWriter descartável."""
+    random.seed(7)
+    Faker.seed(7)
+    writer = generate_data.ShardWriter(tmp_path_factory.mktemp("base"), "csv", {"seed": 7})
+    writer.open("base")
+    sub_brand_ids, channels, payment_type_ids = generate_data.setup_base_data(writer)
+    stores = generate_data.generate_stores(writer, sub_brand_ids, 5, START)
+    products, items, option_groups = generate_data.generate_products_and_items(writer, sub_brand_ids, 20, 10)
+    customers = generate_data.generate_customers(writer, 50, START)
+    writer.close()
+    return stores, channels, products, items, option_groups, customers, payment_type_ids
+
+
+@pytest.fixture(params=["numpy", "python"])
+def context(request, base_data):
+    stores, channels, products, items, option_groups, customers, payment_type_ids = base_data
+    random.seed(11)
+    return generate_data.sales_context(
+        stores, channels, products, items, option_groups, customers, START,
+        payment_type_ids, False, request.param,
+    )
+
+
+def _day_rows(context, day):
+    """Linhas de cada tabela de vendas de um dia, pelo mesmo caminho da carga (ids a partir de 1)."""
+    if context["engine"] == "numpy":
+        day_data = generate_data.synthesize_numpy_day(context, day)
+        columns = generate_data.sales_day_columns(
+            day_data,
+            np.arange(1, len(day_data["sales"]["store_id"]) + 1),
+            np.arange(1, len(day_data["product_sales"]["sale"]) + 1),
+            np.arange(1, len(day_data["deliveries"]["sale"]) + 1),
+        )
+        return {
+            table: list(zip(*(np.asarray(values).tolist() for values in columns[table])))
+            for table in generate_data.LOADED_TABLES
+        }
+    sales = generate_data.synthesize_day_sales(context, day)
+    return generate_data.sales_batch_rows(
+        sales, range(1, len(sales) + 1), count(1), count(1), context["payment_type_ids"]
+    )
+
+
+def test_day_row_counts_match_the_loaded_rows(context):
+    for day in DAYS[:2]:
+        rows = _day_rows(context, day)
+        assert rows["sales"]
+        assert generate_data.day_row_counts(context, day) == {table: len(rows[table]) for table in rows}
+
+
+def test_day_synthesis_does_not_depend_on_call_order(context):
+    """Com --workers os dias saem em qualquer ordem e processo: cada dia tem a própria semente."""
+    forward = [_day_rows(context, day) for day in DAYS]
+    backward = [_day_rows(context, day) for day in reversed(DAYS)][::-1]
+    assert forward == backward
+    assert _day_rows(context, DAYS[1]) == forward[1]
+    assert forward[0] != forward[1]
+
+
+def test_day_first_ids_are_contiguous_blocks():
+    counts = [3, 0, 5, 1, 2]
+    firsts = generate_data.day_first_ids(10, counts)
+    assert firsts == [10, 13, 13, 18, 19]
+    blocks = [range(first, first + n) for first, n in zip(firsts, counts)]
+    assert [i for block in blocks for i in block] == list(range(10, 10 + sum(counts)))
+
+
+class _CopyCursor:
+    """Cursor psycopg2 mínimo: guarda o que o COPY recebeu e informa `loaded` linhas."""
+
+    def __init__(self, loaded=None):
+        self.loaded = loaded
+
+    def copy_expert(self, sql, buffer):
+        self.sql, self.text = sql, buffer.read()
+        self.rowcount = self.text.count("\n") if self.loaded is None else self.loaded
+
+
+def test_copy_value_escapes_the_text_format():
+    assert generate_data._copy_value(None) == "\\N"
+    assert generate_data._copy_value(True) == "t" and generate_data._copy_value(False) == "f"
+    assert generate_data._copy_value("a\tb\nc\rd\\N") == "a\\tb\\nc\\rd\\\\N"
+    assert generate_data._copy_value(Decimal("12.50")) == "12.50"
+    assert generate_data._copy_value(datetime(2025, 1, 2, 3, 4, 5)) == "2025-01-02 03:04:05"
+
+
+def test_copy_rows_writes_one_line_per_row_and_checks_the_count():
+    cursor = _CopyCursor()
+    rows = [(1, "Rua A\tfundos", None), (2, "linha\nquebrada", Decimal("3.10"))]
+    assert generate_data.copy_rows(cursor, "sales", ("id", "street", "value"), rows) == 2
+    assert cursor.sql == "COPY sales (id, street, value) FROM STDIN"
+    assert cursor.text == "1\tRua A\\tfundos\t\\N\n2\tlinha\\nquebrada\t3.10\n"
+
+    assert generate_data.copy_rows(_CopyCursor(), "sales", ("id",), []) == 0
+    with pytest.raises(RuntimeError, match="loaded 1 of 2"):
+        generate_data.copy_rows(_CopyCursor(loaded=1), "sales", ("id", "street", "value"), rows)
+
+
+def _shard_contents(path):
+    """Conteúdo de cada tabela do shard (CSV descomprimido; Parquet como colunas)."""
+    contents = {}
+    for table_file in sorted(path.iterdir()):
+        if table_file.name.endswith(".csv.gz"):
+            with gzip.open(table_file, "rt", encoding="utf-8") as handle:
+                contents[table_file.name] = handle.read()
+        else:
+            contents[table_file.name] = generate_data.pq.read_table(table_file).to_pydict()
+    return contents
+
+
+@pytest.mark.parametrize("fmt", [
+    "csv",
+    pytest.param("parquet", marks=pytest.mark.skipif(generate_data.pa is None, reason="pyarrow ausente")),
+])
+def test_shard_run_resumes_the_missing_month(tmp_path, fmt):
+    args = Namespace(
+        seed=3, end_date=datetime(2025, 3, 10), months=1, stores=3, products=10, items=5,
+        customers=20, engine="numpy", format=fmt, output_dir=tmp_path,
+    )
+    generate_data.generate_files(args)
+    manifest_path = tmp_path / generate_data.MANIFEST
+    manifest = json.loads(manifest_path.read_text())
+    assert [shard["name"] for shard in manifest["shards"]] == ["base", "2025-02", "2025-03"]
+    last = manifest["shards"][-1]
+    expected = _shard_contents(tmp_path / last["name"])
+
+    # simula uma execução interrompida antes do último mês
+    shutil.rmtree(tmp_path / last["name"])
+    manifest["shards"].pop()
+    manifest["complete"] = False
+    manifest_path.write_text(json.dumps(manifest))
+
+    generate_data.generate_files(args)
+    resumed = json.loads(manifest_path.read_text())
+    assert resumed["complete"] and resumed["shards"][-1] == last
+    assert _shard_contents(tmp_path / last["name"]) == expected
+
+    with pytest.raises(SystemExit):
+        generate_data.generate_files(Namespace(**{**vars(args), "months": 2}))
@@ -0,0 +1,52 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app import metrics, schemas
+
+
+def test_histogram_renders_cumulative_buckets():
+    hist = metrics.Histogram("latency_seconds", "Latência.", ("shape",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        hist.observe(value, ("a|b|",))
+    assert list(hist.samples()) == [
+        'latency_seconds_bucket{shape="a|b|",le="0.1"} 2',
+        'latency_seconds_bucket{shape="a|b|",le="1.0"} 3',
+        'latency_seconds_bucket{shape="a|b|",le="+Inf"} 4',
+        'latency_seconds_sum{shape="a|b|"} 3.65',
+        'latency_seconds_count{shape="a|b|"} 4',
+    ]
+
+
+def test_query_shape_ignores_values_and_caps_cardinality(monkeypatch):
+    monkeypatch.setattr(metrics, "_shapes", {})
+    a = schemas.AnalyticsQueryRequest(
+        metrics=["total_revenue", "order_count"], dimensions=["store_name"],
+        filters=[{"field": "channel_name", "operator": "eq", "value": "iFood"}],
+    )
+    b = schemas.AnalyticsQueryRequest(
+        metrics=["order_count", "total_revenue"], dimensions=["store_name"],
+        filters=[{"field": "channel_name", "operator": "in", "value": ["Rappi"]}],
+    )
+    assert metrics.query_shape(a) == metrics.query_shape(b) == "order_count,total_revenue|store_name|channel_name"
+
+    monkeypatch.setattr(metrics, "METRICS_MAX_SHAPES", 1)
+    other = schemas.AnalyticsQueryRequest(metrics=["order_count"], dimensions=[])
+    assert metrics.query_shape(other) == metrics.OTHER_SHAPE
+    assert metrics.query_shape(a) != metrics.OTHER_SHAPE
+
+
+def test_metrics_endpoint_counts_errors_by_route():
+    metrics.HTTP_ERRORS.clear()
+    client = TestClient(app)
+
+    assert client.post("/api/v1/analytics", json={"metrics": ["nope"]}).status_code == 422
+    assert client.get("/api/v1/nothing").status_code == 404
+    assert metrics.HTTP_ERRORS.value(("/api/v1/analytics", "422")) == 1
+    assert metrics.HTTP_ERRORS.value(("unmatched", "404")) == 1
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_errors_total{route="/api/v1/analytics",status="422"} 1' in resp.text
+    assert "# TYPE db_pool_checkouts_total counter" in resp.text
+    assert 'analytics_cache_hits_total{cache="results"}' in resp.text
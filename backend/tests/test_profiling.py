@@ -0,0 +1,108 @@
+import json
+from decimal import Decimal
+
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import postgresql
+
+from app.main import app
+from app import api, database
+from app.cache import result_cache
+from app.database import get_db
+
+
+PLAN = [{"Plan": {"Node Type": "Aggregate", "Shared Hit Blocks": 12}, "Execution Time": 1.5}]
+
+
+class DummyResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def scalar(self):
+        return self._rows
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self._rows
+
+
+class DummySession:
+    """Sessão stub: watermark fixo, linhas fixas e o plano para EXPLAIN."""
+    statements = []
+
+    async def execute(self, query, *_args, **_kwargs):
+        sql = str(query.compile(dialect=postgresql.dialect()))
+        DummySession.statements.append(sql)
+        if sql.startswith("EXPLAIN"):
+            return DummyResult(json.dumps(PLAN))
+        if "max(sales.id)" in sql:
+            return DummyResult(100)
+        return DummyResult([{"channel_name": "iFood", "total_revenue": Decimal("10.50")}])
+
+    async def rollback(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc):
+        return False
+
+
+async def override_get_db():
+    yield DummySession()
+
+
+BODY = {
+    "metrics": ["total_revenue"], "dimensions": ["channel_name"],
+    "filters": [{"field": "channel_name", "operator": "in", "value": ["iFood", "Rappi"]}],
+}
+
+
+def test_analytics_reports_phase_timings_and_server_timing(monkeypatch):
+    app.dependency_overrides[get_db] = override_get_db
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    result_cache.clear()
+    client = TestClient(app)
+
+    try:
+        resp = client.post("/api/v1/analytics", json=BODY)
+        assert resp.status_code == 200
+        body = resp.json()
+        assert body["data"] == [{"channel_name": "iFood", "total_revenue": "10.50"}]
+        meta = body["metadata"]
+        for field in ("build_time_ms", "execute_time_ms", "fetch_time_ms", "serialize_time_ms"):
+            assert meta[field] >= 0, field
+        phases = [entry.split(";")[0] for entry in resp.headers["server-timing"].split(", ")]
+        assert phases == ["build", "db", "fetch", "serialize", "total"]
+
+        # do cache: só a serialização é medida
+        resp = client.post("/api/v1/analytics", json=BODY)
+        assert resp.json()["metadata"]["execute_time_ms"] is None
+        assert 'cache;desc="hit"' in resp.headers["server-timing"]
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        result_cache.clear()
+
+
+def test_explain_endpoint_returns_sql_and_plan(monkeypatch):
+    app.dependency_overrides[get_db] = override_get_db
+    client = TestClient(app)
+
+    try:
+        # desligado por padrão (ANALYTICS_EXPLAIN)
+        assert client.post("/api/v1/analytics/explain", json=BODY).status_code == 404
+
+        monkeypatch.setattr(api, "EXPLAIN_ENABLED", True)
+        DummySession.statements = []
+        resp = client.post("/api/v1/analytics/explain", json=BODY)
+        assert resp.status_code == 200
+        body = resp.json()
+        assert body["plan"] == PLAN
+        # lista do IN expandida: um placeholder por valor
+        assert "IN (%(filter_0_1)s::VARCHAR, %(filter_0_2)s::VARCHAR)" in body["sql"]
+        assert body["params"] == {"filter_0_1": "iFood", "filter_0_2": "Rappi"}
+        assert DummySession.statements[-1].startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT")
+    finally:
+        app.dependency_overrides.pop(get_db, None)
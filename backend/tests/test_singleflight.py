@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+def test_concurrent_identical_calls_share_one_execution():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ["row"]
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do("k", work) for _ in range(5)])
+        assert flights.in_flight() == 0
+        return results
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert [r for r, _ in results] == [["row"]] * 5
+    # apenas a primeira chamada executou; as demais foram coalescidas
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+
+
+def test_errors_propagate_to_all_waiters():
+    async def boom():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("db down")
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do("k", boom) for _ in range(3)], return_exceptions=True)
+        assert flights.in_flight() == 0
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    started = []
+
+    async def work():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        flights = SingleFlight()
+        leader = asyncio.ensure_future(flights.do("k", work))
+        follower = asyncio.ensure_future(flights.do("k", work))
+        await asyncio.sleep(0.01)
+        leader.cancel()  # cliente que iniciou a query desconecta
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == (42, True)
+    assert len(started) == 1
+
+
+def test_query_is_cancelled_when_every_waiter_leaves():
+    state = {}
+
+    async def work():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def main():
+        flights = SingleFlight()
+        waiters = [asyncio.ensure_future(flights.do("k", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for w in waiters:
+            w.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert flights.in_flight() == 0
+
+    asyncio.run(main())
+    assert state.get("cancelled") is True
@@ -0,0 +1,73 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app import crud
+from app.slowlog import SlowQueryLog, fingerprint, slow_query_log
+from conftest import _request
+
+
+def test_fingerprint_ignores_literal_values():
+    a = _request(metrics=["total_revenue"], dimensions=["store_name"],
+                 filters=[{"field": "channel_name", "operator": "in", "value": ["iFood"]}])
+    b = _request(metrics=["total_revenue"], dimensions=["store_name"],
+                 filters=[{"field": "channel_name", "operator": "in", "value": ["Rappi", "Presencial"]}])
+    c = _request(metrics=["total_revenue"], dimensions=["store_name"],
+                 filters=[{"field": "channel_name", "operator": "eq", "value": "iFood"}])
+    assert fingerprint(a)[0] == fingerprint(b)[0]
+    assert fingerprint(a)[0] != fingerprint(c)[0]
+    assert fingerprint(a)[1]["filters"] == ["channel_name in"]
+
+
+def test_percentiles_bounded_store_and_sampled_sql_capture():
+    draws = iter([0.9, 0.1])
+    log = SlowQueryLog(threshold_ms=100, sample_rate=0.5, max_fingerprints=2, window=100,
+                       rng=lambda: next(draws))
+    compiled = []
+
+    def compile_sql():
+        compiled.append(True)
+        return "SELECT 1", {"p": 1}
+
+    req = _request(metrics=["order_count"])
+    for ms in range(1, 101):
+        log.record(req, float(ms), compile_sql)
+    # 100 ms é o único acima do limite, mas o sorteio (0.9) não o amostra
+    [top] = log.top()
+    assert (top["count"], top["slow_count"], top["p50_ms"], top["p95_ms"], top["p99_ms"]) == (100, 1, 50, 95, 99)
+    assert top["sample"] is None and not compiled
+
+    log.record(req, 250.0, compile_sql)
+    assert log.top()[0]["sample"]["sql"] == "SELECT 1" and compiled == [True]
+
+    # limite de fingerprints: sai o usado há mais tempo
+    log.record(_request(metrics=["total_revenue"]), 5.0)
+    log.record(_request(metrics=["avg_order_value"]), 7.0)
+    assert len(log) == 2
+    assert {s["shape"]["metrics"][0] for s in log.top(order_by="count")} == {"total_revenue", "avg_order_value"}
+
+
+def test_compiled_sql_expands_in_lists():
+    req = _request(metrics=["order_count"],
+                   filters=[{"field": "channel_name", "operator": "in", "value": ["iFood", "Rappi"]}])
+    prepared = crud.prepare_analytics_query(req)
+    sql, params = crud.compiled_sql(prepared.statement, prepared.params)
+    assert "IN (%(filter_0_1)s::VARCHAR, %(filter_0_2)s::VARCHAR)" in sql
+    assert params == {"filter_0_1": "iFood", "filter_0_2": "Rappi"}
+
+
+def test_admin_endpoint_lists_slowest_fingerprints():
+    slow_query_log.clear()
+    slow_query_log.record(_request(metrics=["order_count"]), 10.0)
+    slow_query_log.record(_request(metrics=["total_revenue"]), 900.0)
+    client = TestClient(app)
+
+    try:
+        body = client.get("/api/v1/admin/slow-queries", params={"limit": 1}).json()
+        assert body["fingerprints"] == 2
+        assert [item["shape"]["metrics"] for item in body["top"]] == [["total_revenue"]]
+        assert client.get("/api/v1/admin/slow-queries", params={"order_by": "nope"}).status_code == 422
+
+        assert client.delete("/api/v1/admin/slow-queries").status_code == 200
+        assert client.get("/api/v1/admin/slow-queries").json()["top"] == []
+    finally:
+        slow_query_log.clear()
@@ -0,0 +1,139 @@
+import json
+from decimal import Decimal
+from datetime import datetime
+
+import pyarrow as pa
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app import database
+from app.streaming import negotiate_format
+
+
+ROWS = [
+    {"total_revenue": Decimal("10.50"), "channel_name": "iFood", "time_bucket": datetime(2025, 1, 1)},
+    {"total_revenue": None, "channel_name": "Rappi, SP", "time_bucket": datetime(2025, 1, 2)},
+    {"total_revenue": Decimal("3"), "channel_name": "Presencial", "time_bucket": datetime(2025, 1, 3)},
+]
+
+
+class DummyMappingResult:
+    async def partitions(self):
+        # simula o cursor do servidor devolvendo blocos de linhas
+        yield ROWS[:2]
+        yield ROWS[2:]
+
+
+class DummyStreamResult:
+    def mappings(self):
+        return DummyMappingResult()
+
+    async def partitions(self):
+        # sem .mappings(): blocos de tuplas, como as Rows do SQLAlchemy
+        yield [tuple(row.values()) for row in ROWS[:2]]
+        yield [tuple(row.values()) for row in ROWS[2:]]
+
+
+class DummySession:
+    """Sessão stub que registra as opções de execução usadas no streaming."""
+    last_options = None
+
+    async def stream(self, query, params=None):
+        DummySession.last_options = query.get_execution_options()
+        return DummyStreamResult()
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc):
+        return False
+
+
+BODY = {"metrics": ["total_revenue"], "dimensions": ["channel_name"], "time_grain": "day"}
+
+
+def test_negotiate_format():
+    assert negotiate_format(None, "application/json, text/plain, */*") == "json"
+    assert negotiate_format(None, "application/x-ndjson") == "ndjson"
+    assert negotiate_format(None, "text/csv") == "csv"
+    assert negotiate_format("csv", "application/x-ndjson") == "csv"
+
+
+def test_ndjson_streams_rows_from_server_side_cursor(monkeypatch):
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    client = TestClient(app)
+
+    resp = client.post("/api/v1/analytics?format=ndjson", json=BODY)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert lines == [
+        {"total_revenue": "10.50", "channel_name": "iFood", "time_bucket": "2025-01-01T00:00:00"},
+        {"total_revenue": None, "channel_name": "Rappi, SP", "time_bucket": "2025-01-02T00:00:00"},
+        {"total_revenue": "3", "channel_name": "Presencial", "time_bucket": "2025-01-03T00:00:00"},
+    ]
+    assert DummySession.last_options.get("yield_per")
+
+
+def test_csv_via_accept_header_includes_header_row(monkeypatch):
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    client = TestClient(app)
+
+    resp = client.post("/api/v1/analytics", json=BODY, headers={"Accept": "text/csv"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+    assert resp.text.splitlines() == [
+        "total_revenue,channel_name,time_bucket",
+        "10.50,iFood,2025-01-01T00:00:00",
+        ',"Rappi, SP",2025-01-02T00:00:00',
+        "3,Presencial,2025-01-03T00:00:00",
+    ]
+
+
+def test_arrow_stream_is_columnar_with_dictionary_encoded_dimensions(monkeypatch):
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    client = TestClient(app)
+
+    resp = client.post("/api/v1/analytics?format=arrow", json=BODY)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/vnd.apache.arrow.stream")
+    table = pa.ipc.open_stream(resp.content).read_all()
+    assert table.schema.field("total_revenue").type == pa.float64()
+    assert pa.types.is_dictionary(table.schema.field("channel_name").type)
+    assert table.schema.field("time_bucket").type == pa.timestamp("us")
+    assert table.to_pylist() == [
+        {"total_revenue": 10.5, "channel_name": "iFood", "time_bucket": datetime(2025, 1, 1)},
+        {"total_revenue": None, "channel_name": "Rappi, SP", "time_bucket": datetime(2025, 1, 2)},
+        {"total_revenue": 3.0, "channel_name": "Presencial", "time_bucket": datetime(2025, 1, 3)},
+    ]
+
+
+def test_arrow_schema_comes_from_sql_types_not_first_block(monkeypatch):
+    # primeiro bloco só com NULL na métrica; dimensões repetidas entre blocos
+    rows = [
+        {"total_revenue": None, "channel_name": "iFood", "time_bucket": datetime(2025, 1, 1)},
+        {"total_revenue": None, "channel_name": None, "time_bucket": datetime(2025, 1, 2)},
+        {"total_revenue": Decimal("12.34"), "channel_name": "iFood", "time_bucket": datetime(2025, 1, 3)},
+        {"total_revenue": Decimal("5"), "channel_name": "Rappi", "time_bucket": None},
+    ]
+    monkeypatch.setitem(globals(), "ROWS", rows)
+    monkeypatch.setattr(database, "AsyncSessionFactory", DummySession)
+    client = TestClient(app)
+
+    resp = client.post("/api/v1/analytics?format=arrow", json=BODY)
+    assert resp.status_code == 200
+    reader = pa.ipc.open_stream(resp.content)
+    assert reader.schema.field("total_revenue").type == pa.float64()
+    batches = list(reader)
+    assert len(batches) == 2
+    # o dicionário cresce entre blocos (delta) em vez de ser refeito
+    assert batches[1].column(1).dictionary.to_pylist() == ["iFood", "Rappi"]
+    assert pa.Table.from_batches(batches).to_pylist() == [
+        {"total_revenue": None, "channel_name": "iFood", "time_bucket": datetime(2025, 1, 1)},
+        {"total_revenue": None, "channel_name": None, "time_bucket": datetime(2025, 1, 2)},
+        {"total_revenue": 12.34, "channel_name": "iFood", "time_bucket": datetime(2025, 1, 3)},
+        {"total_revenue": 5.0, "channel_name": "Rappi", "time_bucket": None},
+    ]
@@ -18,6 +18,21 @@ export const fetchAnalyticsData = async (queryConfig) => {
   }
 };
 
+/**
+ * Executa várias consultas de uma vez (ex.: todos os widgets do dashboard).
+ * Consultas com os mesmos filtros são respondidas por uma única query no backend.
+ * @param {Array<object>} queries - Lista de objetos { metrics, dimensions, filters }
+ */
+export const fetchAnalyticsBatch = async (queries) => {
+  try {
+    const response = await apiClient.post('/analytics/batch', { queries });
+    return response.data; // Retorna { results: [{ data, metadata }], execution_time_ms }
+  } catch (error) {
+    console.error('Erro ao buscar dados em lote da API:', error);
+    throw error;
+  }
+};
+
 /**
  * Busca as métricas disponíveis
  */